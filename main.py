@@ -7,15 +7,26 @@ import signal
 
 from dotenv import load_dotenv
 
+from models.constants import IMAGE_STORE_CAPACITY
 from models.setup import setup
 from servers.clip import run_clipapi
+from servers.workers import CLIPAPI_WORKERS, prepare_workers, run_clipapi_workers
 import logging
+import sys
 
 # Define an event to signal all threads to exit
 shutdown_event = Event()
 
 if __name__ == "__main__":
     load_dotenv()
+    if CLIPAPI_WORKERS > 1:
+        prepare_workers(CLIPAPI_WORKERS)
+        # Every worker opens a shard of the image store, see servers/workers.py
+        models_pack = setup(with_image_store=False)
+        run_clipapi_workers(
+            models_pack, CLIPAPI_WORKERS, logger_listener, IMAGE_STORE_CAPACITY
+        )
+        sys.exit(0)
     models_pack = setup()
 
     # Setup signal handler for exit
@@ -23,6 +34,10 @@ if __name__ == "__main__":
         if not shutdown_event.is_set():
             logging.info("Signal received, shutting down...")
             shutdown_event.set()
+            if models_pack.image_store is not None:
+                models_pack.image_store.flush()
+            if models_pack.vector_index is not None:
+                models_pack.vector_index.flush()
             logger_listener.stop()
 
     signal.signal(signal.SIGINT, signal_handler)
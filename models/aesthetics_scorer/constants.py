@@ -1,3 +1,9 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
 AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_WEIGHT_URL = "https://ba.stablecog.com/aesthetics_scorer/aesthetics_scorer_rating_openclip_vit_h_14.pth"
 AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_CONFIG = {
     "input_size": 1280,
@@ -19,3 +25,16 @@ AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_CONFIG = {
 }
 
 AESTHETICS_SCORER_CACHE_DIR = "/app/data/aesthetics-scorer"
+
+# Embeddings the heads score at once, bigger batches are split
+AESTHETICS_SCORER_BATCH_SIZE_MAX = int(
+    os.getenv("AESTHETICS_SCORER_BATCH_SIZE_MAX", 64)
+)
+
+# Identifies the fused rating and artifact heads, for the exported graphs
+AESTHETICS_SCORER_OPENCLIP_VIT_H_14_CACHE_KEY = "|".join(
+    [
+        AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_WEIGHT_URL,
+        AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_WEIGHT_URL,
+    ]
+)
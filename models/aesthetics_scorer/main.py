@@ -1,15 +1,23 @@
+import logging
+import time
+from typing import List
+
 import torch
 
 from models.constants import (
     DEVICE,
+    MODEL_BATCH_PADDING,
     AestheticScoreResult,
     AestheticsScorer,
-    OpenCLIP,
 )
-from .model import preprocess
+from models.backends import GraphSpec
+from models.batcher import batch_size_buckets, run_batched
+from utils.metrics import BATCH_SIZE, STAGE_AESTHETICS, stage_timer
+from .constants import AESTHETICS_SCORER_BATCH_SIZE_MAX
+from .model import FusedAestheticScorer, preprocess
 
 
-def normalize(value, range_min, range_max):
+def normalize(value: torch.Tensor, range_min, range_max) -> torch.Tensor:
     # Ensure the range is valid
     if range_min == range_max:
         raise ValueError("Minimum and maximum range values cannot be the same.")
@@ -18,33 +26,70 @@ def normalize(value, range_min, range_max):
             "Minimum range value cannot be greater than the maximum range value."
         )
 
-    # Normalize the value
+    # Normalize the values
     normalized_value = (value - range_min) / (range_max - range_min)
-    return max(0, min(normalized_value, 1))  # Clamp between 0 and 1
+    return normalized_value.clamp(0, 1)  # Clamp between 0 and 1
+
 
+def aesthetics_graph_spec(
+    fused_model: FusedAestheticScorer, cache_key: str
+) -> GraphSpec:
+    """`cache_key` identifies the weights of the fused heads, like their URLs."""
+    input_size = fused_model.config["input_size"]
+    return GraphSpec(
+        name="aesthetics-scorer",
+        module=fused_model,
+        example_inputs=(torch.randn(2, input_size, device=DEVICE),),
+        check_inputs=(torch.randn(3, input_size, device=DEVICE),),
+        input_names=["embeddings"],
+        output_names=["scores"],
+        dynamic_axes={"embeddings": {0: "batch"}},
+        cache_key=cache_key,
+    )
 
-def generate_aesthetic_scores(
-    image, aesthetics_scorer: AestheticsScorer, clip: OpenCLIP, pooler_output=None
-) -> AestheticScoreResult:
-    clip_processor = clip.processor
-    vision_model = clip.model.vision_model
-    rating_model = aesthetics_scorer.rating_model
-    artifacts_model = aesthetics_scorer.artifacts_model
-    calculated_pooler_output = pooler_output
 
-    if calculated_pooler_output is None:
-        inputs = clip_processor(images=image, return_tensors="pt").to(DEVICE)
+def generate_aesthetic_scores_batch(
+    pooler_outputs: torch.Tensor, aesthetics_scorer: AestheticsScorer
+) -> List[AestheticScoreResult]:
+    """Scores a whole `[N, hidden_size]` batch of pooled vision outputs at once."""
+    BATCH_SIZE.labels("Aesthetics Scorer").observe(len(pooler_outputs))
+    with stage_timer(STAGE_AESTHETICS):
+        embeddings = preprocess(pooler_outputs.to(DEVICE))
+
+        forward = aesthetics_scorer.forward or aesthetics_scorer.fused_model
         with torch.no_grad():
-            vision_output = vision_model(**inputs)
-            calculated_pooler_output = vision_output.pooler_output
+            # One column per head: rating, artifact
+            (scores,) = run_batched(
+                forward,
+                (embeddings,),
+                AESTHETICS_SCORER_BATCH_SIZE_MAX,
+                MODEL_BATCH_PADDING,
+            )
+            scores = scores.to(DEVICE)
 
-    embedding = preprocess(calculated_pooler_output)
+        ratings = normalize(scores[:, 0], 0, 10)
+        artifacts = normalize(scores[:, 1], 0, 5)
+        # A single device sync for the whole batch
+        normalized = torch.stack([ratings, artifacts], dim=1).cpu().tolist()
+    return [
+        AestheticScoreResult(rating_score=rating, artifact_score=artifact)
+        for rating, artifact in normalized
+    ]
 
-    with torch.no_grad():
-        rating = rating_model(embedding)
-        artifact = artifacts_model(embedding)
 
-    return AestheticScoreResult(
-        rating_score=normalize(rating.detach().cpu().item(), 0, 10),
-        artifact_score=normalize(artifact.detach().cpu().item(), 0, 5),
+def warmup_aesthetics_scorer(aesthetics_scorer: AestheticsScorer, runs: int):
+    """Scores a batch of random embeddings of every padded shape."""
+    start = time.time()
+    sizes = batch_size_buckets(AESTHETICS_SCORER_BATCH_SIZE_MAX)
+    if not MODEL_BATCH_PADDING:
+        sizes = [sizes[-1]]
+    input_size = aesthetics_scorer.fused_model.config["input_size"]
+    for _ in range(runs):
+        for size in sizes:
+            generate_aesthetic_scores_batch(
+                torch.randn(size, input_size, device=DEVICE), aesthetics_scorer
+            )
+    logging.info(
+        f"✅ Warmed up Aesthetics Scorer in: {round((time.time() - start) * 1000)} ms"
     )
+
@@ -87,6 +87,65 @@ class AestheticScorer(nn.Module):
                     raise e
 
 
+class FusedAestheticScorer(nn.Module):
+    """
+    Runs several `AestheticScorer` heads that share a config as one module, the
+    output has one column per head. Each layer of the heads is stacked into one
+    batched matmul, and heads without hidden activations are linear end to end so
+    they are precomposed into a single `[input_size, len(models)]` projection.
+    """
+
+    def __init__(self, models):
+        super().__init__()
+        self.config = models[0].config
+        if any(model.config != self.config for model in models):
+            raise ValueError("Only aesthetic scorers with the same config can be fused.")
+
+        linears = [
+            [layer for layer in model.layers if isinstance(layer, nn.Linear)]
+            for model in models
+        ]
+        weights = [
+            torch.stack([layers[i].weight.detach() for layers in linears])
+            for i in range(len(linears[0]))
+        ]
+        biases = [
+            torch.stack([layers[i].bias.detach() for layers in linears]).unsqueeze(1)
+            for i in range(len(linears[0]))
+        ]
+
+        if not self.config["use_activation"]:
+            # W_n(...(W_1 x + b_1)...) + b_n is a single affine map
+            weight = weights[0].double()
+            bias = biases[0].double()
+            for w, b in zip(weights[1:], biases[1:]):
+                weight = torch.bmm(w.double(), weight)
+                bias = torch.baddbmm(b.double(), bias, w.double().transpose(1, 2))
+            weights = [weight.float()]
+            biases = [bias.float()]
+
+        self.weights = nn.ParameterList(
+            [nn.Parameter(w.transpose(1, 2).contiguous(), requires_grad=False) for w in weights]
+        )
+        self.biases = nn.ParameterList(
+            [nn.Parameter(b, requires_grad=False) for b in biases]
+        )
+
+    def forward(self, x):
+        # [N, input_size] -> [heads, N, input_size]
+        x = x.unsqueeze(0).expand(len(self.weights[0]), -1, -1)
+        for i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            x = torch.baddbmm(bias, x, weight)
+            if self.config["use_activation"] and i < len(self.weights) - 1:
+                x = torch.relu(x)
+        # [heads, N, 1] -> [N, heads]
+        x = x.squeeze(-1).transpose(0, 1)
+        if self.config["output_activation"] == "sigmoid":
+            upper, lower = 10, 1
+            return (torch.sigmoid(x) * (upper - lower)) + lower
+        return x
+
+
 def preprocess(embeddings):
     return embeddings / embeddings.norm(p=2, dim=-1, keepdim=True)
 
@@ -101,12 +160,15 @@ def download_weights(url, cache_dir):
     if not os.path.exists(file_path):
         # Ensure the cache directory exists
         os.makedirs(cache_dir, exist_ok=True)
-        # Download the file
-        response = requests.get(url, stream=True)
+        # Download the file next to its final path, so an interrupted download
+        # is never mistaken for a cached one
+        response = requests.get(url, stream=True, timeout=60)
         response.raise_for_status()  # Check for request errors
-        with open(file_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
+        tmp_path = f"{file_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
                 f.write(chunk)
+        os.replace(tmp_path, file_path)
     return file_path
 
 
@@ -118,6 +180,14 @@ def load_model(
 ):
     file_path = download_weights(weight_url, cache_dir)
     model = AestheticScorer(config=config)
-    model.load_state_dict(torch.load(file_path, map_location=device))
+    try:
+        # Maps the weights instead of reading them into memory first
+        state_dict = torch.load(
+            file_path, map_location=device, mmap=True, weights_only=True
+        )
+    except RuntimeError:
+        # Files in the legacy (non-zip) format can't be mapped
+        state_dict = torch.load(file_path, map_location=device, weights_only=True)
+    model.load_state_dict(state_dict)
     model.eval()
     return model
@@ -0,0 +1,201 @@
+"""
+Inference backends the models are served from:
+
+- eager: the PyTorch modules as they are, the fallback of the other two
+- torchscript: traced and frozen once, saved under `MODEL_BACKEND_CACHE_DIR`
+- onnx: exported once to the same directory and run with ONNX Runtime, which
+  needs the optional `onnx` and `onnxruntime` packages, fp32 models only
+
+An exported graph is checked against the eager module on inputs of a different
+shape than the ones it was exported with before it's used. If the export, the
+load or the check fails, the model is served eagerly.
+"""
+
+import hashlib
+import logging
+import os
+from typing import Callable, Dict, List, Tuple
+
+import torch
+from torch import nn
+
+from models.constants import DEVICE, MODEL_BACKEND_CACHE_DIR
+from models.precision import PRECISION_FP32, autocast
+
+BACKEND_EAGER = "eager"
+BACKEND_TORCHSCRIPT = "torchscript"
+BACKEND_ONNX = "onnx"
+BACKENDS = [BACKEND_EAGER, BACKEND_TORCHSCRIPT, BACKEND_ONNX]
+
+# Every output row of an exported graph should be this close to the eager one
+PARITY_MIN_COSINE = 0.999
+
+
+def validate_backend(backend: str) -> str:
+    if backend not in BACKENDS:
+        raise ValueError(f"Invalid backend: {backend}, should be one of {BACKENDS}")
+    return backend
+
+
+class GraphSpec:
+    """
+    A module with tensor-only inputs and outputs, and what it takes to export it.
+    `cache_key` identifies the weights, exports are reused while it's unchanged.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        module: nn.Module,
+        example_inputs: Tuple[torch.Tensor, ...],
+        check_inputs: Tuple[torch.Tensor, ...],
+        input_names: List[str],
+        output_names: List[str],
+        dynamic_axes: Dict[str, Dict[int, str]],
+        cache_key: str,
+    ):
+        self.name = name
+        self.module = module
+        self.example_inputs = example_inputs
+        self.check_inputs = check_inputs
+        self.input_names = input_names
+        self.output_names = output_names
+        self.dynamic_axes = dynamic_axes
+        self.cache_key = cache_key
+
+
+def _as_tuple(outputs) -> Tuple[torch.Tensor, ...]:
+    return outputs if isinstance(outputs, tuple) else (outputs,)
+
+
+def _export_path(spec: GraphSpec, backend: str, precision: str) -> str:
+    key = "|".join([spec.cache_key, precision, torch.__version__])
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    extension = "pt" if backend == BACKEND_TORCHSCRIPT else "onnx"
+    return os.path.join(MODEL_BACKEND_CACHE_DIR, f"{spec.name}-{digest}.{extension}")
+
+
+def eager_forward(spec: GraphSpec, precision: str = PRECISION_FP32) -> Callable:
+    def forward(*inputs: torch.Tensor):
+        with torch.no_grad(), autocast(precision):
+            return spec.module(*inputs)
+
+    return forward
+
+
+def _torchscript(spec: GraphSpec, path: str) -> Callable:
+    if not os.path.exists(path):
+        with torch.no_grad():
+            traced = torch.jit.trace(
+                spec.module, spec.example_inputs, check_trace=False
+            )
+            frozen = torch.jit.freeze(traced)
+        tmp_path = f"{path}.tmp"
+        torch.jit.save(frozen, tmp_path)
+        os.replace(tmp_path, path)
+        logging.info(f"✅ Exported {spec.name} to TorchScript: {path}")
+    graph = torch.jit.load(path, map_location=DEVICE)
+
+    def forward(*inputs: torch.Tensor):
+        with torch.no_grad():
+            return graph(*inputs)
+
+    return forward
+
+
+def _onnx(spec: GraphSpec, path: str) -> Callable:
+    import onnxruntime
+
+    if not os.path.exists(path):
+        tmp_path = f"{path}.tmp"
+        with torch.no_grad():
+            torch.onnx.export(
+                spec.module,
+                spec.example_inputs,
+                tmp_path,
+                input_names=spec.input_names,
+                output_names=spec.output_names,
+                dynamic_axes=spec.dynamic_axes,
+                dynamo=False,
+            )
+        os.replace(tmp_path, path)
+        logging.info(f"✅ Exported {spec.name} to ONNX: {path}")
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = (
+        onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    )
+    session = onnxruntime.InferenceSession(
+        path, sess_options=options, providers=["CPUExecutionProvider"]
+    )
+
+    def forward(*inputs: torch.Tensor):
+        feed = {
+            name: tensor.cpu().numpy()
+            for name, tensor in zip(spec.input_names, inputs)
+        }
+        outputs = tuple(torch.from_numpy(o) for o in session.run(None, feed))
+        return outputs if len(outputs) > 1 else outputs[0]
+
+    return forward
+
+
+def exported_forward(
+    spec: GraphSpec, backend: str, precision: str = PRECISION_FP32
+) -> Callable:
+    """Exports `spec.module` to `backend` unless it's cached already, and loads it."""
+    os.makedirs(MODEL_BACKEND_CACHE_DIR, exist_ok=True)
+    path = _export_path(spec, backend, precision)
+    if backend == BACKEND_TORCHSCRIPT:
+        return _torchscript(spec, path)
+    if backend == BACKEND_ONNX:
+        if precision != PRECISION_FP32:
+            raise ValueError(f"ONNX exports only support {PRECISION_FP32}")
+        return _onnx(spec, path)
+    raise ValueError(f"{backend} isn't an export backend")
+
+
+def check_parity(
+    forward: Callable, reference: Callable, inputs: Tuple[torch.Tensor, ...]
+) -> float:
+    """Lowest cosine similarity between the rows of the two callables' outputs."""
+    lowest = 1.0
+    for output, expected in zip(
+        _as_tuple(forward(*inputs)), _as_tuple(reference(*inputs))
+    ):
+        output = output.double().flatten(1)
+        expected = expected.to(output.device).double().flatten(1)
+        cosine = torch.nn.functional.cosine_similarity(output, expected, eps=1e-12)
+        lowest = min(lowest, cosine.min().item())
+    return lowest
+
+
+def load_backend(
+    spec: GraphSpec, backend: str, precision: str = PRECISION_FP32
+) -> Callable:
+    """
+    Returns the forward function of `spec.module` served from `backend`. The
+    module should already be converted to `precision`.
+    """
+    validate_backend(backend)
+    eager = eager_forward(spec, precision)
+    if backend == BACKEND_EAGER:
+        return eager
+
+    try:
+        forward = exported_forward(spec, backend, precision)
+        cosine = check_parity(forward, eager, spec.check_inputs)
+    except Exception as e:
+        # Export errors can carry a whole graph dump, the first line says enough
+        error = str(e).strip().splitlines()[0] if str(e).strip() else repr(e)
+        logging.warning(
+            f"🟠 Couldn't serve {spec.name} from {backend}, falling back to eager: {error}"
+        )
+        return eager
+    if cosine < PARITY_MIN_COSINE:
+        logging.warning(
+            f"🟠 {spec.name} on {backend} drifted from eager (cosine {cosine:.5f}), "
+            "falling back to eager"
+        )
+        return eager
+    logging.info(f"✅ Serving {spec.name} from {backend}")
+    return forward
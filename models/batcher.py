@@ -0,0 +1,209 @@
+import logging
+import os
+import queue
+import time
+import weakref
+from concurrent.futures import TimeoutError
+from threading import Event, Thread
+from typing import Any, Callable, List, Sequence, Tuple
+
+import torch
+
+from utils.metrics import BATCH_SIZE
+
+
+def batch_size_buckets(max_batch_size: int) -> List[int]:
+    """Powers of two below `max_batch_size`, and `max_batch_size` itself."""
+    buckets = []
+    size = 1
+    while size < max_batch_size:
+        buckets.append(size)
+        size *= 2
+    return buckets + [max_batch_size]
+
+
+def run_batched(
+    forward: Callable[..., torch.Tensor | Tuple[torch.Tensor, ...]],
+    inputs: Tuple[torch.Tensor, ...],
+    max_batch_size: int,
+    pad: bool,
+) -> Tuple[torch.Tensor, ...]:
+    """
+    Runs `forward` on the rows of `inputs` in batches of `max_batch_size` rows
+    at most, so its peak memory doesn't grow with the number of rows. With `pad`
+    the last batch is padded up to the smallest of `batch_size_buckets` it fits
+    in, by repeating its last row. Returns the output rows of the actual inputs.
+    """
+    buckets = batch_size_buckets(max_batch_size)
+    rows = len(inputs[0])
+    chunks = []
+    for start in range(0, rows, max_batch_size):
+        chunk = tuple(tensor[start : start + max_batch_size] for tensor in inputs)
+        size = len(chunk[0])
+        padded_size = next(bucket for bucket in buckets if bucket >= size)
+        if pad and padded_size > size:
+            chunk = tuple(
+                torch.cat(
+                    [tensor, tensor[-1:].expand(padded_size - size, *tensor.shape[1:])]
+                )
+                for tensor in chunk
+            )
+        outputs = forward(*chunk)
+        outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+        chunks.append(tuple(output[:size] for output in outputs))
+        del chunk, outputs
+    if len(chunks) == 1:
+        return chunks[0]
+    return tuple(torch.cat(outputs) for outputs in zip(*chunks))
+
+
+class _BatchJob:
+    def __init__(self, items: Sequence[Any]):
+        self.items: Sequence[Any] | None = items
+        self.done = Event()
+        self.outputs: Tuple[torch.Tensor, ...] | None = None
+        self.error: BaseException | None = None
+
+
+class BatchResult:
+    def __init__(self, jobs: List[_BatchJob]):
+        self._jobs = jobs
+
+    def result(self, timeout: float | None = None) -> Tuple[torch.Tensor, ...]:
+        """Raises `TimeoutError` if the rows aren't ready within `timeout` seconds."""
+        jobs = self._jobs
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for job in jobs:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            if not job.done.wait(remaining):
+                raise TimeoutError("Batch didn't finish in time.")
+            if job.error is not None:
+                raise job.error
+        if len(jobs) == 1:
+            return jobs[0].outputs
+        return tuple(
+            torch.cat([job.outputs[i] for job in jobs])
+            for i in range(len(jobs[0].outputs))
+        )
+
+
+class MicroBatcher:
+    """
+    Collects items submitted by concurrent callers into a single batch and runs
+    `process_batch` once for all of them on a dedicated worker thread.
+
+    `process_batch` receives a list of items and must return a tensor (or a tuple
+    of tensors) whose first dimension matches the number of items. Every caller
+    gets back its own rows, in the order it submitted them.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        process_batch: Callable[[List[Any]], torch.Tensor | Tuple[torch.Tensor, ...]],
+        max_batch_size: int,
+        max_wait_ms: float,
+    ):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size should be at least 1.")
+        self.name = name
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._start()
+        _batchers.add(self)
+
+    def _start(self):
+        self._queue: "queue.Queue[_BatchJob]" = queue.Queue()
+        self._thread = Thread(
+            target=self._run, name=f"{self.name}-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, items: Sequence[Any]) -> Tuple[torch.Tensor, ...]:
+        """Blocks until all `items` are processed and returns their output rows."""
+        return self.submit_async(items).result()
+
+    def submit_async(self, items: Sequence[Any]) -> BatchResult:
+        """Queues `items` without waiting, the rows are read with `.result()`."""
+        if len(items) < 1:
+            raise ValueError("Can't submit an empty list of items.")
+        jobs = [
+            _BatchJob(items[i : i + self.max_batch_size])
+            for i in range(0, len(items), self.max_batch_size)
+        ]
+        for job in jobs:
+            self._queue.put(job)
+        return BatchResult(jobs)
+
+    def _collect(self, first: _BatchJob) -> Tuple[List[_BatchJob], _BatchJob | None]:
+        jobs = [first]
+        size = len(first.items)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if size + len(job.items) > self.max_batch_size:
+                # Doesn't fit, it starts the next batch instead
+                return jobs, job
+            jobs.append(job)
+            size += len(job.items)
+        return jobs, None
+
+    def _process(self, jobs: List[_BatchJob]):
+        items = [item for job in jobs for item in job.items]
+        outputs = self.process_batch(items)
+        if isinstance(outputs, torch.Tensor):
+            outputs = (outputs,)
+        start = 0
+        for job in jobs:
+            end = start + len(job.items)
+            job.outputs = tuple(output[start:end] for output in outputs)
+            start = end
+
+    def _run(self):
+        carry_over: _BatchJob | None = None
+        while True:
+            first = carry_over if carry_over is not None else self._queue.get()
+            jobs, carry_over = self._collect(first)
+            size = sum(len(job.items) for job in jobs)
+            BATCH_SIZE.labels(self.name).observe(size)
+            try:
+                self._process(jobs)
+            except BaseException as e:
+                logging.error(f"🔴 {self.name} batch of {size} item(s) failed: {e}")
+                if len(jobs) == 1:
+                    jobs[0].error = e
+                else:
+                    # One caller's bad input mustn't fail the others pooled
+                    # with it, every job is retried on its own
+                    for job in jobs:
+                        try:
+                            self._process([job])
+                        except BaseException as e:
+                            job.error = e
+            finally:
+                for job in jobs:
+                    # The inputs aren't needed anymore, callers may hold the
+                    # job until their whole request is done
+                    job.items = None
+                    job.done.set()
+
+_batchers: "weakref.WeakSet[MicroBatcher]" = weakref.WeakSet()
+
+
+def _restart_batchers():
+    # Only the forking thread survives a fork, worker processes need their own
+    # batcher threads, see servers/workers.py
+    for batcher in list(_batchers):
+        batcher._start()
+
+
+os.register_at_fork(after_in_child=_restart_batchers)
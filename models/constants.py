@@ -1,6 +1,8 @@
 from dotenv import load_dotenv
 import os
 
+from models.loading import ModelSlot
+
 load_dotenv()
 
 DEVICE_CPU = "cpu"
@@ -10,35 +12,149 @@ SC_CLIP_VERSION = "v1.1"
 _DEVICE = os.getenv("DEVICE", DEVICE_CPU)
 DEVICE = _DEVICE if _DEVICE in [DEVICE_CPU, DEVICE_CUDA] else DEVICE_CPU
 
+MODEL_OPEN_CLIP = "open_clip"
+MODEL_AESTHETICS_SCORER = "aesthetics_scorer"
+MODEL_NSFW_SCORER = "nsfw_scorer"
+MODEL_NAMES = [MODEL_OPEN_CLIP, MODEL_AESTHETICS_SCORER, MODEL_NSFW_SCORER]
+
+
+def _model_names(value: str):
+    names = [name.strip() for name in value.split(",") if name.strip() != ""]
+    for name in names:
+        if name not in MODEL_NAMES:
+            raise ValueError(f"Invalid model: {name}, should be one of {MODEL_NAMES}")
+    return names
+
+
+# Models this replica serves, comma separated, and the ones among them that are
+# only loaded once a request needs them instead of at startup
+MODELS_ENABLED = _model_names(os.getenv("MODELS_ENABLED", ",".join(MODEL_NAMES)))
+MODELS_LAZY = _model_names(os.getenv("MODELS_LAZY", ""))
+
+# Backend the models are served from, see models/backends.py, and where the
+# exported graphs are cached
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "eager")
+MODEL_BACKEND_CACHE_DIR = os.getenv(
+    "MODEL_BACKEND_CACHE_DIR", "/app/data/compiled-models"
+)
+
+# Inference batches are padded up to the next power of two, capped at each
+# model's max batch size, so the models only ever see a few shapes
+MODEL_BATCH_PADDING = os.getenv("MODEL_BATCH_PADDING", "true").lower() == "true"
+# Every padded shape is run through each model this many times before the model
+# is reported ready, 0 disables the warmup. TorchScript graphs are only
+# optimized on their second run
+MODEL_WARMUP_RUNS = int(os.getenv("MODEL_WARMUP_RUNS", 1))
+
+# Decode images straight to the smallest resolution the models need
+IMAGE_DECODE_REDUCED = os.getenv("IMAGE_DECODE_REDUCED", "true").lower() == "true"
+
+# Persistent store of image embeddings and scores, set the capacity to 0 to disable it
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "/app/data/image-store")
+IMAGE_STORE_CAPACITY = int(os.getenv("IMAGE_STORE_CAPACITY", 100_000))
+
+# Index of embeddings searched by /search, see utils/vector_index.py. Disabled
+# unless it's given a capacity, ids are stored in up to VECTOR_INDEX_ID_MAX_BYTES
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "/app/data/vector-index")
+VECTOR_INDEX_CAPACITY = int(os.getenv("VECTOR_INDEX_CAPACITY", 0))
+VECTOR_INDEX_DTYPE = os.getenv("VECTOR_INDEX_DTYPE", "float16")
+VECTOR_INDEX_ID_MAX_BYTES = int(os.getenv("VECTOR_INDEX_ID_MAX_BYTES", 64))
+# Rows multiplied with the queries at a time
+VECTOR_INDEX_BLOCK_ROWS = int(os.getenv("VECTOR_INDEX_BLOCK_ROWS", 4096))
+# IVF lists the vectors are partitioned in, 0 always scans all of them, and the
+# lists closest to a query that are scanned
+VECTOR_INDEX_IVF_LISTS = int(os.getenv("VECTOR_INDEX_IVF_LISTS", 0))
+VECTOR_INDEX_IVF_PROBES = int(os.getenv("VECTOR_INDEX_IVF_PROBES", 8))
+
+# Projections /embed applies with `projection=<name>`, see utils/projections.py,
+# none when it's not set
+EMBEDDING_PROJECTIONS_DIR = os.getenv("EMBEDDING_PROJECTIONS_DIR", "")
+
 
 class OpenCLIP:
-    def __init__(self, model, processor, tokenizer):
+    def __init__(
+        self,
+        model,
+        processor,
+        tokenizer,
+        vision_batcher=None,
+        text_batcher=None,
+        text_cache=None,
+        precision="fp32",
+        label_cache=None,
+    ):
         self.model = model
         self.processor = processor
         self.tokenizer = tokenizer
+        self.vision_batcher = vision_batcher
+        self.text_batcher = text_batcher
+        self.text_cache = text_cache
+        self.precision = precision
+        self.label_cache = label_cache
 
 
 class AestheticsScorer:
-    def __init__(self, rating_model, artifacts_model):
+    def __init__(self, rating_model, artifacts_model, fused_model=None, forward=None):
         self.rating_model = rating_model
         self.artifacts_model = artifacts_model
+        self.fused_model = fused_model
+        # The fused model served from the configured backend
+        self.forward = forward
 
 
 class NSFWScorer:
-    def __init__(self, pipeline):
-        self.pipeline = pipeline
+    def __init__(self, model, processor, transform, precision="fp32", forward=None):
+        self.model = model
+        self.processor = processor
+        self.transform = transform
+        self.precision = precision
+        # Pixel values to logits, served from the configured backend
+        self.forward = forward
 
 
 class ModelsPack:
+    """
+    The models of the replica, each in its own `ModelSlot` so they load on their
+    own and routes only wait for the ones they use. Models passed in directly
+    instead of slots are ready right away. Reading a model that isn't ready
+    raises `ModelUnavailable`.
+    """
+
     def __init__(
         self,
-        open_clip: OpenCLIP,
-        aesthetics_scorer: AestheticsScorer,
-        nsfw_scorer: NSFWScorer,
+        open_clip: OpenCLIP | ModelSlot,
+        aesthetics_scorer: AestheticsScorer | ModelSlot,
+        nsfw_scorer: NSFWScorer | ModelSlot,
+        image_store=None,
+        vector_index=None,
+        projections=None,
     ):
-        self.open_clip = open_clip
-        self.aesthetics_scorer = aesthetics_scorer
-        self.nsfw_scorer = nsfw_scorer
+        self.slots = {
+            name: value if isinstance(value, ModelSlot) else ModelSlot.ready(name, value)
+            for name, value in [
+                (MODEL_OPEN_CLIP, open_clip),
+                (MODEL_AESTHETICS_SCORER, aesthetics_scorer),
+                (MODEL_NSFW_SCORER, nsfw_scorer),
+            ]
+        }
+        self.image_store = image_store
+        self.vector_index = vector_index
+        self.projections = projections if projections is not None else {}
+
+    @property
+    def open_clip(self) -> OpenCLIP:
+        return self.slots[MODEL_OPEN_CLIP].get()
+
+    @property
+    def aesthetics_scorer(self) -> AestheticsScorer:
+        return self.slots[MODEL_AESTHETICS_SCORER].get()
+
+    @property
+    def nsfw_scorer(self) -> NSFWScorer:
+        return self.slots[MODEL_NSFW_SCORER].get()
+
+    def status(self) -> dict:
+        return {name: slot.status() for name, slot in self.slots.items()}
 
 
 class AestheticScoreResult:
@@ -0,0 +1,103 @@
+import logging
+import time
+import traceback
+from threading import Event, Lock, Thread
+from typing import Any, Callable
+
+MODEL_DISABLED = "disabled"
+MODEL_LAZY = "lazy"
+MODEL_LOADING = "loading"
+MODEL_READY = "ready"
+MODEL_FAILED = "failed"
+
+
+class ModelUnavailable(Exception):
+    def __init__(self, name: str, state: str):
+        super().__init__(f"{name} is {state}")
+        self.name = name
+        self.state = state
+
+
+class ModelSlot:
+    """
+    Holds a model that is loaded on its own thread, either right away with
+    `start()` or, for lazy slots, on the first `start()` a request triggers.
+    A slot without a `load` function is disabled on this replica.
+    """
+
+    def __init__(self, name: str, load: Callable[[], Any] | None, lazy: bool = False):
+        self.name = name
+        self.lazy = lazy
+        self._load = load
+        self._lock = Lock()
+        self._done = Event()
+        self._value = None
+        self._started = False
+        self._error: str | None = None
+        self._load_sec: float | None = None
+
+    @classmethod
+    def ready(cls, name: str, value: Any) -> "ModelSlot":
+        slot = cls(name, lambda: value)
+        slot._value = value
+        slot._started = True
+        slot._done.set()
+        return slot
+
+    @property
+    def state(self) -> str:
+        if self._load is None:
+            return MODEL_DISABLED
+        if self._done.is_set():
+            return MODEL_FAILED if self._error is not None else MODEL_READY
+        return MODEL_LOADING if self._started else MODEL_LAZY
+
+    def start(self):
+        """Starts loading the model unless it's disabled or already started."""
+        with self._lock:
+            if self._load is None or self._started:
+                return
+            self._started = True
+        Thread(target=self._run, name=f"load-{self.name}", daemon=True).start()
+
+    def _run(self):
+        start = time.time()
+        try:
+            self._value = self._load()
+        except Exception:
+            self._error = traceback.format_exc()
+            logging.error(f"🔴 Failed to load {self.name}: {self._error}")
+        finally:
+            self._load_sec = time.time() - start
+            self._done.set()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Starts a lazy model, returns whether it's ready within `timeout` seconds."""
+        self.start()
+        if self._load is None:
+            return False
+        self._done.wait(timeout)
+        return self.state == MODEL_READY
+
+    def get(self) -> Any:
+        """Returns the model, raises `ModelUnavailable` if it isn't ready."""
+        if self.state != MODEL_READY:
+            self.start()
+            raise ModelUnavailable(self.name, self.state)
+        return self._value
+
+    def peek(self) -> Any | None:
+        """The model if it's ready, without starting a lazy one."""
+        return self._value if self.state == MODEL_READY else None
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "lazy": self.lazy,
+            "load_sec": self._load_sec,
+            "error": (
+                self._error.strip().splitlines()[-1]
+                if self._error is not None
+                else None
+            ),
+        }
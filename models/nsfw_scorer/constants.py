@@ -1 +1,11 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
 NSFW_SCORER_MODEL_ID = "Falconsai/nsfw_image_detection"
+# Inference precision of the classifier, see models/precision.py
+NSFW_SCORER_PRECISION = os.getenv("NSFW_SCORER_PRECISION", "fp32")
+# Images the classifier runs at once, bigger requests are split in batches this big
+NSFW_SCORER_BATCH_SIZE_MAX = int(os.getenv("NSFW_SCORER_BATCH_SIZE_MAX", 32))
@@ -1,20 +1,113 @@
+import logging
+import time
 from typing import List
 from PIL import Image
+import torch
+from torch import nn
+from torchvision.transforms import Compose, Normalize, ToTensor
 
-from models.constants import NSFWScoreResult, NSFWScorer
+from models.backends import GraphSpec
+from models.batcher import batch_size_buckets, run_batched
+from models.constants import (
+    DEVICE,
+    MODEL_BATCH_PADDING,
+    NSFWScoreResult,
+    NSFWScorer,
+)
+from models.nsfw_scorer.constants import (
+    NSFW_SCORER_BATCH_SIZE_MAX,
+    NSFW_SCORER_MODEL_ID,
+)
+from models.precision import PRECISION_FP32, autocast, input_dtype_of
+from utils.metrics import BATCH_SIZE, STAGE_NSFW, stage_timer
+
+
+def create_nsfw_transform(processor):
+    """Same resizing and normalization as the model's image processor, on PIL images."""
+    size = (processor.size["width"], processor.size["height"])
+
+    def resize(img: Image.Image):
+        return img.resize(size, resample=processor.resample)
+
+    return Compose(
+        [
+            resize,
+            ToTensor(),
+            Normalize(processor.image_mean, processor.image_std),
+        ]
+    )
+
+
+class LogitsGraph(nn.Module):
+    """Pixel values to classifier logits, always in fp32."""
+
+    def __init__(self, model, precision: str):
+        super().__init__()
+        self.model = model
+        self.input_dtype = input_dtype_of(precision)
+
+    def forward(self, pixel_values: torch.Tensor):
+        return self.model(pixel_values=pixel_values.to(self.input_dtype)).logits.float()
+
+
+def nsfw_graph_spec(model, processor, precision: str = PRECISION_FP32) -> GraphSpec:
+    size = processor.size
+
+    def pixel_values(n: int):
+        return torch.randn(n, 3, size["height"], size["width"], device=DEVICE)
+
+    return GraphSpec(
+        name="nsfw-scorer",
+        module=LogitsGraph(model, precision).eval(),
+        example_inputs=(pixel_values(2),),
+        check_inputs=(pixel_values(3),),
+        input_names=["pixel_values"],
+        output_names=["logits"],
+        dynamic_axes={"pixel_values": {0: "batch"}},
+        cache_key=NSFW_SCORER_MODEL_ID,
+    )
 
 
 def generate_nsfw_score(
     images: List[Image.Image], nsfw_scorer: NSFWScorer
 ) -> List[NSFWScoreResult]:
-    pipeline = nsfw_scorer.pipeline
-    results = pipeline(images)
-    scores: List[NSFWScoreResult] = []
-    for result in results:
-        nsfw_score = next(
-            (item["score"] for item in result if item["label"] == "nsfw"), None
+    model = nsfw_scorer.model
+    nsfw_index = model.config.label2id.get("nsfw", None)
+    if nsfw_index is None:
+        raise ValueError("NSFW label not found in the result.")
+
+    forward = nsfw_scorer.forward
+    if forward is None:
+
+        def forward(pixel_values: torch.Tensor):
+            with torch.no_grad(), autocast(nsfw_scorer.precision):
+                return model(pixel_values=pixel_values).logits.float()
+
+    BATCH_SIZE.labels("NSFW Scorer").observe(len(images))
+    with stage_timer(STAGE_NSFW):
+        pixel_values = torch.stack([nsfw_scorer.transform(img) for img in images])
+        (logits,) = run_batched(
+            forward,
+            (pixel_values.to(DEVICE),),
+            NSFW_SCORER_BATCH_SIZE_MAX,
+            MODEL_BATCH_PADDING,
         )
-        if nsfw_score is None:
-            raise ValueError("NSFW label not found in the result.")
-        scores.append(NSFWScoreResult(nsfw_score=nsfw_score))
-    return scores
+        with torch.no_grad():
+            nsfw_scores = logits.softmax(dim=-1)[:, nsfw_index].cpu().tolist()
+    return [NSFWScoreResult(nsfw_score=nsfw_score) for nsfw_score in nsfw_scores]
+
+
+def warmup_nsfw_scorer(nsfw_scorer: NSFWScorer, runs: int):
+    """Scores a batch of blank images of every padded shape."""
+    start = time.time()
+    sizes = batch_size_buckets(NSFW_SCORER_BATCH_SIZE_MAX)
+    if not MODEL_BATCH_PADDING:
+        sizes = [sizes[-1]]
+    processor_size = nsfw_scorer.processor.size
+    image = Image.new("RGB", (processor_size["width"], processor_size["height"]))
+    for _ in range(runs):
+        for size in sizes:
+            generate_nsfw_score([image] * size, nsfw_scorer)
+    logging.info(
+        f"✅ Warmed up NSFW Scorer in: {round((time.time() - start) * 1000)} ms"
+    )
@@ -1,3 +1,39 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
 OPEN_CLIP_MODEL_ID = "laion/CLIP-ViT-H-14-laion2B-s32B-b79K"
 OPEN_CLIP_TOKEN_LENGTH_MAX = 77
 OPEN_CLIP_MODEL_CACHE = "/app/data/open-clip-model-cache"
+
+# Inference precision of the vision and text towers, see models/precision.py
+OPEN_CLIP_PRECISION = os.getenv("OPEN_CLIP_PRECISION", "fp32")
+
+# Cross-request batching of the vision tower
+OPEN_CLIP_VISION_BATCH_SIZE_MAX = int(os.getenv("OPEN_CLIP_VISION_BATCH_SIZE_MAX", 32))
+OPEN_CLIP_VISION_BATCH_WAIT_MS = float(os.getenv("OPEN_CLIP_VISION_BATCH_WAIT_MS", 10))
+# Batches of the vision tower run in chunks of at most this many images, which
+# bounds the memory taken by its activations whatever the batch size
+OPEN_CLIP_VISION_INFERENCE_CHUNK_SIZE = min(
+    int(os.getenv("OPEN_CLIP_VISION_INFERENCE_CHUNK_SIZE", 16)),
+    OPEN_CLIP_VISION_BATCH_SIZE_MAX,
+)
+# Preprocessed images of a request are sent to the vision batcher in chunks this big
+OPEN_CLIP_VISION_STREAM_CHUNK_SIZE = int(
+    os.getenv("OPEN_CLIP_VISION_STREAM_CHUNK_SIZE", 8)
+)
+
+# Cross-request batching of the text tower, texts are padded per length bucket
+OPEN_CLIP_TEXT_BATCH_SIZE_MAX = int(os.getenv("OPEN_CLIP_TEXT_BATCH_SIZE_MAX", 64))
+OPEN_CLIP_TEXT_BATCH_WAIT_MS = float(os.getenv("OPEN_CLIP_TEXT_BATCH_WAIT_MS", 10))
+OPEN_CLIP_TEXT_LENGTH_BUCKETS = [16, 32, 48, OPEN_CLIP_TOKEN_LENGTH_MAX]
+
+# In-process LRU cache of text embeddings, keyed by the exact input text
+OPEN_CLIP_TEXT_CACHE_MAX_MB = float(os.getenv("OPEN_CLIP_TEXT_CACHE_MAX_MB", 256))
+OPEN_CLIP_TEXT_CACHE_DTYPE = os.getenv("OPEN_CLIP_TEXT_CACHE_DTYPE", "float32")
+
+# LRU cache of whole zero-shot label sets, each as the normalized matrix of its
+# label embeddings, keyed by the labels in order
+OPEN_CLIP_LABEL_CACHE_MAX_MB = float(os.getenv("OPEN_CLIP_LABEL_CACHE_MAX_MB", 64))
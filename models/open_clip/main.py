@@ -1,10 +1,27 @@
 from PIL import Image
 
-from models.constants import DEVICE
-from .constants import OPEN_CLIP_TOKEN_LENGTH_MAX
-from typing import List
+from models.backends import BACKEND_EAGER, GraphSpec, load_backend
+from models.batcher import MicroBatcher, batch_size_buckets, run_batched
+from models.constants import DEVICE, MODEL_BATCH_PADDING, OpenCLIP
+from models.precision import PRECISION_FP32, input_dtype_of
+from .constants import (
+    OPEN_CLIP_MODEL_ID,
+    OPEN_CLIP_TEXT_BATCH_SIZE_MAX,
+    OPEN_CLIP_TEXT_BATCH_WAIT_MS,
+    OPEN_CLIP_TEXT_LENGTH_BUCKETS,
+    OPEN_CLIP_TOKEN_LENGTH_MAX,
+    OPEN_CLIP_VISION_BATCH_SIZE_MAX,
+    OPEN_CLIP_VISION_BATCH_WAIT_MS,
+    OPEN_CLIP_VISION_INFERENCE_CHUNK_SIZE,
+)
+from typing import Dict, List
+import numpy as np
 import torch
+from torch import nn
 from utils.helpers import time_log
+from utils.metrics import STAGE_TEXT_FORWARD, STAGE_VISION_FORWARD, stage_timer
+import logging
+import time
 from torchvision.transforms import (
     Compose,
     Resize,
@@ -12,7 +29,6 @@ from torchvision.transforms import (
     ToTensor,
     Normalize,
 )
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 CLIP_IMAGE_SIZE = 224
@@ -40,47 +56,237 @@ def create_clip_transform(n_px):
 clip_transform = create_clip_transform(CLIP_IMAGE_SIZE)
 
 
-def clip_preprocessor(images: List[Image.Image]):
-    def process_image(img: Image.Image, index: int):
-        return clip_transform(img), index
+class VisionGraph(nn.Module):
+    """Pixel values to image embeddings and pooled outputs, always in fp32."""
 
-    images_with_index = [(img, i) for i, img in enumerate(images)]
+    def __init__(self, model, precision: str):
+        super().__init__()
+        self.model = model
+        self.input_dtype = input_dtype_of(precision)
 
-    with ThreadPoolExecutor() as executor:
-        futures = [
-            executor.submit(process_image, img_tuple[0], img_tuple[1])
-            for img_tuple in images_with_index
-        ]
-        results = [future.result() for future in as_completed(futures)]
+    def forward(self, pixel_values: torch.Tensor):
+        vision_output = self.model.vision_model(
+            pixel_values=pixel_values.to(self.input_dtype)
+        )
+        pooler_output = vision_output.pooler_output
+        image_embeddings = self.model.visual_projection(pooler_output)
+        return image_embeddings.float(), pooler_output.float()
 
-    results_sorted = sorted(results, key=lambda x: x[1])
-    results_sorted = [result[0] for result in results_sorted]
 
-    return torch.stack(results_sorted)
+class TextGraph(nn.Module):
+    """Token ids and attention masks to text embeddings, always in fp32."""
 
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
 
-def embeds_of_images(images: List[Image.Image], model):
-    with time_log(f"[] OpenCLIP: Embedded {len(images)} image(s)"):
-        with torch.no_grad():
-            inputs = clip_preprocessor(images=images)
-            inputs = inputs.to(DEVICE)
-            vision_output = model.vision_model(pixel_values=inputs)
-            image_embedding_tensors = model.visual_projection(vision_output[1])
-            image_embeddings = image_embedding_tensors.cpu().numpy().tolist()
-            return image_embeddings, vision_output
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor):
+        return self.model.get_text_features(
+            input_ids=input_ids, attention_mask=attention_mask
+        ).float()
 
 
-def embeds_of_texts(texts: str, model, tokenizer):
-    with time_log(f"[] OpenCLIP: Embedded {len(texts)} text(s)"):
-        with torch.no_grad():
-            inputs = tokenizer(
-                texts,
-                padding=True,
-                return_tensors="pt",
-                truncation=True,
-                max_length=OPEN_CLIP_TOKEN_LENGTH_MAX,
+def vision_graph_spec(model, precision: str = PRECISION_FP32) -> GraphSpec:
+    def pixel_values(n: int):
+        return torch.randn(n, 3, CLIP_IMAGE_SIZE, CLIP_IMAGE_SIZE, device=DEVICE)
+
+    return GraphSpec(
+        name="open-clip-vision",
+        module=VisionGraph(model, precision).eval(),
+        example_inputs=(pixel_values(2),),
+        check_inputs=(pixel_values(3),),
+        input_names=["pixel_values"],
+        output_names=["image_embeddings", "pooler_output"],
+        dynamic_axes={"pixel_values": {0: "batch"}},
+        cache_key=f"{OPEN_CLIP_MODEL_ID}/vision",
+    )
+
+
+def text_graph_spec(model, precision: str = PRECISION_FP32) -> GraphSpec:
+    vocab_size = model.config.text_config.vocab_size
+
+    def tokens(n: int, length: int):
+        input_ids = torch.randint(0, vocab_size, (n, length), device=DEVICE)
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[0, length // 2 :] = 0
+        return input_ids, attention_mask
+
+    return GraphSpec(
+        name="open-clip-text",
+        module=TextGraph(model).eval(),
+        example_inputs=tokens(2, 16),
+        check_inputs=tokens(3, 24),
+        input_names=["input_ids", "attention_mask"],
+        output_names=["text_embeddings"],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+        },
+        cache_key=f"{OPEN_CLIP_MODEL_ID}/text",
+    )
+
+
+def create_vision_batcher(
+    model, precision: str = PRECISION_FP32, backend: str = BACKEND_EAGER
+) -> MicroBatcher:
+    forward = load_backend(vision_graph_spec(model, precision), backend, precision)
+
+    def process_batch(pixel_values: List[torch.Tensor]):
+        # In chunks, the activations of a whole batch are never held at once
+        with stage_timer(STAGE_VISION_FORWARD):
+            image_embeddings, pooler_output = run_batched(
+                forward,
+                (torch.stack(pixel_values).to(DEVICE),),
+                OPEN_CLIP_VISION_INFERENCE_CHUNK_SIZE,
+                MODEL_BATCH_PADDING,
             )
-            inputs = inputs.to(DEVICE)
-            text_embeddings = model.get_text_features(**inputs)
-            text_embeddings = text_embeddings.cpu().numpy().tolist()
-            return text_embeddings
+        return image_embeddings.cpu(), pooler_output
+
+    return MicroBatcher(
+        name="OpenCLIP vision",
+        process_batch=process_batch,
+        max_batch_size=OPEN_CLIP_VISION_BATCH_SIZE_MAX,
+        max_wait_ms=OPEN_CLIP_VISION_BATCH_WAIT_MS,
+    )
+
+
+def bucket_by_length(lengths: List[int], buckets: List[int]) -> List[List[int]]:
+    """Groups indexes of `lengths` by the smallest bucket each length fits in."""
+    groups: List[List[int]] = [[] for _ in buckets]
+    for index, length in enumerate(lengths):
+        bucket = next((i for i, b in enumerate(buckets) if length <= b), -1)
+        groups[bucket].append(index)
+    return [group for group in groups if len(group) > 0]
+
+
+def create_text_batcher(
+    model, tokenizer, precision: str = PRECISION_FP32, backend: str = BACKEND_EAGER
+) -> MicroBatcher:
+    forward = load_backend(text_graph_spec(model, precision), backend, precision)
+
+    def process_batch(texts: List[str]):
+        tokens = tokenizer(
+            texts,
+            truncation=True,
+            max_length=OPEN_CLIP_TOKEN_LENGTH_MAX,
+        )["input_ids"]
+        text_embeddings = None
+        # One padded forward pass per length bucket, so short prompts
+        # aren't padded to the length of the longest one in the batch
+        for indexes in bucket_by_length(
+            [len(t) for t in tokens], OPEN_CLIP_TEXT_LENGTH_BUCKETS
+        ):
+            length = max(len(tokens[i]) for i in indexes)
+            if MODEL_BATCH_PADDING:
+                # Up to the bucket's length, so there's one shape per bucket
+                length = next(b for b in OPEN_CLIP_TEXT_LENGTH_BUCKETS if b >= length)
+            input_ids = torch.full(
+                (len(indexes), length), tokenizer.pad_token_id, dtype=torch.long
+            )
+            attention_mask = torch.zeros((len(indexes), length), dtype=torch.long)
+            for row, i in enumerate(indexes):
+                input_ids[row, : len(tokens[i])] = torch.tensor(tokens[i])
+                attention_mask[row, : len(tokens[i])] = 1
+            with stage_timer(STAGE_TEXT_FORWARD):
+                (bucket_embeddings,) = run_batched(
+                    forward,
+                    (input_ids.to(DEVICE), attention_mask.to(DEVICE)),
+                    OPEN_CLIP_TEXT_BATCH_SIZE_MAX,
+                    MODEL_BATCH_PADDING,
+                )
+            bucket_embeddings = bucket_embeddings.cpu()
+            if text_embeddings is None:
+                text_embeddings = bucket_embeddings.new_empty(
+                    (len(texts), bucket_embeddings.shape[1])
+                )
+            text_embeddings[indexes] = bucket_embeddings
+        return text_embeddings
+
+    return MicroBatcher(
+        name="OpenCLIP text",
+        process_batch=process_batch,
+        max_batch_size=OPEN_CLIP_TEXT_BATCH_SIZE_MAX,
+        max_wait_ms=OPEN_CLIP_TEXT_BATCH_WAIT_MS,
+    )
+
+
+def embeds_of_texts(texts: List[str], clip: OpenCLIP):
+    with time_log(f"[] OpenCLIP: Embedded {len(texts)} text(s)"):
+        text_embeddings: List[np.ndarray | None] = [None for _ in texts]
+        missing: Dict[str, List[int]] = {}
+        for i, text in enumerate(texts):
+            if clip.text_cache is not None:
+                text_embeddings[i] = clip.text_cache.get(text)
+            if text_embeddings[i] is None:
+                missing.setdefault(text, []).append(i)
+
+        # Only the texts that aren't cached go through the tokenizer and the model
+        if len(missing) > 0:
+            missing_texts = list(missing.keys())
+            (computed,) = clip.text_batcher.submit(missing_texts)
+            for text, embedding in zip(missing_texts, computed.numpy()):
+                if clip.text_cache is not None:
+                    clip.text_cache.put(text, embedding)
+                for i in missing[text]:
+                    text_embeddings[i] = embedding
+
+        return np.stack(text_embeddings).astype(np.float32, copy=False)
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def embeds_of_labels(labels: List[str], clip: OpenCLIP) -> np.ndarray:
+    """
+    Normalized embeddings of a zero-shot label set. Sets that come back are read
+    from the label cache whole, without a text cache lookup per label.
+    """
+    key = tuple(labels)
+    if clip.label_cache is not None:
+        cached = clip.label_cache.get(key)
+        if cached is not None:
+            return cached
+    label_embeddings = normalize(embeds_of_texts(labels, clip))
+    if clip.label_cache is not None:
+        clip.label_cache.put(key, label_embeddings)
+    return label_embeddings
+
+
+def zero_shot_logits(
+    image_embeddings: np.ndarray, labels: List[str], clip: OpenCLIP
+) -> np.ndarray:
+    """
+    Image × label logits, the cosine similarities scaled by the model's learned
+    `logit_scale`, the same as CLIP's `logits_per_image`.
+    """
+    label_embeddings = embeds_of_labels(labels, clip)
+    logit_scale = clip.model.logit_scale.detach().float().exp().item()
+    return logit_scale * normalize(image_embeddings) @ label_embeddings.T
+
+
+def warmup_open_clip(clip: OpenCLIP, runs: int):
+    """
+    Runs a batch of every padded shape through both towers, from the batchers so
+    the tokenizer and the preprocessing are warmed up too.
+    """
+    start = time.time()
+    vision_sizes = batch_size_buckets(OPEN_CLIP_VISION_INFERENCE_CHUNK_SIZE)
+    text_sizes = batch_size_buckets(OPEN_CLIP_TEXT_BATCH_SIZE_MAX)
+    if not MODEL_BATCH_PADDING:
+        vision_sizes = [vision_sizes[-1]]
+        text_sizes = [text_sizes[-1]]
+    image = Image.new("RGB", (CLIP_IMAGE_SIZE, CLIP_IMAGE_SIZE))
+    pixel_values = clip_transform(image)
+    for _ in range(runs):
+        for size in vision_sizes:
+            clip.vision_batcher.submit([pixel_values] * size)
+        for length in OPEN_CLIP_TEXT_LENGTH_BUCKETS:
+            # A word per token, between the start and end tokens
+            text = " ".join(["photo"] * (length - 2))
+            for size in text_sizes:
+                clip.text_batcher.submit([text] * size)
+    logging.info(
+        f"✅ Warmed up OpenCLIP in: {round((time.time() - start) * 1000)} ms"
+    )
@@ -0,0 +1,97 @@
+"""
+Checks the reduced-resolution decode against a full resolution decode, both run
+through `create_clip_transform`:
+
+    python -m models.open_clip.verify_decode [--embeddings] <image path or URL>...
+
+Exits with 1 if any image goes over the allowed drift.
+"""
+
+import argparse
+import os
+import sys
+
+import torch
+from tabulate import tabulate
+
+from models.constants import DEVICE
+from models.open_clip.constants import OPEN_CLIP_MODEL_CACHE, OPEN_CLIP_MODEL_ID
+from models.open_clip.main import CLIP_IMAGE_SIZE, create_clip_transform
+from utils.helpers import decode_image, download_image_bytes, is_url
+from utils.logger import TabulateLevels
+
+
+def read_source(source: str) -> bytes:
+    if is_url(source):
+        return download_image_bytes(source)
+    with open(source, "rb") as f:
+        return f.read()
+
+
+def cosine_similarity(a: torch.Tensor, b: torch.Tensor) -> float:
+    a, b = a.flatten().double(), b.flatten().double()
+    return (a @ b / (a.norm() * b.norm())).item()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("sources", nargs="+", help="Image paths or URLs")
+    parser.add_argument("--min-size", type=int, default=CLIP_IMAGE_SIZE)
+    parser.add_argument("--max-mean-diff", type=float, default=0.02)
+    parser.add_argument("--min-cosine", type=float, default=0.995)
+    parser.add_argument(
+        "--embeddings",
+        action="store_true",
+        help="Also compare the OpenCLIP image embeddings",
+    )
+    args = parser.parse_args()
+
+    transform = create_clip_transform(CLIP_IMAGE_SIZE)
+    model = None
+    if args.embeddings:
+        from transformers import AutoModel
+
+        model = AutoModel.from_pretrained(
+            OPEN_CLIP_MODEL_ID, cache_dir=OPEN_CLIP_MODEL_CACHE
+        ).to(DEVICE)
+
+    rows = []
+    failed = False
+    for source in args.sources:
+        data = read_source(source)
+        full_image = decode_image(data)
+        reduced_image = decode_image(data, min_size=args.min_size)
+        full = transform(full_image)
+        reduced = transform(reduced_image)
+        diff = (full - reduced).abs()
+        cosine = cosine_similarity(full, reduced)
+        row = [
+            os.path.basename(source),
+            f"{full_image.width}x{full_image.height}",
+            f"{reduced_image.width}x{reduced_image.height}",
+            f"{diff.mean().item():.4f}",
+            f"{diff.max().item():.3f}",
+            f"{cosine:.5f}",
+        ]
+        ok = diff.mean().item() <= args.max_mean_diff and cosine >= args.min_cosine
+        if model is not None:
+            with torch.no_grad():
+                pixel_values = torch.stack([full, reduced]).to(DEVICE)
+                embeddings = model.get_image_features(pixel_values=pixel_values)
+            embedding_cosine = cosine_similarity(embeddings[0], embeddings[1])
+            row.append(f"{embedding_cosine:.5f}")
+            ok = ok and embedding_cosine >= args.min_cosine
+        row.append("✅" if ok else "🔴")
+        failed = failed or not ok
+        rows.append(row)
+
+    headers = ["Image", "Full", "Reduced", "Mean diff", "Max diff", "Pixel cosine"]
+    if model is not None:
+        headers.append("Embedding cosine")
+    headers.append("")
+    print(tabulate(rows, headers=headers, tablefmt=TabulateLevels.PRIMARY.value))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Reduced-precision inference modes for the CPU, applied to a model once at load time:
+
+- fp32: the model as it is
+- bf16: weights in bfloat16, forward passes run under bfloat16 autocast
+- int8: dynamic int8 quantization of the Linear layers, activations stay in fp32
+- int8-bf16: int8 Linear layers, everything else in bfloat16
+"""
+
+from contextlib import nullcontext
+
+import torch
+from torch import nn
+
+from models.constants import DEVICE, DEVICE_CPU
+
+PRECISION_FP32 = "fp32"
+PRECISION_BF16 = "bf16"
+PRECISION_INT8 = "int8"
+PRECISION_INT8_BF16 = "int8-bf16"
+PRECISIONS = [PRECISION_FP32, PRECISION_BF16, PRECISION_INT8, PRECISION_INT8_BF16]
+
+
+def validate_precision(precision: str) -> str:
+    if precision not in PRECISIONS:
+        raise ValueError(f"Invalid precision: {precision}, should be one of {PRECISIONS}")
+    if precision in [PRECISION_INT8, PRECISION_INT8_BF16] and DEVICE != DEVICE_CPU:
+        raise ValueError(f"{precision} precision is only supported on the CPU")
+    return precision
+
+
+def uses_bf16(precision: str) -> bool:
+    return precision in [PRECISION_BF16, PRECISION_INT8_BF16]
+
+
+def input_dtype_of(precision: str) -> torch.dtype:
+    """The dtype the inputs of a model converted to `precision` should be cast to."""
+    return torch.bfloat16 if uses_bf16(precision) else torch.float32
+
+
+class _Int8Linear(nn.Module):
+    """Runs a dynamically quantized Linear on fp32 and casts the output back."""
+
+    def __init__(self, linear: nn.Module):
+        super().__init__()
+        self.linear = linear
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.linear(x.float()).to(x.dtype)
+
+
+def _wrap_int8_linears(module: nn.Module):
+    for name, child in module.named_children():
+        if isinstance(child, torch.ao.nn.quantized.dynamic.Linear):
+            setattr(module, name, _Int8Linear(child))
+        else:
+            _wrap_int8_linears(child)
+
+
+def apply_precision(model: nn.Module, precision: str) -> nn.Module:
+    """Converts an fp32 `model` in eval mode to `precision`, returns the model to use."""
+    validate_precision(precision)
+    if precision in [PRECISION_INT8, PRECISION_INT8_BF16]:
+        # In place, so the fp32 Linear weights are freed instead of copied
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+        if precision == PRECISION_INT8_BF16:
+            _wrap_int8_linears(model)
+    if uses_bf16(precision):
+        model = model.to(torch.bfloat16)
+    return model
+
+
+def weights_bytes(model: nn.Module) -> int:
+    """Bytes taken by the weights of `model`, including the packed int8 ones."""
+
+    def tensor_bytes(value) -> int:
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(tensor_bytes(v) for v in value)
+        return 0
+
+    return sum(tensor_bytes(value) for value in model.state_dict().values())
+
+
+def autocast(precision: str):
+    """The context forward passes of a model converted to `precision` run in."""
+    if uses_bf16(precision):
+        return torch.autocast(device_type=DEVICE, dtype=torch.bfloat16)
+    return nullcontext()
@@ -1,92 +1,300 @@
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
 from huggingface_hub import login
-from transformers import AutoModel, AutoProcessor, AutoTokenizer, pipeline
+from transformers import (
+    AutoConfig,
+    AutoImageProcessor,
+    AutoModel,
+    AutoModelForImageClassification,
+    AutoProcessor,
+    AutoTokenizer,
+)
 from models.aesthetics_scorer.constants import (
     AESTHETICS_SCORER_CACHE_DIR,
     AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_CONFIG,
+    AESTHETICS_SCORER_OPENCLIP_VIT_H_14_CACHE_KEY,
     AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_WEIGHT_URL,
     AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_CONFIG,
     AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_WEIGHT_URL,
 )
-from models.aesthetics_scorer.model import load_model as load_aesthetics_scorer_model
+from models.aesthetics_scorer.model import (
+    FusedAestheticScorer,
+    load_model as load_aesthetics_scorer_model,
+)
+from models.aesthetics_scorer.main import (
+    aesthetics_graph_spec,
+    warmup_aesthetics_scorer,
+)
+from models.backends import load_backend, validate_backend
 from models.constants import (
     DEVICE,
+    EMBEDDING_PROJECTIONS_DIR,
+    IMAGE_STORE_CAPACITY,
+    IMAGE_STORE_DIR,
+    MODEL_AESTHETICS_SCORER,
+    MODEL_BACKEND,
+    MODEL_NSFW_SCORER,
+    MODEL_OPEN_CLIP,
+    MODEL_WARMUP_RUNS,
+    MODELS_ENABLED,
+    MODELS_LAZY,
     SC_CLIP_VERSION,
+    VECTOR_INDEX_BLOCK_ROWS,
+    VECTOR_INDEX_CAPACITY,
+    VECTOR_INDEX_DIR,
+    VECTOR_INDEX_DTYPE,
+    VECTOR_INDEX_ID_MAX_BYTES,
+    VECTOR_INDEX_IVF_LISTS,
+    VECTOR_INDEX_IVF_PROBES,
     AestheticsScorer,
     ModelsPack,
     NSFWScorer,
     OpenCLIP,
 )
-from models.nsfw_scorer.constants import NSFW_SCORER_MODEL_ID
-from models.open_clip.constants import OPEN_CLIP_MODEL_CACHE, OPEN_CLIP_MODEL_ID
+from models.nsfw_scorer.constants import NSFW_SCORER_MODEL_ID, NSFW_SCORER_PRECISION
+from models.nsfw_scorer.main import (
+    create_nsfw_transform,
+    nsfw_graph_spec,
+    warmup_nsfw_scorer,
+)
+from models.open_clip.constants import (
+    OPEN_CLIP_LABEL_CACHE_MAX_MB,
+    OPEN_CLIP_MODEL_CACHE,
+    OPEN_CLIP_MODEL_ID,
+    OPEN_CLIP_PRECISION,
+    OPEN_CLIP_TEXT_CACHE_DTYPE,
+    OPEN_CLIP_TEXT_CACHE_MAX_MB,
+)
+from models.open_clip.main import (
+    create_text_batcher,
+    create_vision_batcher,
+    warmup_open_clip,
+)
+from models.loading import ModelSlot
+from models.precision import apply_precision, validate_precision
 import logging
 from tabulate import tabulate
 
+from utils.cache import EmbeddingCache
+from utils.image_store import ImageStore
+from utils.memory import memory_stats
 from utils.logger import TabulateLevels
+from utils.projections import load_projections
+from utils.vector_index import VectorIndex
 
 
-def setup() -> ModelsPack:
-    start = time.time()
-    version_str = f"Version: {SC_CLIP_VERSION}"
-    logging.info(
-        tabulate(
-            [["🟡 Setup started", version_str]], tablefmt=TabulateLevels.PRIMARY.value
-        )
+def load_open_clip() -> OpenCLIP:
+    logging.info(f"🟡 Loading OpenCLIP in {OPEN_CLIP_PRECISION}")
+    # Safetensors weights are memory-mapped straight into the model, without a
+    # randomly initialized copy first
+    open_clip_model = AutoModel.from_pretrained(
+        OPEN_CLIP_MODEL_ID, cache_dir=OPEN_CLIP_MODEL_CACHE, low_cpu_mem_usage=True
+    ).to(DEVICE)
+    open_clip_model = apply_precision(open_clip_model.eval(), OPEN_CLIP_PRECISION)
+    open_clip_tokenizer = AutoTokenizer.from_pretrained(
+        OPEN_CLIP_MODEL_ID, cache_dir=OPEN_CLIP_MODEL_CACHE
     )
-
-    hf_token = os.environ.get("HF_TOKEN", None)
-    if hf_token is not None:
-        login(token=hf_token)
-        logging.info(f"✅ Logged in to HuggingFace")
-
-    # For OpenCLIP
-    logging.info("🟡 Loading OpenCLIP")
     open_clip = OpenCLIP(
-        model=AutoModel.from_pretrained(
-            OPEN_CLIP_MODEL_ID, cache_dir=OPEN_CLIP_MODEL_CACHE
-        ).to(DEVICE),
+        model=open_clip_model,
         processor=AutoProcessor.from_pretrained(
             OPEN_CLIP_MODEL_ID, cache_dir=OPEN_CLIP_MODEL_CACHE
         ),
-        tokenizer=AutoTokenizer.from_pretrained(
-            OPEN_CLIP_MODEL_ID, cache_dir=OPEN_CLIP_MODEL_CACHE
+        tokenizer=open_clip_tokenizer,
+        vision_batcher=create_vision_batcher(
+            open_clip_model, OPEN_CLIP_PRECISION, MODEL_BACKEND
+        ),
+        text_batcher=create_text_batcher(
+            open_clip_model, open_clip_tokenizer, OPEN_CLIP_PRECISION, MODEL_BACKEND
+        ),
+        text_cache=EmbeddingCache(
+            max_bytes=int(OPEN_CLIP_TEXT_CACHE_MAX_MB * 1024 * 1024),
+            dtype=OPEN_CLIP_TEXT_CACHE_DTYPE,
+        ),
+        label_cache=EmbeddingCache(
+            max_bytes=int(OPEN_CLIP_LABEL_CACHE_MAX_MB * 1024 * 1024)
         ),
+        precision=OPEN_CLIP_PRECISION,
     )
+    if MODEL_WARMUP_RUNS > 0:
+        warmup_open_clip(open_clip, MODEL_WARMUP_RUNS)
     logging.info("✅ Loaded OpenCLIP")
+    return open_clip
 
-    # For asthetics scorer
+
+def load_aesthetics_scorer() -> AestheticsScorer:
     logging.info("🟡 Loading Aesthetics Scorer")
-    aesthetics_scorer = AestheticsScorer(
-        rating_model=load_aesthetics_scorer_model(
+    # Both heads are downloaded and loaded at the same time
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        rating_future = executor.submit(
+            load_aesthetics_scorer_model,
             weight_url=AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_WEIGHT_URL,
             cache_dir=AESTHETICS_SCORER_CACHE_DIR,
             config=AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_CONFIG,
-        ).to(DEVICE),
-        artifacts_model=load_aesthetics_scorer_model(
+        )
+        artifacts_future = executor.submit(
+            load_aesthetics_scorer_model,
             weight_url=AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_WEIGHT_URL,
             cache_dir=AESTHETICS_SCORER_CACHE_DIR,
             config=AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_CONFIG,
-        ).to(DEVICE),
+        )
+        rating_model = rating_future.result().to(DEVICE)
+        artifacts_model = artifacts_future.result().to(DEVICE)
+    fused_model = FusedAestheticScorer([rating_model, artifacts_model]).eval()
+    aesthetics_scorer = AestheticsScorer(
+        rating_model=rating_model,
+        artifacts_model=artifacts_model,
+        fused_model=fused_model,
+        forward=load_backend(
+            aesthetics_graph_spec(
+                fused_model, AESTHETICS_SCORER_OPENCLIP_VIT_H_14_CACHE_KEY
+            ),
+            MODEL_BACKEND,
+        ),
     )
+    if MODEL_WARMUP_RUNS > 0:
+        warmup_aesthetics_scorer(aesthetics_scorer, MODEL_WARMUP_RUNS)
     logging.info("✅ Loaded Aesthetics Scorer")
+    return aesthetics_scorer
 
-    # For NSFW scorer
-    logging.info("🟡 Loading NSFW Scorer")
+
+def load_nsfw_scorer() -> NSFWScorer:
+    logging.info(f"🟡 Loading NSFW Scorer in {NSFW_SCORER_PRECISION}")
+    nsfw_processor = AutoImageProcessor.from_pretrained(NSFW_SCORER_MODEL_ID)
+    nsfw_model = apply_precision(
+        AutoModelForImageClassification.from_pretrained(
+            NSFW_SCORER_MODEL_ID, low_cpu_mem_usage=True
+        )
+        .to(DEVICE)
+        .eval(),
+        NSFW_SCORER_PRECISION,
+    )
     nsfw_scorer = NSFWScorer(
-        pipeline=pipeline(
-            "image-classification", model=NSFW_SCORER_MODEL_ID, device=DEVICE
+        model=nsfw_model,
+        processor=nsfw_processor,
+        transform=create_nsfw_transform(nsfw_processor),
+        precision=NSFW_SCORER_PRECISION,
+        forward=load_backend(
+            nsfw_graph_spec(nsfw_model, nsfw_processor, NSFW_SCORER_PRECISION),
+            MODEL_BACKEND,
+            NSFW_SCORER_PRECISION,
+        ),
+    )
+    if MODEL_WARMUP_RUNS > 0:
+        warmup_nsfw_scorer(nsfw_scorer, MODEL_WARMUP_RUNS)
+    logging.info("✅ Loaded NSFW Scorer")
+    return nsfw_scorer
+
+
+LOADERS = {
+    MODEL_OPEN_CLIP: load_open_clip,
+    MODEL_AESTHETICS_SCORER: load_aesthetics_scorer,
+    MODEL_NSFW_SCORER: load_nsfw_scorer,
+}
+
+
+def open_image_store(directory: str, capacity: int) -> ImageStore:
+    # Sized from the config alone so it doesn't wait for the OpenCLIP weights
+    open_clip_config = AutoConfig.from_pretrained(
+        OPEN_CLIP_MODEL_ID, cache_dir=OPEN_CLIP_MODEL_CACHE
+    )
+    return ImageStore(
+        directory=directory,
+        capacity=capacity,
+        embedding_dim=open_clip_config.projection_dim,
+        pooler_dim=open_clip_config.vision_config.hidden_size,
+    )
+
+
+def setup(with_image_store: bool = True) -> ModelsPack:
+    """
+    Starts loading the enabled models, each on its own thread, and returns right
+    away. The lazy ones are left for the first request that needs them. Without
+    `with_image_store` the store is left for the caller to open.
+    """
+    start = time.time()
+    version_str = f"Version: {SC_CLIP_VERSION}"
+    logging.info(
+        tabulate(
+            [["🟡 Setup started", version_str]], tablefmt=TabulateLevels.PRIMARY.value
         )
     )
-    logging.info("✅ Loaded Aesthetics Scorer")
 
-    end = time.time()
-    logging.info("//////////////////////////////////////////////////////////////////")
-    logging.info(f"✅ Setup is done in: {round((end - start))} sec.")
-    logging.info("//////////////////////////////////////////////////////////////////")
+    hf_token = os.environ.get("HF_TOKEN", None)
+    if hf_token is not None:
+        login(token=hf_token)
+        logging.info(f"✅ Logged in to HuggingFace")
+
+    # Fail before loading anything if a precision isn't usable on this device
+    validate_precision(OPEN_CLIP_PRECISION)
+    validate_precision(NSFW_SCORER_PRECISION)
+    validate_backend(MODEL_BACKEND)
+
+    slots = {
+        name: ModelSlot(
+            name,
+            load if name in MODELS_ENABLED else None,
+            lazy=name in MODELS_LAZY,
+        )
+        for name, load in LOADERS.items()
+    }
+
+    image_store = None
+    if with_image_store and IMAGE_STORE_CAPACITY > 0:
+        image_store = open_image_store(IMAGE_STORE_DIR, IMAGE_STORE_CAPACITY)
+
+    vector_index = None
+    projections = {}
+    if VECTOR_INDEX_CAPACITY > 0 or EMBEDDING_PROJECTIONS_DIR != "":
+        open_clip_config = AutoConfig.from_pretrained(
+            OPEN_CLIP_MODEL_ID, cache_dir=OPEN_CLIP_MODEL_CACHE
+        )
+    if EMBEDDING_PROJECTIONS_DIR != "":
+        projections = load_projections(
+            EMBEDDING_PROJECTIONS_DIR, open_clip_config.projection_dim
+        )
+    if VECTOR_INDEX_CAPACITY > 0:
+        vector_index = VectorIndex(
+            directory=VECTOR_INDEX_DIR,
+            capacity=VECTOR_INDEX_CAPACITY,
+            dim=open_clip_config.projection_dim,
+            dtype=VECTOR_INDEX_DTYPE,
+            id_max_bytes=VECTOR_INDEX_ID_MAX_BYTES,
+            block_rows=VECTOR_INDEX_BLOCK_ROWS,
+            ivf_lists=VECTOR_INDEX_IVF_LISTS,
+            ivf_probes=VECTOR_INDEX_IVF_PROBES,
+        )
+
+    eager_slots = [slot for slot in slots.values() if not slot.lazy]
+    for slot in eager_slots:
+        slot.start()
+    logging.info(
+        tabulate(
+            [[name, slot.state] for name, slot in slots.items()],
+            tablefmt=TabulateLevels.PRIMARY.value,
+        )
+    )
+
+    def log_when_done():
+        for slot in eager_slots:
+            slot.wait()
+        end = time.time()
+        logging.info("//////////////////////////////////////////////////////////////////")
+        logging.info(f"✅ Setup is done in: {round((end - start))} sec.")
+        memory = memory_stats()
+        logging.info(
+            f"✅ Memory: {memory['rss_mb']} MB, peak: {memory['rss_peak_mb']} MB"
+        )
+        logging.info("//////////////////////////////////////////////////////////////////")
+
+    Thread(target=log_when_done, name="setup", daemon=True).start()
 
     return ModelsPack(
-        open_clip=open_clip,
-        aesthetics_scorer=aesthetics_scorer,
-        nsfw_scorer=nsfw_scorer,
+        open_clip=slots[MODEL_OPEN_CLIP],
+        aesthetics_scorer=slots[MODEL_AESTHETICS_SCORER],
+        nsfw_scorer=slots[MODEL_NSFW_SCORER],
+        image_store=image_store,
+        vector_index=vector_index,
+        projections=projections,
     )
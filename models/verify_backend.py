@@ -0,0 +1,162 @@
+"""
+Checks the exported backends against eager PyTorch, model by model:
+
+    python -m models.verify_backend [--backends torchscript onnx] [--precision fp32]
+
+For every model and backend it reports the lowest cosine similarity of the
+outputs to the eager ones and the throughput of both on random inputs. Exports
+are written to (and reused from) `MODEL_BACKEND_CACHE_DIR`, the same ones the
+server loads. Exits with 1 if any backend fails to export or drifts.
+"""
+
+import argparse
+import sys
+import time
+from typing import Callable, List, Tuple
+
+import torch
+from tabulate import tabulate
+
+from models.aesthetics_scorer.constants import (
+    AESTHETICS_SCORER_OPENCLIP_VIT_H_14_CACHE_KEY,
+)
+from models.aesthetics_scorer.main import aesthetics_graph_spec
+from models.backends import (
+    BACKEND_EAGER,
+    BACKENDS,
+    PARITY_MIN_COSINE,
+    GraphSpec,
+    check_parity,
+    eager_forward,
+    exported_forward,
+    validate_backend,
+)
+from models.nsfw_scorer.main import nsfw_graph_spec
+from models.open_clip.main import text_graph_spec, vision_graph_spec
+from models.precision import (
+    PRECISION_FP32,
+    PRECISIONS,
+    apply_precision,
+    validate_precision,
+)
+from models.verify_precision import load_reference_models
+from utils.logger import TabulateLevels
+
+
+def batch_of(inputs: Tuple[torch.Tensor, ...], size: int) -> Tuple[torch.Tensor, ...]:
+    """Tiles the rows of `inputs` up to `size` rows."""
+    return tuple(
+        tensor.repeat(-(-size // len(tensor)), *[1] * (tensor.dim() - 1))[:size]
+        for tensor in inputs
+    )
+
+
+def items_per_sec(forward: Callable, inputs: Tuple[torch.Tensor, ...], runs: int):
+    # The first pass warms up, the next ones are timed
+    forward(*inputs)
+    start = time.time()
+    for _ in range(runs):
+        forward(*inputs)
+    return len(inputs[0]) * runs / (time.time() - start)
+
+
+def verify(
+    specs: List[Tuple[GraphSpec, str]],
+    backends: List[str],
+    batch_size: int,
+    runs: int,
+    min_cosine: float,
+) -> bool:
+    """
+    `specs` pairs every graph with the precision its module was converted to.
+    Prints the comparison table, returns whether any backend failed.
+    """
+    rows = []
+    failed = False
+    for spec, precision in specs:
+        inputs = batch_of(spec.check_inputs, batch_size)
+        eager = eager_forward(spec, precision)
+        eager_speed = items_per_sec(eager, inputs, runs)
+        rows.append(
+            [spec.name, BACKEND_EAGER, "1.00000", f"{eager_speed:.1f}", "1.00x", "✅"]
+        )
+        for backend in backends:
+            if backend == BACKEND_EAGER:
+                continue
+            try:
+                forward = exported_forward(spec, backend, precision)
+                cosine = check_parity(forward, eager, inputs)
+                speed = items_per_sec(forward, inputs, runs)
+            except Exception as e:
+                failed = True
+                error = str(e).strip().splitlines()[0][:80]
+                rows.append([spec.name, backend, "-", "-", "-", f"🔴 {error}"])
+                continue
+            ok = cosine >= min_cosine
+            failed = failed or not ok
+            rows.append(
+                [
+                    spec.name,
+                    backend,
+                    f"{cosine:.5f}",
+                    f"{speed:.1f}",
+                    f"{speed / eager_speed:.2f}x",
+                    "✅" if ok else "🔴",
+                ]
+            )
+
+    headers = ["Model", "Backend", "Min cosine", "Items/sec", "Speedup", ""]
+    print(tabulate(rows, headers=headers, tablefmt=TabulateLevels.PRIMARY.value))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=[b for b in BACKENDS if b != BACKEND_EAGER],
+        choices=BACKENDS,
+    )
+    parser.add_argument(
+        "--precision",
+        default=PRECISION_FP32,
+        choices=PRECISIONS,
+        help="Precision of the OpenCLIP and NSFW models",
+    )
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--min-cosine", type=float, default=PARITY_MIN_COSINE)
+    args = parser.parse_args()
+    for backend in args.backends:
+        validate_backend(backend)
+    validate_precision(args.precision)
+
+    (
+        clip_model,
+        _,
+        nsfw_model,
+        nsfw_processor,
+        aesthetics_scorer,
+    ) = load_reference_models()
+    clip_model = apply_precision(clip_model, args.precision)
+    nsfw_model = apply_precision(nsfw_model, args.precision)
+    specs = [
+        (vision_graph_spec(clip_model, args.precision), args.precision),
+        (text_graph_spec(clip_model, args.precision), args.precision),
+        (
+            aesthetics_graph_spec(
+                aesthetics_scorer.fused_model,
+                AESTHETICS_SCORER_OPENCLIP_VIT_H_14_CACHE_KEY,
+            ),
+            PRECISION_FP32,
+        ),
+        (nsfw_graph_spec(nsfw_model, nsfw_processor, args.precision), args.precision),
+    ]
+
+    failed = verify(specs, args.backends, args.batch_size, args.runs, args.min_cosine)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
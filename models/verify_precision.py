@@ -0,0 +1,294 @@
+"""
+Checks the reduced-precision modes against fp32 on a sample set of images and texts:
+
+    python -m models.verify_precision [--precisions bf16 int8 ...] <image path or URL>...
+
+For every mode it reports the cosine similarity of the OpenCLIP image and text
+embeddings to the fp32 ones, the drift of the aesthetic and NSFW scores, the
+vision throughput and the size of the weights. Exits with 1 if any mode goes
+over the allowed drift.
+"""
+
+import argparse
+import copy
+import sys
+import time
+from typing import List
+
+import torch
+from tabulate import tabulate
+
+from models.aesthetics_scorer.constants import (
+    AESTHETICS_SCORER_CACHE_DIR,
+    AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_CONFIG,
+    AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_WEIGHT_URL,
+    AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_CONFIG,
+    AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_WEIGHT_URL,
+)
+from models.aesthetics_scorer.main import generate_aesthetic_scores_batch
+from models.aesthetics_scorer.model import (
+    FusedAestheticScorer,
+    load_model as load_aesthetics_scorer_model,
+)
+from models.constants import DEVICE, AestheticsScorer, NSFWScorer
+from models.nsfw_scorer.constants import NSFW_SCORER_MODEL_ID
+from models.nsfw_scorer.main import create_nsfw_transform, generate_nsfw_score
+from models.open_clip.constants import OPEN_CLIP_MODEL_CACHE, OPEN_CLIP_MODEL_ID
+from models.open_clip.main import (
+    clip_transform,
+    create_text_batcher,
+    create_vision_batcher,
+)
+from models.open_clip.verify_decode import read_source
+from models.precision import (
+    PRECISION_FP32,
+    PRECISIONS,
+    apply_precision,
+    validate_precision,
+    weights_bytes,
+)
+from utils.helpers import decode_image
+from utils.logger import TabulateLevels
+
+SAMPLE_TEXTS = [
+    "a photo of a cat",
+    "an astronaut riding a horse on the moon, digital art",
+    "portrait of a woman in a red dress, oil painting, highly detailed",
+    "a bowl of ramen",
+    "cyberpunk city street at night, neon lights, rain, cinematic lighting, 4k",
+]
+
+
+class Outputs:
+    def __init__(self, image_embeddings, text_embeddings, ratings, artifacts, nsfw):
+        self.image_embeddings = image_embeddings
+        self.text_embeddings = text_embeddings
+        self.ratings = ratings
+        self.artifacts = artifacts
+        self.nsfw = nsfw
+
+
+def run(
+    clip_model,
+    tokenizer,
+    nsfw_model,
+    nsfw_processor,
+    aesthetics_scorer: AestheticsScorer,
+    images,
+    texts: List[str],
+    precision: str,
+    runs: int,
+):
+    """Runs the sample set through the serving code paths, returns the outputs and images/sec."""
+    vision_batcher = create_vision_batcher(clip_model, precision)
+    text_batcher = create_text_batcher(clip_model, tokenizer, precision)
+    pixel_values = [clip_transform(image) for image in images]
+
+    # The first pass warms up, the next ones are timed
+    image_embeddings, pooler_output = vision_batcher.submit(pixel_values)
+    start = time.time()
+    for _ in range(runs):
+        vision_batcher.submit(pixel_values)
+    images_per_sec = len(images) * runs / (time.time() - start)
+
+    (text_embeddings,) = text_batcher.submit(texts)
+    scores = generate_aesthetic_scores_batch(pooler_output, aesthetics_scorer)
+    nsfw_scorer = NSFWScorer(
+        nsfw_model, nsfw_processor, create_nsfw_transform(nsfw_processor), precision
+    )
+    nsfw_scores = generate_nsfw_score(images, nsfw_scorer)
+    outputs = Outputs(
+        image_embeddings=image_embeddings,
+        text_embeddings=text_embeddings,
+        ratings=torch.tensor([score.rating_score for score in scores]),
+        artifacts=torch.tensor([score.artifact_score for score in scores]),
+        nsfw=torch.tensor([score.nsfw_score for score in nsfw_scores]),
+    )
+    return outputs, images_per_sec
+
+
+def min_cosine(a: torch.Tensor, b: torch.Tensor) -> float:
+    return torch.nn.functional.cosine_similarity(a.double(), b.double()).min().item()
+
+
+def max_drift(a: torch.Tensor, b: torch.Tensor) -> float:
+    return (a - b).abs().max().item()
+
+
+def verify(
+    clip_model,
+    tokenizer,
+    nsfw_model,
+    nsfw_processor,
+    aesthetics_scorer: AestheticsScorer,
+    images,
+    texts: List[str],
+    precisions: List[str],
+    runs: int,
+    min_cosine_allowed: float,
+    max_score_drift: float,
+) -> bool:
+    """Prints the comparison table, returns whether any precision failed."""
+    clip_model.eval()
+    reference, reference_speed = run(
+        clip_model,
+        tokenizer,
+        nsfw_model,
+        nsfw_processor,
+        aesthetics_scorer,
+        images,
+        texts,
+        PRECISION_FP32,
+        runs,
+    )
+    reference_mb = weights_bytes(clip_model) / 1024 / 1024
+    rows = [
+        [PRECISION_FP32, "1.00000", "1.00000", "0.0000", "0.0000", "0.0000"]
+        + [f"{reference_speed:.1f}", "1.00x", f"{reference_mb:.0f}", "✅"]
+    ]
+    failed = False
+    for precision in precisions:
+        if precision == PRECISION_FP32:
+            continue
+        candidate = apply_precision(copy.deepcopy(clip_model), precision)
+        outputs, speed = run(
+            candidate,
+            tokenizer,
+            apply_precision(copy.deepcopy(nsfw_model), precision),
+            nsfw_processor,
+            aesthetics_scorer,
+            images,
+            texts,
+            precision,
+            runs,
+        )
+        image_cosine = min_cosine(outputs.image_embeddings, reference.image_embeddings)
+        text_cosine = min_cosine(outputs.text_embeddings, reference.text_embeddings)
+        rating_drift = max_drift(outputs.ratings, reference.ratings)
+        artifact_drift = max_drift(outputs.artifacts, reference.artifacts)
+        nsfw_drift = max_drift(outputs.nsfw, reference.nsfw)
+        mb = weights_bytes(candidate)
+        ok = (
+            min(image_cosine, text_cosine) >= min_cosine_allowed
+            and max(rating_drift, artifact_drift, nsfw_drift) <= max_score_drift
+        )
+        failed = failed or not ok
+        rows.append(
+            [
+                precision,
+                f"{image_cosine:.5f}",
+                f"{text_cosine:.5f}",
+                f"{rating_drift:.4f}",
+                f"{artifact_drift:.4f}",
+                f"{nsfw_drift:.4f}",
+                f"{speed:.1f}",
+                f"{speed / reference_speed:.2f}x",
+                f"{mb / 1024 / 1024:.0f}",
+                "✅" if ok else "🔴",
+            ]
+        )
+
+    headers = [
+        "Precision",
+        "Image cosine",
+        "Text cosine",
+        "Rating drift",
+        "Artifact drift",
+        "NSFW drift",
+        "Images/sec",
+        "Speedup",
+        "OpenCLIP MB",
+        "",
+    ]
+    print(tabulate(rows, headers=headers, tablefmt=TabulateLevels.PRIMARY.value))
+    return failed
+
+
+def load_reference_models():
+    """
+    Loads the fp32 models the way `setup` does, returns the OpenCLIP model, its
+    tokenizer, the NSFW model, its processor and the aesthetics scorer.
+    """
+    from transformers import (
+        AutoImageProcessor,
+        AutoModel,
+        AutoModelForImageClassification,
+        AutoTokenizer,
+    )
+
+    clip_model = (
+        AutoModel.from_pretrained(OPEN_CLIP_MODEL_ID, cache_dir=OPEN_CLIP_MODEL_CACHE)
+        .to(DEVICE)
+        .eval()
+    )
+    tokenizer = AutoTokenizer.from_pretrained(
+        OPEN_CLIP_MODEL_ID, cache_dir=OPEN_CLIP_MODEL_CACHE
+    )
+    nsfw_model = (
+        AutoModelForImageClassification.from_pretrained(NSFW_SCORER_MODEL_ID)
+        .to(DEVICE)
+        .eval()
+    )
+    nsfw_processor = AutoImageProcessor.from_pretrained(NSFW_SCORER_MODEL_ID)
+    rating_model = load_aesthetics_scorer_model(
+        weight_url=AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_WEIGHT_URL,
+        cache_dir=AESTHETICS_SCORER_CACHE_DIR,
+        config=AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_CONFIG,
+    ).to(DEVICE)
+    artifacts_model = load_aesthetics_scorer_model(
+        weight_url=AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_WEIGHT_URL,
+        cache_dir=AESTHETICS_SCORER_CACHE_DIR,
+        config=AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_CONFIG,
+    ).to(DEVICE)
+    aesthetics_scorer = AestheticsScorer(
+        rating_model=rating_model,
+        artifacts_model=artifacts_model,
+        fused_model=FusedAestheticScorer([rating_model, artifacts_model]).eval(),
+    )
+    return clip_model, tokenizer, nsfw_model, nsfw_processor, aesthetics_scorer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("sources", nargs="+", help="Image paths or URLs")
+    parser.add_argument(
+        "--precisions",
+        nargs="+",
+        default=[p for p in PRECISIONS if p != PRECISION_FP32],
+        choices=PRECISIONS,
+    )
+    parser.add_argument("--texts", nargs="+", default=SAMPLE_TEXTS)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--min-cosine", type=float, default=0.99)
+    parser.add_argument("--max-score-drift", type=float, default=0.02)
+    args = parser.parse_args()
+    for precision in args.precisions:
+        validate_precision(precision)
+
+    (
+        clip_model,
+        tokenizer,
+        nsfw_model,
+        nsfw_processor,
+        aesthetics_scorer,
+    ) = load_reference_models()
+    images = [decode_image(read_source(source)) for source in args.sources]
+
+    failed = verify(
+        clip_model,
+        tokenizer,
+        nsfw_model,
+        nsfw_processor,
+        aesthetics_scorer,
+        images,
+        args.texts,
+        args.precisions,
+        args.runs,
+        args.min_cosine,
+        args.max_score_drift,
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
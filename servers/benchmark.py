@@ -0,0 +1,714 @@
+"""
+Benchmarks the serving path end to end, offline, on a plain CPU box:
+
+    python -m servers.benchmark [--scenarios image text ...] [--concurrency 1 8]
+        [--batch-sizes 1 16] [--workers 1] [--output results.json]
+        [--compare baseline.json]
+
+The API is started in a child process with small random-weight stand-ins for
+the OpenCLIP, aesthetics and NSFW models, behind the same `ModelsPack` and
+batchers as in production, and reads synthetic images from a local HTTP stub.
+Nothing is downloaded. Every scenario is run at every concurrency and batch
+size, the table reports throughput, latency percentiles, the peak RSS of the
+API process, and the mean time and the largest RSS increase over a run of
+every server-side stage from `/metrics`. With `--workers` the API is served by
+that many worker processes, see servers/workers.py, the peak is the PSS of all
+of them and their parent, and the stages have no RSS increase of their own.
+
+`--output` writes the results as JSON, `--compare` prints the change of every
+run against the results of an earlier one. The stand-ins are much smaller than
+the real models, so the numbers are for comparing runs, not for sizing.
+"""
+
+import argparse
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+import requests
+from PIL import Image
+from tabulate import tabulate
+
+from utils.logger import TabulateLevels
+
+SCENARIO_TEXT = "text"
+SCENARIO_IMAGE = "image"
+SCENARIO_IMAGE_SCORED = "image-scored"
+SCENARIO_NSFW_CHECK = "nsfw-check"
+SCENARIO_MIXED = "mixed"
+SCENARIOS = [
+    SCENARIO_TEXT,
+    SCENARIO_IMAGE,
+    SCENARIO_IMAGE_SCORED,
+    SCENARIO_NSFW_CHECK,
+    SCENARIO_MIXED,
+]
+
+SAMPLE_WORDS = (
+    "a photo of cat dog astronaut riding horse on the moon digital art portrait "
+    "woman red dress oil painting highly detailed bowl ramen cyberpunk city street "
+    "night neon lights rain cinematic lighting"
+).split()
+
+# How often the RSS of the API process is sampled during a run, by the benchmark
+# and, over every stage, by the API itself
+RSS_SAMPLE_INTERVAL_S = 0.02
+STAGE_METRIC = "clipapi_stage_seconds"
+STAGE_RSS_METRIC = "clipapi_stage_rss_growth_bytes"
+
+
+class ByteTokenizer:
+    """Stand-in for the CLIP tokenizer, one token per byte between start and end tokens."""
+
+    bos_token_id = 49406
+    eos_token_id = 49407
+    pad_token_id = 49407
+
+    def __call__(self, texts: List[str], truncation=True, max_length=77, **kwargs):
+        input_ids = []
+        for text in texts:
+            tokens = [byte + 1 for byte in text.encode()]
+            if truncation:
+                tokens = tokens[: max_length - 2]
+            input_ids.append([self.bos_token_id, *tokens, self.eos_token_id])
+        return {"input_ids": input_ids}
+
+
+def stand_in_models_pack(width: int, layers: int):
+    """A `ModelsPack` of randomly initialized models with the production interfaces."""
+    import torch
+    from transformers import (
+        CLIPConfig,
+        CLIPModel,
+        ViTConfig,
+        ViTForImageClassification,
+        ViTImageProcessor,
+    )
+
+    from models.aesthetics_scorer.model import AestheticScorer, FusedAestheticScorer
+    from models.constants import (
+        DEVICE,
+        MODEL_BACKEND,
+        AestheticsScorer,
+        ModelsPack,
+        NSFWScorer,
+        OpenCLIP,
+    )
+    from models.nsfw_scorer.main import create_nsfw_transform
+    from models.open_clip.constants import (
+        OPEN_CLIP_LABEL_CACHE_MAX_MB,
+        OPEN_CLIP_TEXT_CACHE_DTYPE,
+        OPEN_CLIP_TEXT_CACHE_MAX_MB,
+    )
+    from models.open_clip.main import (
+        CLIP_IMAGE_SIZE,
+        create_text_batcher,
+        create_vision_batcher,
+    )
+    from utils.cache import EmbeddingCache
+
+    torch.manual_seed(0)
+    tower = dict(
+        hidden_size=width,
+        intermediate_size=width * 4,
+        num_attention_heads=max(width // 32, 1),
+        num_hidden_layers=layers,
+    )
+    clip_model = (
+        CLIPModel(
+            CLIPConfig(
+                text_config=dict(**tower, max_position_embeddings=77),
+                vision_config=dict(**tower, image_size=CLIP_IMAGE_SIZE, patch_size=32),
+                projection_dim=width,
+            )
+        )
+        .to(DEVICE)
+        .eval()
+    )
+    tokenizer = ByteTokenizer()
+    open_clip = OpenCLIP(
+        model=clip_model,
+        processor=None,
+        tokenizer=tokenizer,
+        vision_batcher=create_vision_batcher(clip_model, backend=MODEL_BACKEND),
+        text_batcher=create_text_batcher(clip_model, tokenizer, backend=MODEL_BACKEND),
+        text_cache=EmbeddingCache(
+            max_bytes=int(OPEN_CLIP_TEXT_CACHE_MAX_MB * 1024 * 1024),
+            dtype=OPEN_CLIP_TEXT_CACHE_DTYPE,
+        ),
+        label_cache=EmbeddingCache(
+            max_bytes=int(OPEN_CLIP_LABEL_CACHE_MAX_MB * 1024 * 1024)
+        ),
+    )
+
+    head_config = {
+        "input_size": width,
+        "use_activation": False,
+        "dropout": 0.0,
+        "hidden_dim": width * 4,
+        "reduce_dims": False,
+        "output_activation": None,
+    }
+    rating_model = AestheticScorer(config=head_config).to(DEVICE).eval()
+    artifacts_model = AestheticScorer(config=head_config).to(DEVICE).eval()
+    aesthetics_scorer = AestheticsScorer(
+        rating_model=rating_model,
+        artifacts_model=artifacts_model,
+        fused_model=FusedAestheticScorer([rating_model, artifacts_model]).eval(),
+    )
+
+    nsfw_model = (
+        ViTForImageClassification(
+            ViTConfig(
+                **tower,
+                image_size=224,
+                patch_size=32,
+                id2label={0: "normal", 1: "nsfw"},
+                label2id={"normal": 0, "nsfw": 1},
+            )
+        )
+        .to(DEVICE)
+        .eval()
+    )
+    nsfw_processor = ViTImageProcessor(size={"height": 224, "width": 224})
+    nsfw_scorer = NSFWScorer(
+        model=nsfw_model,
+        processor=nsfw_processor,
+        transform=create_nsfw_transform(nsfw_processor),
+    )
+    return ModelsPack(open_clip, aesthetics_scorer, nsfw_scorer)
+
+
+def serve_stand_ins(port: int, token: str, width: int, layers: int, workers: int):
+    """Runs the API with the stand-in models, in the child process."""
+    import logging
+
+    logging.basicConfig(level=logging.WARNING)
+    os.environ["CLIPAPI_HOST"] = "127.0.0.1"
+    os.environ["CLIPAPI_PORT"] = str(port)
+    os.environ["CLIPAPI_AUTH_TOKEN"] = token
+    os.environ["HF_HUB_OFFLINE"] = "1"
+
+    from models.aesthetics_scorer.main import warmup_aesthetics_scorer
+    from models.constants import MODEL_WARMUP_RUNS
+    from models.nsfw_scorer.main import warmup_nsfw_scorer
+    from models.open_clip.main import warmup_open_clip
+    from servers.clip import run_clipapi
+    from servers.workers import prepare_workers, run_clipapi_workers
+    from utils.metrics import enable_stage_rss_sampling
+
+    if workers > 1:
+        prepare_workers(workers)
+    else:
+        enable_stage_rss_sampling(RSS_SAMPLE_INTERVAL_S)
+    models_pack = stand_in_models_pack(width, layers)
+    if MODEL_WARMUP_RUNS > 0:
+        warmup_open_clip(models_pack.open_clip, MODEL_WARMUP_RUNS)
+        warmup_aesthetics_scorer(models_pack.aesthetics_scorer, MODEL_WARMUP_RUNS)
+        warmup_nsfw_scorer(models_pack.nsfw_scorer, MODEL_WARMUP_RUNS)
+    if workers > 1:
+        run_clipapi_workers(models_pack, workers)
+    else:
+        run_clipapi(models_pack)
+
+
+def synthetic_images(count: int, size: int) -> List[bytes]:
+    """JPEGs of smooth random noise, which compress about like photos do."""
+    # Unseeded, a run must not repeat the texts of an earlier one
+    rng = np.random.default_rng()
+    images = []
+    for _ in range(count):
+        pixels = rng.integers(0, 255, (size // 16, size // 16, 3), dtype=np.uint8)
+        image = Image.fromarray(pixels).resize((size, size), Image.BICUBIC)
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+def start_image_stub(images: List[bytes]) -> Tuple[http.server.HTTPServer, str]:
+    """
+    Serves the images at `<base URL>/<any prefix>/<n>.jpg`, image `n` modulo
+    their count, so every request can use URLs nothing has cached yet.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are separate writes, with Nagle a reused connection
+        # would wait for the delayed ACK of the headers before sending the body
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            name = self.path.rsplit("/", 1)[-1].split(".")[0]
+            body = images[int(name) % len(images)] if name.isdigit() else None
+            if body is None:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def request_of(
+    scenario: str, batch_size: int, image_base: str, rng: np.random.Generator
+) -> Tuple[str, list]:
+    """The route and body of one request of `scenario`, with URLs unique to it."""
+    prefix = f"{image_base}/{uuid.uuid4().hex}"
+
+    def url():
+        return f"{prefix}/{rng.integers(1 << 30)}.jpg"
+
+    def text():
+        # Ends with a number so it's not in the text cache
+        words = rng.choice(SAMPLE_WORDS, size=rng.integers(3, 30))
+        return " ".join([*words, str(rng.integers(1 << 30))])
+
+    if scenario == SCENARIO_TEXT:
+        return "/embed", [{"text": text()} for _ in range(batch_size)]
+    if scenario == SCENARIO_IMAGE:
+        return "/embed", [{"image": url()} for _ in range(batch_size)]
+    if scenario == SCENARIO_IMAGE_SCORED:
+        return "/embed", [
+            {"image": url(), "calculate_score": True, "check_nsfw": True}
+            for _ in range(batch_size)
+        ]
+    if scenario == SCENARIO_NSFW_CHECK:
+        return "/nsfw-check", [url() for _ in range(batch_size)]
+    if scenario == SCENARIO_MIXED:
+        return "/embed", [
+            {"text": text()} if rng.random() < 0.5 else {"image": url()}
+            for _ in range(batch_size)
+        ]
+    raise ValueError(f"Invalid scenario: {scenario}, should be one of {SCENARIOS}")
+
+
+def _proc_field_mb(path: str, field: str) -> float | None:
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def rss_mb(pid: int) -> float | None:
+    """
+    RSS of the process, or with worker processes the PSS of the process and its
+    children, their RSS would count the weights they share once per worker.
+    """
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        children = []
+    if len(children) == 0:
+        return _proc_field_mb(f"/proc/{pid}/status", "VmRSS:")
+    values = [
+        _proc_field_mb(f"/proc/{process}/smaps_rollup", "Pss:")
+        for process in [pid] + children
+    ]
+    return sum(value for value in values if value is not None)
+
+
+class RSSSampler:
+    """Samples the RSS of a process on a thread, keeping the highest value."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.peak_mb: float | None = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            value = rss_mb(self.pid)
+            if value is not None:
+                self.peak_mb = max(self.peak_mb or 0, value)
+            self._stop.wait(RSS_SAMPLE_INTERVAL_S)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def stage_histograms(api_base: str) -> Dict[str, Dict[str, float]]:
+    """
+    The cumulative bucket counts and the sum of every stage, from `/metrics`,
+    and its largest RSS increase since the previous scrape when the API samples
+    it.
+    """
+    from prometheus_client.parser import text_string_to_metric_families
+
+    stages: Dict[str, Dict[str, float]] = {}
+    text = requests.get(f"{api_base}/metrics", timeout=10).text
+    for family in text_string_to_metric_families(text):
+        if family.name == STAGE_RSS_METRIC:
+            for sample in family.samples:
+                stage = stages.setdefault(sample.labels["stage"], {})
+                stage["rss_growth"] = sample.value
+            continue
+        if family.name != STAGE_METRIC:
+            continue
+        for sample in family.samples:
+            stage = stages.setdefault(sample.labels["stage"], {})
+            if sample.name.endswith("_bucket"):
+                stage[sample.labels["le"]] = sample.value
+            elif sample.name.endswith("_sum"):
+                stage["sum"] = sample.value
+    return stages
+
+
+def histogram_quantile(buckets: List[Tuple[float, float]], q: float) -> float | None:
+    """
+    Estimates quantile `q` from cumulative `(upper bound, count)` buckets, by
+    linear interpolation within the bucket it falls in, like Prometheus does.
+    """
+    total = buckets[-1][1] if len(buckets) > 0 else 0
+    if total <= 0:
+        return None
+    rank = q * total
+    lower, below = 0.0, 0.0
+    for upper, count in buckets:
+        if count >= rank:
+            if upper == float("inf"):
+                return lower
+            if count == below:
+                return upper
+            return lower + (upper - lower) * (rank - below) / (count - below)
+        lower, below = upper, count
+    return lower
+
+
+def stage_summary(before: dict, after: dict) -> Dict[str, dict]:
+    """
+    Count, mean and percentiles in ms of every stage between two scrapes, and
+    its largest RSS increase in MB, `None` when the API doesn't sample it.
+    """
+    summary = {}
+    for stage, values in after.items():
+        previous = before.get(stage, {})
+        buckets = sorted(
+            (float(le), count - previous.get(le, 0))
+            for le, count in values.items()
+            if le not in ["sum", "rss_growth"]
+        )
+        count = buckets[-1][1] if len(buckets) > 0 else 0
+        if count <= 0:
+            continue
+        total = values.get("sum", 0) - previous.get("sum", 0)
+        rss_growth = values.get("rss_growth", None)
+        summary[stage] = {
+            "count": int(count),
+            "mean_ms": total / count * 1000,
+            "rss_growth_mb": (
+                rss_growth / 1024 / 1024 if rss_growth is not None else None
+            ),
+        }
+        for name, q in [("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)]:
+            value = histogram_quantile(buckets, q)
+            summary[stage][name] = value * 1000 if value is not None else None
+    return summary
+
+
+def run(
+    api_base: str,
+    image_base: str,
+    token: str,
+    pid: int,
+    scenario: str,
+    concurrency: int,
+    batch_size: int,
+    requests_count: int,
+) -> dict:
+    """Sends `requests_count` requests of `scenario` from `concurrency` clients."""
+    local = threading.local()
+    rng_lock = threading.Lock()
+    # Unseeded, a run must not repeat the texts of an earlier one
+    rng = np.random.default_rng()
+
+    def send(_):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        with rng_lock:
+            route, body = request_of(scenario, batch_size, image_base, rng)
+        start = time.perf_counter()
+        response = session.post(
+            f"{api_base}{route}",
+            json=body,
+            headers={"Authorization": token},
+            timeout=120,
+        )
+        latency = time.perf_counter() - start
+        item_errors = 0
+        if response.ok:
+            data = response.json()
+            items = data.get("embeddings", data.get("data", []))
+            item_errors = sum(1 for item in items if "error" in item)
+        return latency, response.status_code, item_errors
+
+    before = stage_histograms(api_base)
+    with RSSSampler(pid) as sampler, ThreadPoolExecutor(concurrency) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(send, range(requests_count)))
+        elapsed = time.perf_counter() - start
+    after = stage_histograms(api_base)
+
+    ok = [latency for latency, status, _ in results if status == 200]
+    latencies = np.array(ok) * 1000
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "batch_size": batch_size,
+        "requests": requests_count,
+        "failed_requests": requests_count - len(ok),
+        "item_errors": sum(errors for _, _, errors in results),
+        "requests_per_sec": len(ok) / elapsed,
+        "items_per_sec": len(ok) * batch_size / elapsed,
+        "latency_ms": {
+            name: float(np.percentile(latencies, q)) if len(ok) > 0 else None
+            for name, q in [("p50", 50), ("p95", 95), ("p99", 99)]
+        },
+        "peak_rss_mb": sampler.peak_mb,
+        "stages": stage_summary(before, after),
+    }
+
+
+def run_key(result: dict) -> Tuple[str, int, int]:
+    return result["scenario"], result["concurrency"], result["batch_size"]
+
+
+def format_ms(value: float | None) -> str:
+    return f"{value:.1f}" if value is not None else "-"
+
+
+def print_results(results: List[dict]):
+    rows = []
+    for result in results:
+        stages = " ".join(
+            f"{stage}={summary['mean_ms']:.1f}"
+            for stage, summary in result["stages"].items()
+        )
+        stage_growths = " ".join(
+            f"{stage}={summary['rss_growth_mb']:.1f}"
+            for stage, summary in result["stages"].items()
+            if summary.get("rss_growth_mb", None) is not None
+        )
+        rows.append(
+            [
+                result["scenario"],
+                result["concurrency"],
+                result["batch_size"],
+                f"{result['items_per_sec']:.1f}",
+                format_ms(result["latency_ms"]["p50"]),
+                format_ms(result["latency_ms"]["p95"]),
+                format_ms(result["latency_ms"]["p99"]),
+                format_ms(result["peak_rss_mb"]),
+                result["failed_requests"] + result["item_errors"],
+                stages,
+                stage_growths or "-",
+            ]
+        )
+    headers = [
+        "Scenario",
+        "Clients",
+        "Batch",
+        "Items/sec",
+        "p50 ms",
+        "p95 ms",
+        "p99 ms",
+        "Peak RSS MB",
+        "Errors",
+        "Mean stage ms",
+        "Stage RSS growth MB",
+    ]
+    print(tabulate(rows, headers=headers, tablefmt=TabulateLevels.PRIMARY.value))
+
+
+def print_comparison(results: List[dict], baseline: List[dict]):
+    baseline_runs = {run_key(result): result for result in baseline}
+    rows = []
+    for result in results:
+        previous = baseline_runs.get(run_key(result))
+        if previous is None:
+            continue
+        p99 = result["latency_ms"]["p99"]
+        previous_p99 = previous["latency_ms"]["p99"]
+        rows.append(
+            [
+                *run_key(result),
+                f"{result['items_per_sec'] / previous['items_per_sec']:.2f}x",
+                (
+                    f"{(p99 - previous_p99) / previous_p99 * 100:+.1f}%"
+                    if p99 is not None and previous_p99
+                    else "-"
+                ),
+                (
+                    f"{result['peak_rss_mb'] - previous['peak_rss_mb']:+.0f}"
+                    if result["peak_rss_mb"] and previous["peak_rss_mb"]
+                    else "-"
+                ),
+            ]
+        )
+    headers = ["Scenario", "Clients", "Batch", "Throughput", "p99", "Peak RSS MB"]
+    print(tabulate(rows, headers=headers, tablefmt=TabulateLevels.PRIMARY.value))
+
+
+def wait_until_healthy(api_base: str, process, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not process.is_alive():
+            raise RuntimeError("The API process exited before it was healthy")
+        try:
+            if requests.get(f"{api_base}/health", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError(f"The API wasn't healthy within {timeout} sec.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS
+    )
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 16])
+    parser.add_argument("--requests", type=int, default=50, help="Per run")
+    parser.add_argument(
+        "--warmup-requests", type=int, default=5, help="Per scenario, not measured"
+    )
+    parser.add_argument("--images", type=int, default=32, help="Distinct images")
+    parser.add_argument("--image-size", type=int, default=512)
+    parser.add_argument("--width", type=int, default=64, help="Of the stand-ins")
+    parser.add_argument("--layers", type=int, default=2, help="Of the stand-ins")
+    parser.add_argument("--workers", type=int, default=1, help="API processes")
+    parser.add_argument("--output", help="Writes the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)["runs"]
+
+    image_stub, image_base = start_image_stub(
+        synthetic_images(args.images, args.image_size)
+    )
+    port = free_port()
+    api_base = f"http://127.0.0.1:{port}"
+    token = uuid.uuid4().hex
+    # Read by the metrics module when it's imported in the child
+    os.environ["CLIPAPI_WORKERS"] = str(args.workers)
+    context = multiprocessing.get_context("spawn")
+    process = context.Process(
+        target=serve_stand_ins,
+        args=(port, token, args.width, args.layers, args.workers),
+        daemon=True,
+    )
+    process.start()
+    results = []
+    try:
+        wait_until_healthy(api_base, process, timeout=300)
+        for scenario in args.scenarios:
+            run(
+                api_base,
+                image_base,
+                token,
+                process.pid,
+                scenario,
+                1,
+                max(args.batch_sizes),
+                args.warmup_requests,
+            )
+            for concurrency in args.concurrency:
+                for batch_size in args.batch_sizes:
+                    results.append(
+                        run(
+                            api_base,
+                            image_base,
+                            token,
+                            process.pid,
+                            scenario,
+                            concurrency,
+                            batch_size,
+                            args.requests,
+                        )
+                    )
+    finally:
+        process.terminate()
+        process.join()
+        image_stub.shutdown()
+
+    print_results(results)
+    if baseline is not None:
+        print_comparison(results, baseline)
+    if args.output is not None:
+        import torch
+
+        output = {
+            "meta": {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "torch": torch.__version__,
+                "cpus": os.cpu_count(),
+                "args": vars(args),
+                "env": {
+                    name: value
+                    for name, value in os.environ.items()
+                    if name.startswith(
+                        (
+                            "CLIPAPI_WORKER",
+                            "MODEL_",
+                            "OPEN_CLIP_",
+                            "NSFW_",
+                            "AESTHETICS_",
+                        )
+                    )
+                },
+            },
+            "runs": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    sys.exit(1 if any(r["failed_requests"] > 0 for r in results) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,76 @@
 import os
+import socket
 import traceback
 
-from flask import Flask, request, current_app, jsonify
+from flask import Flask, request, current_app, g, jsonify
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from waitress import serve
+from werkzeug.exceptions import RequestEntityTooLarge
 
-from models.aesthetics_scorer.main import generate_aesthetic_scores
+from models.aesthetics_scorer.main import generate_aesthetic_scores_batch
 from models.nsfw_scorer.main import generate_nsfw_score
-from models.open_clip.main import (
-    embeds_of_texts,
-    embeds_of_images,
+from models.open_clip.main import embeds_of_texts, zero_shot_logits
+from models.constants import (
+    DEVICE,
+    MODEL_AESTHETICS_SCORER,
+    MODEL_NSFW_SCORER,
+    MODEL_OPEN_CLIP,
+    ModelsPack,
+    NSFWScoreResult,
 )
-from models.constants import ModelsPack, NSFWScoreResult
-from utils.helpers import download_images, is_url, time_log, timeout
+from models.loading import MODEL_DISABLED, MODEL_FAILED, MODEL_LAZY, MODEL_READY
+from servers.formats import embeddings_response, negotiate_format
+from servers.inputs import (
+    CLIPAPI_MAX_BODY_BYTES,
+    InMemoryRequest,
+    embedding_of,
+    get_request_deadline,
+    get_request_items,
+    has_image,
+    image_source_of,
+    labels_of,
+    score_filter_of,
+    scores_of,
+    search_k_of,
+    text_of,
+)
+from servers.pipeline import (
+    DEADLINE_EXCEEDED,
+    ImageSource,
+    run_image_pipeline,
+    store_images,
+)
+from utils.admission import AdmissionRejected, admission_controller
+from utils.fetcher import image_fetcher
+from utils.helpers import is_true, is_url, time_log
+from utils.image_store import ImageRecord
+from utils.logger import ITEM_LOG
+from utils.memory import memory_stats
+from utils.vector_index import SearchMatch, VectorIndexFull
+from utils.metrics import (
+    ITEM_ERRORS,
+    ITEMS,
+    REQUESTS_REJECTED,
+    STAGE_SEARCH,
+    STAGE_SERIALIZATION,
+    STAGE_ZERO_SHOT,
+    metrics_registry,
+    register_cache_stats,
+    stage_timer,
+)
+import numpy as np
+import torch
 import time
 import logging
-from typing import List
+from typing import Dict, List, Tuple
 from dotenv import load_dotenv
 
 load_dotenv()
 
 clipapi = Flask(__name__)
+clipapi.request_class = InMemoryRequest
+clipapi.config["MAX_CONTENT_LENGTH"] = CLIPAPI_MAX_BODY_BYTES
+clipapi.config["MAX_FORM_MEMORY_SIZE"] = CLIPAPI_MAX_BODY_BYTES
 
 
 class ObjectForEmbedding:
@@ -33,40 +84,276 @@ def root():
     return "OK", 200
 
 
-@clipapi.route("/health", methods=["GET"])
-def health():
-    return "OK", 200
+# Seconds a client should wait before retrying while a model is still loading
+MODEL_LOADING_RETRY_AFTER = 5
 
 
-@clipapi.route("/embed", methods=["POST"])
-def clip_embed():
-    s = time.time()
+@clipapi.route("/health", methods=["GET"])
+def health():
+    """
+    Ready once any model this replica serves is ready or lazy, routes whose
+    models are still loading answer 503 with Retry-After meanwhile. With
+    `?model=open_clip,nsfw_scorer` it's ready only once all of those are.
+    """
     with current_app.app_context():
         models_pack: ModelsPack = current_app.models_pack
+    models = models_pack.status()
+    serving = [MODEL_READY, MODEL_LAZY]
+    names = request.args.get("model", None)
+    if names is not None:
+        names = [name.strip() for name in names.split(",") if name.strip() != ""]
+        for name in names or [""]:
+            if name not in models:
+                return f"Invalid model: {name}, should be one of {list(models)}", 400
+        loaded = all(models[name]["state"] in serving for name in names)
+    else:
+        enabled = [
+            model["state"]
+            for model in models.values()
+            if model["state"] != MODEL_DISABLED
+        ]
+        loaded = len(enabled) < 1 or any(state in serving for state in enabled)
+    # Takes the pod out of rotation while it's shedding load
+    saturated = admission_controller.is_saturated()
+    ok = loaded and not saturated
+    body = {"status": "ok" if ok else "unavailable", "overloaded": saturated}
+    body["models"] = {name: model["state"] for name, model in models.items()}
+    return jsonify(body), 200 if ok else 503
+
+
+def require_models(
+    models_pack: ModelsPack, names: List[str], deadline: float, log_prefix: str
+):
+    """
+    Waits until the request's models are loaded, starting the lazy ones, or
+    returns the response for a model that's disabled, failed or not up in time.
+    """
+    for name in names:
+        slot = models_pack.slots[name]
+        if slot.wait(max(deadline - time.monotonic(), 0)):
+            continue
+        state = slot.state
+        logging.warning(f"{log_prefix} 🔴 {name} is {state}")
+        REQUESTS_REJECTED.labels(request.path, f"{name}_{state}").inc()
+        if state == MODEL_DISABLED:
+            return f"{name} isn't served by this replica", 503
+        if state == MODEL_FAILED:
+            return f"{name} failed to load", 503
+        retry_after = {"Retry-After": str(MODEL_LOADING_RETRY_AFTER)}
+        return f"{name} is {state}", 503, retry_after
+    return None
+
+
+def admit(items: int, log_prefix: str):
+    """Admits the request's items, or returns the response that sheds the request."""
+    try:
+        g.admission_ticket = admission_controller.admit(items)
+    except AdmissionRejected as e:
+        logging.warning(f"{log_prefix} 🔴 Rejected {items} item(s): {e.reason}")
+        REQUESTS_REJECTED.labels(request.path, "overloaded").inc()
+        return e.reason, 503, {"Retry-After": str(e.retry_after)}
+    return None
+
+
+@clipapi.teardown_request
+def release_admission(exception):
+    ticket = g.pop("admission_ticket", None)
+    if ticket is not None:
+        ticket.release()
+
+
+def count_item_error(error: str):
+    reason = "deadline" if error == DEADLINE_EXCEEDED else "failed"
+    ITEM_ERRORS.labels(request.path, reason).inc()
+
+
+def check_auth(log_prefix: str):
+    """Returns the response for a request without the right token, if it's not."""
     authheader = request.headers.get("Authorization")
     if authheader is None:
-        logging.error("📎 🔴 Unauthorized: Missing authorization header")
+        logging.error(f"{log_prefix} 🔴 Unauthorized: Missing authorization header")
         return "Unauthorized", 401
     if authheader != os.environ["CLIPAPI_AUTH_TOKEN"]:
         logging.error(
-            f"📎 🔴 Unauthorized: Invalid authorization header: {authheader[:3]}...",
+            f"{log_prefix} 🔴 Unauthorized: Invalid authorization header: {authheader[:3]}...",
         )
         return "Unauthorized", 401
+    return None
+
 
-    req_body = None
+def read_body(log_prefix: str):
+    """Returns the parsed request body, or the response if it can't be read."""
     try:
-        req_body = request.get_json()
+        req_body = get_request_items(request)
+    except RequestEntityTooLarge:
+        logging.error(f"{log_prefix} 🔴 Request body is too large")
+        return None, ("Request body is too large", 413)
     except Exception as e:
         tb = traceback.format_exc()
-        logging.info(f"📎 🔴 Error parsing request body: {tb}\n")
+        logging.info(f"{log_prefix} 🔴 Error parsing request body: {tb}\n")
+        return None, (str(e), 400)
+    if req_body is None:
+        logging.error(f"{log_prefix} 🔴 Missing request body")
+        return None, ("Missing request body", 400)
+    return req_body, None
+
+
+def read_items(log_prefix: str):
+    """Returns the items of the request body, or the response if it isn't an array."""
+    req_body, invalid = read_body(log_prefix)
+    if invalid is not None:
+        return None, invalid
+    if isinstance(req_body, list) is not True:
+        logging.error(f"{log_prefix} 🔴 Body should be an array")
+        return None, ("Body should be an array", 400)
+    return req_body, None
+
+
+@clipapi.route("/metrics", methods=["GET"])
+def metrics():
+    return (
+        generate_latest(metrics_registry()),
+        200,
+        {"Content-Type": CONTENT_TYPE_LATEST},
+    )
+
+
+@clipapi.route("/stats", methods=["GET"])
+def stats():
+    with current_app.app_context():
+        models_pack: ModelsPack = current_app.models_pack
+    open_clip = models_pack.slots[MODEL_OPEN_CLIP].peek()
+    text_cache = open_clip.text_cache if open_clip is not None else None
+    label_cache = open_clip.label_cache if open_clip is not None else None
+    image_store = models_pack.image_store
+    return jsonify(
+        {
+            "models": models_pack.status(),
+            "memory": memory_stats(),
+            "text_cache": text_cache.stats() if text_cache is not None else None,
+            "label_cache": label_cache.stats() if label_cache is not None else None,
+            "image_store": image_store.stats() if image_store is not None else None,
+            "vector_index": (
+                models_pack.vector_index.stats()
+                if models_pack.vector_index is not None
+                else None
+            ),
+            "fetcher": image_fetcher.stats(),
+            "admission": admission_controller.stats(),
+        }
+    )
+
+
+def process_images(
+    image_sources: List[ImageSource],
+    wants_score: List[bool],
+    wants_nsfw: List[bool],
+    models_pack: ModelsPack,
+    deadline: float,
+    log_prefix: str,
+) -> Tuple[List[ImageRecord], Dict[int, str]]:
+    """
+    Embeds the images and scores the ones `wants_score` and `wants_nsfw` ask
+    for, reading and updating the image store. Returns a record per image, and
+    the errors of the ones that failed by index.
+    """
+
+    def is_complete(record: ImageRecord | None, i: int) -> bool:
+        return (
+            record is not None
+            and record.embedding is not None
+            and (not wants_score[i] or record.rating_score is not None)
+            and (not wants_nsfw[i] or record.nsfw_score is not None)
+        )
+
+    records, pil_images, pooler_outputs, errors = run_image_pipeline(
+        image_sources, is_complete, models_pack, deadline
+    )
+
+    # Aesthetic scores for all the images that need them in one pass
+    to_score = [
+        i
+        for i, record in enumerate(records)
+        if i not in errors and wants_score[i] and record.rating_score is None
+    ]
+    if len(to_score) > 0:
+        s_aes = time.time()
+        pooler_output = torch.stack(
+            [
+                (
+                    pooler_outputs[i]
+                    if i in pooler_outputs
+                    else torch.from_numpy(records[i].pooler_output).to(DEVICE)
+                )
+                for i in to_score
+            ]
+        )
+        scores = generate_aesthetic_scores_batch(
+            pooler_outputs=pooler_output,
+            aesthetics_scorer=models_pack.aesthetics_scorer,
+        )
+        for i, score in zip(to_score, scores):
+            records[i].rating_score = score.rating_score
+            records[i].artifact_score = score.artifact_score
+            logging.info(
+                f"🎨 Image {i+1} | Rating Score: {score.rating_score:.2f} | Artifact Score: {score.artifact_score:.2f}",
+                extra=ITEM_LOG,
+            )
+        e_aes = time.time()
+        logging.info(
+            f"🎨 Scored {len(to_score)} image(s) in: {(e_aes - s_aes)*1000:.0f} ms"
+        )
+
+    # NSFW scores for all the flagged images in one pass
+    to_check = [
+        i
+        for i, record in enumerate(records)
+        if i not in errors and wants_nsfw[i] and record.nsfw_score is None
+    ]
+    if len(to_check) > 0:
+        try:
+            with time_log(
+                f"{log_prefix} Calculated NSFW score for {len(to_check)} image(s)"
+            ):
+                nsfw_results = generate_nsfw_score(
+                    images=[pil_images[i] for i in to_check],
+                    nsfw_scorer=models_pack.nsfw_scorer,
+                )
+                for i, result in zip(to_check, nsfw_results):
+                    records[i].nsfw_score = result.nsfw_score
+        except Exception as e:
+            tb = traceback.format_exc()
+            logging.info(f"{log_prefix} 🔴 Failed to calculate NSFW score: {tb}\n")
+            for i in to_check:
+                errors[i] = str(e)
+
+    store_images(
+        records,
+        image_sources,
+        pil_images,
+        pooler_outputs,
+        models_pack.image_store,
+    )
+    return records, errors
+
+
+@clipapi.route("/embed", methods=["POST"])
+def clip_embed():
+    s = time.time()
+    with current_app.app_context():
+        models_pack: ModelsPack = current_app.models_pack
+    unauthorized = check_auth("📎")
+    if unauthorized is not None:
+        return unauthorized
+    try:
+        deadline = get_request_deadline(request)
+    except ValueError as e:
+        logging.error(f"📎 🔴 {e}")
         return str(e), 400
-    finally:
-        if req_body is None:
-            logging.error("📎 🔴 Missing request body")
-            return "Missing request body", 400
-        if isinstance(req_body, list) is not True:
-            logging.error("📎 🔴 Body should be an array")
-            return "Body should be an array", 400
+
+    req_body, invalid = read_items("📎")
+    if invalid is not None:
+        return invalid
 
     logging.info(f"📎 🔵 Received {len(req_body)} item(s) for embedding")
     embeds = [None for _ in range(len(req_body))]
@@ -75,16 +362,45 @@ def clip_embed():
     for index, item in enumerate(req_body):
         if "text" in item:
             text_objects.append(ObjectForEmbedding(item, index))
-        if "image" in item:
+        if has_image(item):
             image_objects.append(ObjectForEmbedding(item, index))
 
-    if len(text_objects) > 0:
-        texts = [obj.item["text"] for obj in text_objects]
-        text_embeds = embeds_of_texts(
-            texts,
-            models_pack.open_clip.model,
-            models_pack.open_clip.tokenizer,
+    try:
+        texts = [text_of(obj.item) for obj in text_objects]
+        image_sources = [
+            image_source_of(obj.item, request.files) for obj in image_objects
+        ]
+    except ValueError as e:
+        logging.error(f"📎 🔴 {e}")
+        return str(e), 400
+
+    needed = [MODEL_OPEN_CLIP]
+    if any(is_true(obj.item.get("calculate_score")) for obj in image_objects):
+        needed.append(MODEL_AESTHETICS_SCORER)
+    if any(is_true(obj.item.get("check_nsfw")) for obj in image_objects):
+        needed.append(MODEL_NSFW_SCORER)
+    unavailable = require_models(models_pack, needed, deadline, "📎")
+    if unavailable is not None:
+        return unavailable
+
+    try:
+        response_format = negotiate_format(
+            request,
+            models_pack.open_clip.model.config.projection_dim,
+            models_pack.projections,
         )
+    except ValueError as e:
+        logging.error(f"📎 🔴 {e}")
+        return str(e), 400
+
+    rejected = admit(len(text_objects) + len(image_objects), "📎")
+    if rejected is not None:
+        return rejected
+    ITEMS.labels(request.path, "text").inc(len(text_objects))
+    ITEMS.labels(request.path, "image").inc(len(image_objects))
+
+    if len(text_objects) > 0:
+        text_embeds = embeds_of_texts(texts, models_pack.open_clip)
         for i, embed in enumerate(text_embeds):
             item = text_objects[i].item
             index = text_objects[i].index
@@ -95,78 +411,50 @@ def clip_embed():
             embeds[index] = obj
 
     if len(image_objects) > 0:
-        image_urls = []
-        pil_images = []
-        nsfw_scores = []
-        for obj in image_objects:
-            image_urls.append(obj.item["image"])
+        wants_score = [is_true(obj.item.get("calculate_score")) for obj in image_objects]
+        wants_nsfw = [is_true(obj.item.get("check_nsfw")) for obj in image_objects]
         try:
-            with time_log(f"📎 Downloaded {len(image_urls)} image(s)"):
-                pil_images = download_images(urls=image_urls, max_workers=25)
+            records, errors = process_images(
+                image_sources, wants_score, wants_nsfw, models_pack, deadline, "📎"
+            )
         except Exception as e:
             tb = traceback.format_exc()
-            logging.info(f"📎 🔴 Failed to download images: {tb}\n")
+            logging.info(f"📎 🔴 Failed to process images: {tb}\n")
             return str(e), 500
-        image_embeds, vision_output = embeds_of_images(
-            pil_images,
-            models_pack.open_clip.model,
-        )
-        for i, embed in enumerate(image_embeds):
+
+        for i, record in enumerate(records):
             item = image_objects[i].item
             index = image_objects[i].index
             id = item.get("id", None)
-            obj = {"input_image": image_urls[i], "embedding": embed}
+            if i in errors:
+                count_item_error(errors[i])
+                obj = {"input_image": image_sources[i].url, "error": errors[i]}
+                if id is not None:
+                    obj["id"] = id
+                embeds[index] = obj
+                continue
+            obj = {"input_image": image_sources[i].url, "embedding": record.embedding}
             if id is not None:
                 obj["id"] = id
 
-            # Calculate score if needed
-            if "calculate_score" in item and (
-                item["calculate_score"] is True
-                or item["calculate_score"] == "true"
-                or item["calculate_score"] == "True"
-            ):
-                s_aes = time.time()
-                pooler_output = vision_output.pooler_output[i].unsqueeze(0)
-                score = generate_aesthetic_scores(
-                    image=pil_images[i],
-                    aesthetics_scorer=models_pack.aesthetics_scorer,
-                    clip=models_pack.open_clip,
-                    pooler_output=pooler_output,
-                )
+            if wants_score[i]:
                 obj["aesthetic_score"] = {
-                    "rating": score.rating_score,
-                    "artifact": score.artifact_score,
+                    "rating": record.rating_score,
+                    "artifact": record.artifact_score,
                 }
-                e_aes = time.time()
-                logging.info(
-                    f"🎨 Image {i+1} | Duration: {(e_aes - s_aes)*1000 :.0f} ms | Rating Score: {score.rating_score:.2f} | Artifact Score: {score.artifact_score:.2f}"
-                )
-            if "check_nsfw" in item and (
-                item["check_nsfw"] is True
-                or item["check_nsfw"] == "true"
-                or item["check_nsfw"] == "True"
-            ):
-                nsfw_score = None
-                try:
-                    with time_log(f"📎 Calculated NSFW score for image {i+1}"):
-                        nsfw_result = generate_nsfw_score(
-                            images=[pil_images[i]],
-                            nsfw_scorer=models_pack.nsfw_scorer,
-                        )
-                        nsfw_score = nsfw_result[0].nsfw_score
-                except Exception as e:
-                    tb = traceback.format_exc()
-                    logging.info(f"📎 🔴 Failed to calculate NSFW score: {tb}\n")
-                    return str(e), 500
+
+            if wants_nsfw[i]:
                 obj["nsfw_score"] = {
-                    "nsfw": nsfw_score,
+                    "nsfw": record.nsfw_score,
                 }
 
             embeds[index] = obj
 
+    with stage_timer(STAGE_SERIALIZATION):
+        response = embeddings_response(embeds, response_format)
     e = time.time()
     logging.info(f"📎 ✅ Responded for {len(req_body)} item(s) in: {(e-s)*1000:.0f} ms")
-    return jsonify({"embeddings": embeds})
+    return response
 
 
 @clipapi.route("/nsfw-check", methods=["POST"])
@@ -174,73 +462,96 @@ def nsfw_check():
     s = time.time()
     with current_app.app_context():
         models_pack: ModelsPack = current_app.models_pack
-    authheader = request.headers.get("Authorization")
-    if authheader is None:
-        logging.error("📎 👙 🔴 Unauthorized: Missing authorization header")
-        return "Unauthorized", 401
-    if authheader != os.environ["CLIPAPI_AUTH_TOKEN"]:
-        logging.error(
-            f"📎 👙 🔴 Unauthorized: Invalid authorization header: {authheader[:3]}...",
-        )
-        return "Unauthorized", 401
-
-    req_body = None
+    unauthorized = check_auth("📎 👙")
+    if unauthorized is not None:
+        return unauthorized
     try:
-        req_body = request.get_json()
-    except Exception as e:
-        tb = traceback.format_exc()
-        logging.info(f"📎 👙 🔴 Error parsing request body: {tb}\n")
+        deadline = get_request_deadline(request)
+    except ValueError as e:
+        logging.error(f"📎 👙 🔴 {e}")
         return str(e), 400
-    finally:
-        if req_body is None:
-            logging.error("📎 👙 🔴 Missing request body")
-            return "Missing request body", 400
-        if isinstance(req_body, list) is not True:
-            logging.error("📎 👙 🔴 Body should be an array")
-            return "Body should be an array", 400
+
+    req_body, invalid = read_items("📎 👙")
+    if invalid is not None:
+        return invalid
 
     logging.info(f"📎 👙 🔵 Received {len(req_body)} item(s) for NSFW check")
 
-    image_urls = []
-    pil_images = []
-    nsfw_scores: List[NSFWScoreResult] = []
+    image_sources: List[ImageSource] = []
+
+    for index, maybe_image in enumerate(req_body):
+        if isinstance(maybe_image, str) and is_url(maybe_image) is not True:
+            logging.error(f"📎 👙 🔴 Invalid URL: {maybe_image}")
+            return f"Invalid URL: {maybe_image}", 400
+        try:
+            image_sources.append(image_source_of(maybe_image, request.files))
+        except ValueError as e:
+            logging.error(f"📎 👙 🔴 {e}")
+            return str(e), 400
+
+    if len(image_sources) < 1:
+        logging.error("📎 👙 🔴 No images found in the request body")
+        return "No images found in the request body", 400
 
-    for index, maybe_image_url in enumerate(req_body):
-        if is_url(maybe_image_url) is not True:
-            logging.error(f"📎 👙 🔴 Invalid URL: {maybe_image_url}")
-            return f"Invalid URL: {maybe_image_url}", 400
-        image_urls.append(maybe_image_url)
+    unavailable = require_models(models_pack, [MODEL_NSFW_SCORER], deadline, "📎 👙")
+    if unavailable is not None:
+        return unavailable
 
-    if len(image_urls) < 1:
-        logging.error("📎 👙 🔴 No image URLs found in the request body")
-        return "No image URLs found in the request body", 400
+    rejected = admit(len(image_sources), "📎 👙")
+    if rejected is not None:
+        return rejected
+    ITEMS.labels(request.path, "image").inc(len(image_sources))
 
     try:
-        with time_log(f"📎 👙 Downloaded {len(image_urls)} image(s)"):
-            pil_images = download_images(urls=image_urls, max_workers=25)
+        records, pil_images, _, errors = run_image_pipeline(
+            image_sources,
+            lambda record, i: record is not None and record.nsfw_score is not None,
+            models_pack,
+            deadline,
+            embed=False,
+            log_prefix="📎 👙",
+        )
     except Exception as e:
         tb = traceback.format_exc()
         logging.info(f"📎 👙 🔴 Failed to download images: {tb}\n")
         return str(e), 500
 
-    m = time.time()
-    nsfw_scores = generate_nsfw_score(
-        images=pil_images,
-        nsfw_scorer=models_pack.nsfw_scorer,
-    )
-    n = time.time()
-    logging.info(
-        f"📎 👙 🟢  Calculated NSFW score for {len(image_urls)} image(s) in: {(n-m)*1000:.0f} ms"
-    )
+    to_score = [i for i, pil_image in enumerate(pil_images) if pil_image is not None]
+    if len(to_score) > 0:
+        m = time.time()
+        try:
+            nsfw_results = generate_nsfw_score(
+                images=[pil_images[i] for i in to_score],
+                nsfw_scorer=models_pack.nsfw_scorer,
+            )
+            for i, result in zip(to_score, nsfw_results):
+                records[i].nsfw_score = result.nsfw_score
+            n = time.time()
+            logging.info(
+                f"📎 👙 🟢  Calculated NSFW score for {len(to_score)} image(s) in: {(n-m)*1000:.0f} ms"
+            )
+            store_images(
+                records, image_sources, pil_images, {}, models_pack.image_store
+            )
+        except Exception as e:
+            tb = traceback.format_exc()
+            logging.info(f"📎 👙 🔴 Failed to calculate NSFW score: {tb}\n")
+            for i in to_score:
+                errors[i] = str(e)
 
     response = []
-    for i, score in enumerate(nsfw_scores):
+    for i, record in enumerate(records):
+        if i in errors:
+            count_item_error(errors[i])
+            response.append({"input": image_sources[i].url, "error": errors[i]})
+            continue
+        score = NSFWScoreResult(nsfw_score=record.nsfw_score)
         nsfw_score_obj = {
             "nsfw": score.nsfw_score,
         }
         response.append(
             {
-                "input": image_urls[i],
+                "input": image_sources[i].url,
                 "nsfw_score": nsfw_score_obj,
             }
         )
@@ -249,15 +560,405 @@ def nsfw_check():
     logging.info(
         f"📎 👙 ✅ Responded for {len(req_body)} item(s) in: {(e-s)*1000:.0f} ms"
     )
-    return jsonify({"data": response})
+    with stage_timer(STAGE_SERIALIZATION):
+        body = jsonify({"data": response})
+    return body
+
+
+def vectors_of_items(
+    items: List[dict], models_pack: ModelsPack, deadline: float, log_prefix: str
+):
+    """
+    Reads or computes the vector of every `/index/upsert` and `/search` item:
+    its "embedding", or the embedding of its "text" or its image. Images with
+    "calculate_score" or "check_nsfw" are scored too. Returns the vectors, their
+    scores and the errors of the items that failed, by index, or the response
+    for a request that can't be served.
+    """
+    vectors: Dict[int, np.ndarray] = {}
+    scores: Dict[int, dict] = {}
+    errors: Dict[int, str] = {}
+    texts: List[ObjectForEmbedding] = []
+    images: List[ObjectForEmbedding] = []
+    try:
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                raise ValueError(f"Invalid item: {item}")
+            embedding = embedding_of(item)
+            if embedding is not None:
+                vectors[index] = embedding
+            elif "text" in item:
+                text_of(item)
+                texts.append(ObjectForEmbedding(item, index))
+            elif has_image(item):
+                images.append(ObjectForEmbedding(item, index))
+            else:
+                raise ValueError("Item should have an embedding, a text or an image")
+        image_sources = [image_source_of(obj.item, request.files) for obj in images]
+    except ValueError as e:
+        logging.error(f"{log_prefix} 🔴 {e}")
+        return None, (str(e), 400)
+
+    wants_score = [is_true(obj.item.get("calculate_score")) for obj in images]
+    wants_nsfw = [is_true(obj.item.get("check_nsfw")) for obj in images]
+    needed = [MODEL_OPEN_CLIP] if len(texts) + len(images) > 0 else []
+    if any(wants_score):
+        needed.append(MODEL_AESTHETICS_SCORER)
+    if any(wants_nsfw):
+        needed.append(MODEL_NSFW_SCORER)
+    unavailable = require_models(models_pack, needed, deadline, log_prefix)
+    if unavailable is not None:
+        return None, unavailable
+
+    rejected = admit(len(items), log_prefix)
+    if rejected is not None:
+        return None, rejected
+    ITEMS.labels(request.path, "embedding").inc(len(vectors))
+    ITEMS.labels(request.path, "text").inc(len(texts))
+    ITEMS.labels(request.path, "image").inc(len(images))
+
+    if len(texts) > 0:
+        text_embeds = embeds_of_texts(
+            [obj.item["text"] for obj in texts], models_pack.open_clip
+        )
+        for obj, embed in zip(texts, text_embeds):
+            vectors[obj.index] = embed
+
+    if len(images) > 0:
+        try:
+            records, image_errors = process_images(
+                image_sources,
+                wants_score,
+                wants_nsfw,
+                models_pack,
+                deadline,
+                log_prefix,
+            )
+        except Exception as e:
+            tb = traceback.format_exc()
+            logging.info(f"{log_prefix} 🔴 Failed to process images: {tb}\n")
+            return None, (str(e), 500)
+        for i, record in enumerate(records):
+            index = images[i].index
+            if i in image_errors:
+                count_item_error(image_errors[i])
+                errors[index] = image_errors[i]
+                continue
+            vectors[index] = record.embedding
+            scores[index] = {
+                "rating_score": record.rating_score,
+                "artifact_score": record.artifact_score,
+                "nsfw_score": record.nsfw_score,
+            }
+    return (vectors, scores, errors), None
+
+
+def match_response(match: SearchMatch) -> dict:
+    obj = {"id": match.id, "score": match.score}
+    if match.rating_score is not None or match.artifact_score is not None:
+        obj["aesthetic_score"] = {
+            "rating": match.rating_score,
+            "artifact": match.artifact_score,
+        }
+    if match.nsfw_score is not None:
+        obj["nsfw_score"] = {"nsfw": match.nsfw_score}
+    return obj
+
+
+@clipapi.route("/index/upsert", methods=["POST"])
+def index_upsert():
+    s = time.time()
+    with current_app.app_context():
+        models_pack: ModelsPack = current_app.models_pack
+    unauthorized = check_auth("📎 🔎")
+    if unauthorized is not None:
+        return unauthorized
+    try:
+        deadline = get_request_deadline(request)
+    except ValueError as e:
+        logging.error(f"📎 🔎 🔴 {e}")
+        return str(e), 400
+    vector_index = models_pack.vector_index
+    if vector_index is None:
+        return "The vector index isn't enabled on this replica", 503
+
+    req_body, invalid = read_items("📎 🔎")
+    if invalid is not None:
+        return invalid
+    try:
+        for item in req_body:
+            if not isinstance(item, dict) or not isinstance(item.get("id"), str):
+                raise ValueError("Every item should have a string id")
+        item_scores = [scores_of(item) for item in req_body]
+    except ValueError as e:
+        logging.error(f"📎 🔎 🔴 {e}")
+        return str(e), 400
+    logging.info(f"📎 🔎 🔵 Received {len(req_body)} item(s) to index")
+
+    vectors, unavailable = vectors_of_items(req_body, models_pack, deadline, "📎 🔎")
+    if unavailable is not None:
+        return unavailable
+    vectors, scores, errors = vectors
+
+    response = []
+    for index, item in enumerate(req_body):
+        if index not in errors:
+            try:
+                # Scores sent with the item win over the ones computed here
+                vector_index.upsert(
+                    item["id"],
+                    vectors[index],
+                    **{**scores.get(index, {}), **item_scores[index]},
+                )
+            except (ValueError, VectorIndexFull) as e:
+                errors[index] = str(e)
+        obj = {"id": item["id"]}
+        if index in errors:
+            obj["error"] = errors[index]
+        response.append(obj)
+
+    e = time.time()
+    logging.info(
+        f"📎 🔎 ✅ Indexed {len(req_body) - len(errors)} item(s) in: {(e-s)*1000:.0f} ms"
+    )
+    with stage_timer(STAGE_SERIALIZATION):
+        body = jsonify({"items": response, "vectors": len(vector_index)})
+    return body
+
 
+@clipapi.route("/index/delete", methods=["POST"])
+def index_delete():
+    with current_app.app_context():
+        models_pack: ModelsPack = current_app.models_pack
+    unauthorized = check_auth("📎 🔎")
+    if unauthorized is not None:
+        return unauthorized
+    vector_index = models_pack.vector_index
+    if vector_index is None:
+        return "The vector index isn't enabled on this replica", 503
+
+    req_body, invalid = read_items("📎 🔎")
+    if invalid is not None:
+        return invalid
+    try:
+        if not all(isinstance(id, str) for id in req_body):
+            raise ValueError("Body should be an array of ids")
+        deleted = sum(1 for id in req_body if vector_index.delete(id))
+    except ValueError as e:
+        logging.error(f"📎 🔎 🔴 {e}")
+        return str(e), 400
+    logging.info(f"📎 🔎 ✅ Deleted {deleted} of {len(req_body)} item(s)")
+    return jsonify({"deleted": deleted, "vectors": len(vector_index)})
 
-def run_clipapi(models_pack: ModelsPack):
+
+@clipapi.route("/search", methods=["POST"])
+def search():
+    s = time.time()
+    with current_app.app_context():
+        models_pack: ModelsPack = current_app.models_pack
+    unauthorized = check_auth("📎 🔎")
+    if unauthorized is not None:
+        return unauthorized
+    try:
+        deadline = get_request_deadline(request)
+    except ValueError as e:
+        logging.error(f"📎 🔎 🔴 {e}")
+        return str(e), 400
+    vector_index = models_pack.vector_index
+    if vector_index is None:
+        return "The vector index isn't enabled on this replica", 503
+
+    req_body, invalid = read_items("📎 🔎")
+    if invalid is not None:
+        return invalid
+    try:
+        for item in req_body:
+            if not isinstance(item, dict):
+                raise ValueError(f"Invalid query: {item}")
+        # Queries asking for the same matches are searched together
+        groups: Dict[tuple, List[int]] = {}
+        for index, item in enumerate(req_body):
+            score_filter = score_filter_of(item)
+            key = (
+                search_k_of(item),
+                tuple(sorted(score_filter.items())),
+                is_true(item.get("exact")),
+            )
+            groups.setdefault(key, []).append(index)
+    except ValueError as e:
+        logging.error(f"📎 🔎 🔴 {e}")
+        return str(e), 400
+    logging.info(f"📎 🔎 🔵 Received {len(req_body)} item(s) to search for")
+
+    vectors, unavailable = vectors_of_items(req_body, models_pack, deadline, "📎 🔎")
+    if unavailable is not None:
+        return unavailable
+    vectors, _, errors = vectors
+
+    results: List[dict | None] = [None for _ in req_body]
+    with stage_timer(STAGE_SEARCH):
+        for (k, score_filter, exact), indexes in groups.items():
+            indexes = [index for index in indexes if index not in errors]
+            if len(indexes) < 1:
+                continue
+            try:
+                matches = vector_index.search(
+                    np.stack([vectors[index] for index in indexes]),
+                    k,
+                    dict(score_filter),
+                    exact,
+                )
+            except ValueError as e:
+                logging.error(f"📎 🔎 🔴 {e}")
+                return str(e), 400
+            for index, query_matches in zip(indexes, matches):
+                results[index] = {
+                    "matches": [match_response(match) for match in query_matches]
+                }
+    for index, error in errors.items():
+        results[index] = {"error": error}
+    for index, item in enumerate(req_body):
+        if "id" in item:
+            results[index]["id"] = item["id"]
+
+    e = time.time()
+    logging.info(
+        f"📎 🔎 ✅ Searched for {len(req_body)} item(s) in: {(e-s)*1000:.0f} ms"
+    )
+    with stage_timer(STAGE_SERIALIZATION):
+        body = jsonify({"results": results})
+    return body
+
+
+# Scores images against candidate labels, `{"labels": [...], "images": [...]}`
+# with the images in any of the shapes `/embed` takes. Answers with a row of
+# probabilities per image, or of logits with `"logits": true`, instead of the
+# embeddings themselves
+@clipapi.route("/zero-shot", methods=["POST"])
+def zero_shot():
+    s = time.time()
+    with current_app.app_context():
+        models_pack: ModelsPack = current_app.models_pack
+    unauthorized = check_auth("📎 🏷️")
+    if unauthorized is not None:
+        return unauthorized
+    try:
+        deadline = get_request_deadline(request)
+    except ValueError as e:
+        logging.error(f"📎 🏷️ 🔴 {e}")
+        return str(e), 400
+
+    req_body, invalid = read_body("📎 🏷️")
+    if invalid is not None:
+        return invalid
+    try:
+        if not isinstance(req_body, dict):
+            raise ValueError("Body should be an object with labels and images")
+        labels = labels_of(req_body)
+        images = req_body.get("images", None)
+        if not isinstance(images, list) or len(images) < 1:
+            raise ValueError("images should be a non-empty array")
+        image_sources = [image_source_of(item, request.files) for item in images]
+    except ValueError as e:
+        logging.error(f"📎 🏷️ 🔴 {e}")
+        return str(e), 400
+    wants_logits = is_true(req_body.get("logits"))
+    logging.info(
+        f"📎 🏷️ 🔵 Received {len(images)} image(s) to score against {len(labels)} label(s)"
+    )
+
+    unavailable = require_models(models_pack, [MODEL_OPEN_CLIP], deadline, "📎 🏷️")
+    if unavailable is not None:
+        return unavailable
+    rejected = admit(len(images), "📎 🏷️")
+    if rejected is not None:
+        return rejected
+    ITEMS.labels(request.path, "image").inc(len(images))
+    ITEMS.labels(request.path, "label").inc(len(labels))
+
+    try:
+        records, errors = process_images(
+            image_sources,
+            [False] * len(images),
+            [False] * len(images),
+            models_pack,
+            deadline,
+            "📎 🏷️",
+        )
+    except Exception as e:
+        tb = traceback.format_exc()
+        logging.info(f"📎 🏷️ 🔴 Failed to process images: {tb}\n")
+        return str(e), 500
+
+    scored = [i for i in range(len(records)) if i not in errors]
+    rows: Dict[int, List[float]] = {}
+    if len(scored) > 0:
+        with stage_timer(STAGE_ZERO_SHOT):
+            logits = zero_shot_logits(
+                np.stack([records[i].embedding for i in scored]),
+                labels,
+                models_pack.open_clip,
+            )
+            if not wants_logits:
+                logits = torch.softmax(torch.from_numpy(logits), dim=1).numpy()
+        rows = dict(zip(scored, logits.tolist()))
+
+    response = []
+    for i, item in enumerate(images):
+        obj = {"input_image": image_sources[i].url}
+        if isinstance(item, dict) and "id" in item:
+            obj["id"] = item["id"]
+        if i in errors:
+            count_item_error(errors[i])
+            obj["error"] = errors[i]
+        else:
+            obj["logits" if wants_logits else "probs"] = rows[i]
+        response.append(obj)
+
+    e = time.time()
+    logging.info(
+        f"📎 🏷️ ✅ Scored {len(scored)} image(s) against {len(labels)} label(s) in: {(e-s)*1000:.0f} ms"
+    )
+    with stage_timer(STAGE_SERIALIZATION):
+        body = jsonify({"labels": labels, "data": response})
+    return body
+
+
+def run_clipapi(models_pack: ModelsPack, sockets: List[socket.socket] | None = None):
+    """Serves the API on CLIPAPI_HOST:CLIPAPI_PORT, or on already listening `sockets`."""
     host = os.environ.get("CLIPAPI_HOST", "0.0.0.0")
     port = os.environ.get("CLIPAPI_PORT", 13339)
+    threads = int(os.environ.get("CLIPAPI_THREADS", 32))
     with clipapi.app_context():
         current_app.models_pack = models_pack
+
+    def cache_stats():
+        open_clip = models_pack.slots[MODEL_OPEN_CLIP].peek()
+        text_cache = open_clip.text_cache if open_clip is not None else None
+        label_cache = open_clip.label_cache if open_clip is not None else None
+        image_store = models_pack.image_store
+        return {
+            "text_cache": text_cache.stats() if text_cache is not None else None,
+            "label_cache": label_cache.stats() if label_cache is not None else None,
+            "image_store": image_store.stats() if image_store is not None else None,
+        }
+
+    register_cache_stats(cache_stats)
     logging.info("//////////////////////////////////////////////////////////////////")
-    logging.info(f"📎 🟢 Starting CLIP API on {host}:{port}")
+    if sockets is None:
+        logging.info(f"📎 🟢 Starting CLIP API on {host}:{port}")
+        listen = {"host": host, "port": port}
+    else:
+        logging.info(f"📎 🟢 Starting CLIP API worker {os.getpid()}")
+        listen = {"sockets": sockets}
     logging.info("//////////////////////////////////////////////////////////////////")
-    serve(clipapi, host=host, port=port)
+    # Enough threads for requests to reach admission control instead of queueing
+    # inside waitress, the models themselves are serialized by their batchers
+    # Request bodies up to the max size are buffered in memory, not in temp files
+    serve(
+        clipapi,
+        **listen,
+        threads=threads,
+        max_request_body_size=CLIPAPI_MAX_BODY_BYTES,
+        inbuf_overflow=CLIPAPI_MAX_BODY_BYTES,
+    )
@@ -0,0 +1,201 @@
+import base64
+import json
+import struct
+from typing import Any, Dict, List
+
+import numpy as np
+from flask import Request, Response, jsonify
+
+from utils.helpers import is_true
+from utils.projections import Projection
+
+FORMAT_JSON = "json"
+FORMAT_BASE64 = "base64"
+FORMAT_BINARY = "binary"
+FORMAT_MSGPACK = "msgpack"
+FORMATS = [FORMAT_JSON, FORMAT_BASE64, FORMAT_BINARY, FORMAT_MSGPACK]
+
+DTYPES = {"float32": np.dtype("<f4"), "float16": np.dtype("<f2")}
+
+MIMETYPE_BINARY = "application/octet-stream"
+MIMETYPE_MSGPACK = "application/msgpack"
+ACCEPT_FORMATS = {
+    MIMETYPE_BINARY: FORMAT_BINARY,
+    MIMETYPE_MSGPACK: FORMAT_MSGPACK,
+    "application/x-msgpack": FORMAT_MSGPACK,
+}
+
+
+# float16 needs this many significant digits to be read back exactly
+FLOAT16_JSON_DIGITS = 5
+
+
+class ResponseFormat:
+    def __init__(
+        self,
+        format: str,
+        dtype: str,
+        normalize: bool = False,
+        dim: int | None = None,
+        projection: Projection | None = None,
+    ):
+        self.format = format
+        self.dtype = dtype
+        self.normalize = normalize
+        self.dim = dim
+        self.projection = projection
+
+
+def negotiate_format(
+    request: Request, embedding_dim: int, projections: Dict[str, Projection]
+) -> ResponseFormat:
+    """
+    Picks the embedding response format from the `format` query parameter, or from
+    the `Accept` header when it's not set. `dtype` selects float32 or float16,
+    `projection` one of `projections`, `dim` keeps the first values of every
+    embedding, at most as many as the model's `embedding_dim` or the projection
+    gives, and `normalize=true` scales them to unit length. Raises `ValueError`
+    for invalid values.
+    """
+    format = request.args.get("format", None)
+    if format is None:
+        best = request.accept_mimetypes.best_match(
+            ["application/json", *ACCEPT_FORMATS.keys()], default="application/json"
+        )
+        format = ACCEPT_FORMATS.get(best, FORMAT_JSON)
+    if format not in FORMATS:
+        raise ValueError(f"Invalid format: {format}, should be one of {FORMATS}")
+    dtype = request.args.get("dtype", "float32")
+    if dtype not in DTYPES:
+        raise ValueError(f"Invalid dtype: {dtype}, should be one of {list(DTYPES)}")
+    projection = request.args.get("projection", None)
+    if projection is not None:
+        if projection not in projections:
+            raise ValueError(
+                f"Invalid projection: {projection}, should be one of {list(projections)}"
+            )
+        projection = projections[projection]
+    dim = request.args.get("dim", None)
+    if dim is not None:
+        if not dim.isdigit() or int(dim) < 1:
+            raise ValueError(f"Invalid dim: {dim}, should be a positive integer")
+        dim = int(dim)
+        if projection is not None and dim > projection.matrix.shape[1]:
+            raise ValueError(
+                f"Invalid dim: {dim}, projection {projection.name} has {projection.matrix.shape[1]}"
+            )
+        if projection is None and dim > embedding_dim:
+            raise ValueError(
+                f"Invalid dim: {dim}, the embeddings have {embedding_dim}"
+            )
+    return ResponseFormat(
+        format=format,
+        dtype=dtype,
+        normalize=is_true(request.args.get("normalize", None)),
+        dim=dim,
+        projection=projection,
+    )
+
+
+def shape_embeddings(
+    embeddings: np.ndarray, response_format: ResponseFormat
+) -> np.ndarray:
+    """
+    Projects, truncates and normalizes a batch of embeddings, in that order, as
+    `response_format` asks, and converts them to its dtype.
+    """
+    if response_format.projection is not None:
+        embeddings = response_format.projection.apply(embeddings)
+    if response_format.dim is not None:
+        embeddings = embeddings[:, : response_format.dim]
+    if response_format.normalize:
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.maximum(norms, 1e-12)
+    return np.ascontiguousarray(embeddings, dtype=DTYPES[response_format.dtype])
+
+
+def _round_significant(values: np.ndarray, digits: int) -> np.ndarray:
+    """Rounds to `digits` significant digits, so the floats print that short in JSON."""
+    values = values.astype(np.float64)
+    magnitudes = np.floor(
+        np.log10(np.abs(values), out=np.zeros_like(values), where=values != 0)
+    )
+    scales = 10.0 ** (digits - 1 - magnitudes)
+    return np.round(values * scales) / scales
+
+
+def _has_embedding(obj: Dict[str, Any] | None) -> bool:
+    # Items that failed carry an "error" instead
+    return obj is not None and "embedding" in obj
+
+
+def _without_embedding(obj: Dict[str, Any] | None) -> Dict[str, Any] | None:
+    if obj is None:
+        return None
+    return {key: value for key, value in obj.items() if key != "embedding"}
+
+
+def embeddings_response(
+    embeds: List[Dict[str, Any] | None], response_format: ResponseFormat
+) -> Response:
+    """
+    Serializes the `/embed` items, whose "embedding" is a numpy vector, in the
+    negotiated format. Vectors are written straight from their numpy buffers:
+
+    - json: `{"embeddings": [{..., "embedding": [floats]}]}`, the default
+    - base64: same as json with every "embedding" a base64 string of its
+      little-endian bytes, and top-level "dtype" and "dim"
+    - msgpack: same as base64 with every "embedding" as msgpack bin
+    - binary: a little-endian uint32 byte length, then that many bytes of JSON
+      metadata `{"dtype", "dim", "count", "embeddings": [items without
+      "embedding", with "row"]}`, then `count` packed rows of `dim` values
+
+    Items without an "embedding" (the ones that failed) are passed through as is,
+    and get no "row" in the binary format. The embeddings are shaped by
+    `shape_embeddings` all at once, and in JSON, float16 ones are written with
+    just the digits float16 has.
+    """
+    rows = [i for i, obj in enumerate(embeds) if _has_embedding(obj)]
+    if len(rows) > 0:
+        embeddings = shape_embeddings(
+            np.stack([embeds[i]["embedding"] for i in rows]), response_format
+        )
+    else:
+        embeddings = np.empty((0, 0), dtype=DTYPES[response_format.dtype])
+    dim = embeddings.shape[1]
+
+    if response_format.format == FORMAT_JSON:
+        if response_format.dtype == "float16":
+            embeddings = _round_significant(embeddings, FLOAT16_JSON_DIGITS)
+        for i, embedding in zip(rows, embeddings.tolist()):
+            embeds[i]["embedding"] = embedding
+        return jsonify({"embeddings": embeds})
+
+    if response_format.format == FORMAT_BINARY:
+        items = [_without_embedding(obj) for obj in embeds]
+        for row, i in enumerate(rows):
+            items[i]["row"] = row
+        metadata = json.dumps(
+            {
+                "dtype": response_format.dtype,
+                "dim": dim,
+                "count": len(rows),
+                "embeddings": items,
+            }
+        ).encode()
+        body = struct.pack("<I", len(metadata)) + metadata + embeddings.tobytes()
+        return Response(body, mimetype=MIMETYPE_BINARY)
+
+    items = [_without_embedding(obj) for obj in embeds]
+    for i, embedding in zip(rows, embeddings):
+        embedding = embedding.tobytes()
+        if response_format.format == FORMAT_BASE64:
+            embedding = base64.b64encode(embedding).decode()
+        items[i]["embedding"] = embedding
+    payload = {"embeddings": items, "dtype": response_format.dtype, "dim": dim}
+
+    if response_format.format == FORMAT_MSGPACK:
+        import msgpack
+
+        return Response(msgpack.packb(payload), mimetype=MIMETYPE_MSGPACK)
+    return jsonify(payload)
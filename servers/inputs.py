@@ -0,0 +1,220 @@
+import base64
+import binascii
+import json
+import os
+import time
+from io import BytesIO
+from typing import List
+
+import numpy as np
+from dotenv import load_dotenv
+from flask import Request
+
+from servers.pipeline import ImageSource
+from utils.vector_index import SCORE_NAMES, ScoreFilter
+
+load_dotenv()
+
+# Same as the ingress' proxy-body-size
+CLIPAPI_MAX_BODY_BYTES = int(float(os.getenv("CLIPAPI_MAX_BODY_MB", 50)) * 1024 * 1024)
+
+IMAGE_URL_KEY = "image"
+IMAGE_BASE64_KEY = "image_base64"
+IMAGE_FILE_KEY = "image_file"
+IMAGE_KEYS = [IMAGE_URL_KEY, IMAGE_BASE64_KEY, IMAGE_FILE_KEY]
+
+MULTIPART_ITEMS_FIELD = "items"
+
+# Time budget of a request, clients can lower or raise it per request with the
+# X-Deadline-Ms header or the deadline_ms query parameter
+REQUEST_DEADLINE_MS = float(os.getenv("REQUEST_DEADLINE_MS", 30000))
+DEADLINE_HEADER = "X-Deadline-Ms"
+DEADLINE_PARAM = "deadline_ms"
+
+# Matches /search returns per query, unless the query asks for another "k"
+SEARCH_K_DEFAULT = int(os.getenv("SEARCH_K_DEFAULT", 10))
+SEARCH_K_MAX = int(os.getenv("SEARCH_K_MAX", 1000))
+EMBEDDING_KEY = "embedding"
+
+# Candidate labels a /zero-shot request may score its images against
+ZERO_SHOT_LABELS_MAX = int(os.getenv("ZERO_SHOT_LABELS_MAX", 1000))
+
+
+class InMemoryRequest(Request):
+    """Keeps multipart uploads in memory instead of spooling big ones to temp files."""
+
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        return BytesIO()
+
+
+def get_request_items(request: Request):
+    """
+    Returns the JSON body of the request. For multipart requests the JSON is read
+    from the "items" field and the image bytes from the file parts the items name.
+    """
+    if request.mimetype == "multipart/form-data":
+        items = request.form.get(MULTIPART_ITEMS_FIELD, None)
+        return json.loads(items) if items is not None else None
+    return request.get_json()
+
+
+def get_request_deadline(request: Request) -> float:
+    """
+    Returns the `time.monotonic()` value by which the request should be answered,
+    counted from now. Raises `ValueError` for a deadline that isn't a positive
+    number.
+    """
+    start = time.monotonic()
+    value = request.headers.get(DEADLINE_HEADER, None)
+    if value is None:
+        value = request.args.get(DEADLINE_PARAM, None)
+    if value is None:
+        return start + REQUEST_DEADLINE_MS / 1000
+    try:
+        deadline_ms = float(value)
+    except ValueError:
+        raise ValueError(f"Invalid deadline: {value}")
+    if not deadline_ms > 0:
+        raise ValueError(f"Invalid deadline: {value}, should be over 0")
+    return start + deadline_ms / 1000
+
+
+def has_image(item) -> bool:
+    return isinstance(item, dict) and any(key in item for key in IMAGE_KEYS)
+
+
+def image_source_of(item, files) -> ImageSource:
+    """
+    Reads the image of an item: a URL string, or an object with an "image" URL,
+    "image_base64" bytes (plain or as a data URI) or an "image_file" multipart
+    part name. Raises `ValueError` when the item has no valid image.
+    """
+    if isinstance(item, str):
+        return ImageSource(url=item)
+    if not isinstance(item, dict):
+        raise ValueError(f"Invalid image item: {item}")
+
+    if IMAGE_URL_KEY in item:
+        return ImageSource(url=item[IMAGE_URL_KEY])
+    if IMAGE_BASE64_KEY in item:
+        value = item[IMAGE_BASE64_KEY]
+        if not isinstance(value, str):
+            raise ValueError(f"{IMAGE_BASE64_KEY} should be a string")
+        if value.startswith("data:"):
+            value = value.split(",", 1)[-1]
+        try:
+            return ImageSource(data=base64.b64decode(value, validate=True))
+        except binascii.Error as e:
+            raise ValueError(f"Invalid {IMAGE_BASE64_KEY}: {e}")
+    if IMAGE_FILE_KEY in item:
+        name = item[IMAGE_FILE_KEY]
+        file = files.get(name, None)
+        if file is None:
+            raise ValueError(f"Missing multipart file: {name}")
+        return ImageSource(data=file.read())
+    raise ValueError(f"No image found in item: {item}")
+
+
+def text_of(item) -> str:
+    """The "text" of an item, raises `ValueError` if it's not a string."""
+    value = item["text"]
+    if not isinstance(value, str):
+        raise ValueError(f"text should be a string: {value}")
+    return value
+
+
+def embedding_of(item) -> np.ndarray | None:
+    """
+    The raw "embedding" of an item, `None` if it has none. Raises `ValueError`
+    if it's not a list of numbers.
+    """
+    if not isinstance(item, dict) or EMBEDDING_KEY not in item:
+        return None
+    value = item[EMBEDDING_KEY]
+    if not isinstance(value, list) or not all(
+        isinstance(x, (int, float)) and not isinstance(x, bool) for x in value
+    ):
+        raise ValueError(f"{EMBEDDING_KEY} should be a list of numbers")
+    return np.array(value, dtype=np.float32)
+
+
+def scores_of(item) -> dict:
+    """
+    The scores an item carries in the shape `/embed` returns them, an
+    "aesthetic_score" object with "rating" and "artifact" and an "nsfw_score"
+    object with "nsfw", as `VectorIndex.upsert` arguments. Missing or null
+    scores are left out, so they don't replace computed ones.
+    """
+    scores = {}
+    for key, fields in [
+        (
+            "aesthetic_score",
+            [("rating", "rating_score"), ("artifact", "artifact_score")],
+        ),
+        ("nsfw_score", [("nsfw", "nsfw_score")]),
+    ]:
+        value = item.get(key, None)
+        if value is None:
+            continue
+        if not isinstance(value, dict):
+            raise ValueError(f"{key} should be an object")
+        for field, argument in fields:
+            score = value.get(field, None)
+            if score is None:
+                continue
+            if not isinstance(score, (int, float)):
+                raise ValueError(f"{key}.{field} should be a number")
+            scores[argument] = score
+    return scores
+
+
+def search_k_of(item) -> int:
+    k = item.get("k", SEARCH_K_DEFAULT)
+    if not isinstance(k, int) or isinstance(k, bool) or not 1 <= k <= SEARCH_K_MAX:
+        raise ValueError(f"Invalid k: {k}, should be from 1 to {SEARCH_K_MAX}")
+    return k
+
+
+def score_filter_of(item) -> ScoreFilter:
+    """
+    Reads the "filter" of a query, e.g. `{"rating": {"min": 5}, "nsfw": {"max":
+    0.2}}`. Vectors without a score that's filtered on don't match.
+    """
+    value = item.get("filter", None)
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise ValueError("filter should be an object")
+    score_filter = {}
+    for name, bounds in value.items():
+        if name not in SCORE_NAMES:
+            raise ValueError(
+                f"Invalid filter: {name}, should be one of {list(SCORE_NAMES)}"
+            )
+        if not isinstance(bounds, dict) or not set(bounds) <= {"min", "max"}:
+            raise ValueError(f"filter.{name} should be an object with min and/or max")
+        for bound in bounds.values():
+            if not isinstance(bound, (int, float)) or isinstance(bound, bool):
+                raise ValueError(f"filter.{name} bounds should be numbers")
+        score_filter[SCORE_NAMES[name]] = (bounds.get("min"), bounds.get("max"))
+    return score_filter
+
+
+def labels_of(body) -> List[str]:
+    """The "labels" of a /zero-shot request, a non-empty array of distinct texts."""
+    labels = body.get("labels", None)
+    if (
+        not isinstance(labels, list)
+        or len(labels) < 1
+        or not all(isinstance(label, str) for label in labels)
+    ):
+        raise ValueError("labels should be a non-empty array of texts")
+    if len(labels) > ZERO_SHOT_LABELS_MAX:
+        raise ValueError(
+            f"Too many labels: {len(labels)}, should be at most {ZERO_SHOT_LABELS_MAX}"
+        )
+    if len(set(labels)) < len(labels):
+        raise ValueError("labels should be distinct")
+    return labels
@@ -0,0 +1,221 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, TimeoutError, wait
+from typing import Callable, Dict, List, Tuple
+
+import torch
+from PIL import Image
+
+from models.batcher import BatchResult
+from models.constants import IMAGE_DECODE_REDUCED, MODEL_NSFW_SCORER, ModelsPack
+from models.open_clip.constants import OPEN_CLIP_VISION_STREAM_CHUNK_SIZE
+from models.open_clip.main import CLIP_IMAGE_SIZE, clip_transform
+from utils.fetcher import image_fetcher
+from utils.helpers import TIMEOUT, decode_image, download_image_bytes, time_log
+from utils.image_store import ImageRecord, ImageStore, content_key_of
+from utils.metrics import (
+    STAGE_DECODE,
+    STAGE_DOWNLOAD,
+    STAGE_PREPROCESS,
+    stage_timer,
+)
+
+DEADLINE_EXCEEDED = "Deadline exceeded"
+
+
+class ImageSource:
+    """An image to process, either a URL to download or bytes uploaded with the request."""
+
+    def __init__(self, url: str | None = None, data: bytes | None = None):
+        self.url = url
+        self.data = data
+
+
+def run_image_pipeline(
+    sources: List[ImageSource],
+    is_complete: Callable[[ImageRecord | None, int], bool],
+    models_pack: ModelsPack,
+    deadline: float,
+    embed: bool = True,
+    log_prefix: str = "📎",
+) -> Tuple[
+    List[ImageRecord | None],
+    List[Image.Image | None],
+    Dict[int, torch.Tensor],
+    Dict[int, str],
+]:
+    """
+    Streams the images through download -> decode -> preprocess -> vision model.
+
+    Images are looked up in the image store by URL first and by the hash of their
+    bytes once downloaded, uploaded bytes skip both the URL lookup and the download.
+    Only the ones whose record isn't complete are decoded.
+    Each image moves on to the next stage as soon as its bytes arrive, and the
+    preprocessed ones are sent to the vision batcher in chunks as soon as a chunk
+    fills, so network, decode and model time overlap. Returns the records, the
+    decoded images (`None` where nothing had to be computed) and the pooled
+    vision outputs of the images that were embedded.
+
+    An image that fails, or isn't done by `deadline` (a `time.monotonic()` value),
+    doesn't fail the others: its record and image are `None` and the error is
+    returned in the last dict, keyed by the image's index.
+    """
+    image_store = models_pack.image_store
+    records: List[ImageRecord | None] = [None for _ in sources]
+    pil_images: List[Image.Image | None] = [None for _ in sources]
+    pooler_outputs: Dict[int, torch.Tensor] = {}
+    errors: Dict[int, str] = {}
+    if image_store is not None:
+        records = [
+            image_store.get_by_url(source.url) if source.url is not None else None
+            for source in sources
+        ]
+
+    to_fetch = [i for i, record in enumerate(records) if not is_complete(record, i)]
+    if len(to_fetch) < 1:
+        return records, pil_images, pooler_outputs, errors
+
+    decode_min_size = None
+    if IMAGE_DECODE_REDUCED:
+        decode_min_size = CLIP_IMAGE_SIZE
+        # Routes wait for the NSFW scorer before they need it, a replica without
+        # it only decodes to the CLIP size
+        nsfw_scorer = models_pack.slots[MODEL_NSFW_SCORER].peek()
+        if nsfw_scorer is not None:
+            nsfw_size = nsfw_scorer.processor.size
+            decode_min_size = max(
+                decode_min_size, nsfw_size["height"], nsfw_size["width"]
+            )
+
+    def fetch(i: int):
+        data = sources[i].data
+        if data is None:
+            timeout = min(TIMEOUT, deadline - time.monotonic())
+            with stage_timer(STAGE_DOWNLOAD):
+                data = download_image_bytes(sources[i].url, timeout=timeout)
+        content_key = content_key_of(data)
+        record = None
+        if image_store is not None:
+            record = image_store.get_by_content(content_key)
+        if is_complete(record, i):
+            if sources[i].url is not None:
+                # Known image under a new URL
+                image_store.put(content_key, url=sources[i].url)
+            return record, None, None
+        if record is None:
+            record = ImageRecord(content_key, None, None, None, None, None)
+        with stage_timer(STAGE_DECODE):
+            pil_image = decode_image(data, min_size=decode_min_size)
+        pixel_values = None
+        if embed and record.embedding is None:
+            with stage_timer(STAGE_PREPROCESS):
+                pixel_values = clip_transform(pil_image)
+        return record, pil_image, pixel_values
+
+    def fail(i: int, error: str):
+        records[i] = None
+        pil_images[i] = None
+        pooler_outputs.pop(i, None)
+        errors[i] = error
+
+    chunk_indexes: List[int] = []
+    chunk: List[torch.Tensor] = []
+    submitted: List[Tuple[List[int], BatchResult]] = []
+
+    def submit_chunk():
+        result = models_pack.open_clip.vision_batcher.submit_async(chunk[:])
+        submitted.append((chunk_indexes[:], result))
+        chunk_indexes.clear()
+        chunk.clear()
+
+    with time_log(f"{log_prefix} Downloaded and processed {len(to_fetch)} image(s)"):
+        futures = {image_fetcher.submit(fetch, i): i for i in to_fetch}
+        pending = set(futures)
+        # A partial chunk is sent once no image has come in for the batcher's
+        # wait, so the images that are ready don't wait for the slowest one.
+        # Without embedding, OpenCLIP may not even be loaded on this replica
+        idle_wait = models_pack.open_clip.vision_batcher.max_wait if embed else None
+        try:
+            while len(pending) > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if len(chunk) > 0:
+                    remaining = min(remaining, idle_wait)
+                done, pending = wait(pending, remaining, FIRST_COMPLETED)
+                if len(done) < 1 and len(chunk) > 0:
+                    submit_chunk()
+                for future in done:
+                    i = futures[future]
+                    try:
+                        record, pil_image, pixel_values = future.result()
+                    except Exception as e:
+                        fail(i, str(e))
+                        continue
+                    records[i] = record
+                    pil_images[i] = pil_image
+                    if pixel_values is not None:
+                        chunk_indexes.append(i)
+                        chunk.append(pixel_values)
+                        if len(chunk) >= OPEN_CLIP_VISION_STREAM_CHUNK_SIZE:
+                            submit_chunk()
+            for future in pending:
+                fail(futures[future], DEADLINE_EXCEEDED)
+            if len(chunk) > 0:
+                submit_chunk()
+
+            for indexes, result in submitted:
+                try:
+                    image_embeddings, pooler_output = result.result(
+                        timeout=max(deadline - time.monotonic(), 0)
+                    )
+                except TimeoutError:
+                    for i in indexes:
+                        fail(i, DEADLINE_EXCEEDED)
+                    continue
+                except Exception as e:
+                    for i in indexes:
+                        fail(i, str(e))
+                    continue
+                image_embeddings = image_embeddings.numpy()
+                for j, i in enumerate(indexes):
+                    records[i].embedding = image_embeddings[j]
+                    pooler_outputs[i] = pooler_output[j]
+        finally:
+            for future in futures:
+                future.cancel()
+
+    if len(errors) > 0:
+        logging.warning(
+            f"{log_prefix} 🔴 {len(errors)} of {len(sources)} image(s) failed"
+        )
+    return records, pil_images, pooler_outputs, errors
+
+
+def store_images(
+    records: List[ImageRecord],
+    sources: List[ImageSource],
+    pil_images: List[Image.Image | None],
+    pooler_outputs: Dict[int, torch.Tensor],
+    image_store: ImageStore | None,
+):
+    """Saves the results computed for the decoded images to the image store."""
+    if image_store is None:
+        return
+    for i, record in enumerate(records):
+        if pil_images[i] is None:
+            continue
+        pooler_output = pooler_outputs.get(i)
+        image_store.put(
+            record.content_key,
+            url=sources[i].url,
+            embedding=record.embedding if pooler_output is not None else None,
+            pooler_output=(
+                pooler_output.cpu().numpy() if pooler_output is not None else None
+            ),
+            rating_score=record.rating_score,
+            artifact_score=record.artifact_score,
+            nsfw_score=record.nsfw_score,
+        )
+
+
@@ -0,0 +1,238 @@
+"""
+Serves the API from several worker processes forked from the one that loaded
+the models. The workers share the weights copy-on-write instead of holding a
+copy each, and accept connections from the same listening socket, the kernel
+hands each connection to one of them.
+
+Only for DEVICE=cpu, CUDA can't be used after a fork. Every worker has its own
+batchers, caches, admission control and image store shard, and the available
+cores are split among their torch threads.
+"""
+
+import gc
+import logging
+import os
+import signal
+import socket
+import time
+import traceback
+from typing import Dict
+
+import torch
+from dotenv import load_dotenv
+from prometheus_client import multiprocess
+
+from models.constants import (
+    DEVICE,
+    DEVICE_CPU,
+    IMAGE_STORE_DIR,
+    VECTOR_INDEX_CAPACITY,
+    ModelsPack,
+)
+from models.loading import MODEL_LAZY
+from models.setup import open_image_store
+from servers.clip import run_clipapi
+from utils.logger import LogListener, setup_logger
+from utils.metrics import MULTIPROCESS
+
+load_dotenv()
+
+# Processes serving the API, with 1 it's served from the main process
+CLIPAPI_WORKERS = int(os.getenv("CLIPAPI_WORKERS", 1))
+# torch threads of every worker, 0 splits the available cores among them
+CLIPAPI_WORKER_TORCH_THREADS = int(os.getenv("CLIPAPI_WORKER_TORCH_THREADS", 0))
+
+# A worker that exits on its own is forked again after this many seconds
+WORKER_RESTART_DELAY_S = 1
+LISTEN_BACKLOG = 1024
+
+
+def available_cpus() -> int:
+    """CPUs this process may run on, capped by the cgroup CPU quota in a container."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def validate_workers(workers: int):
+    if workers < 1:
+        raise ValueError(f"Invalid CLIPAPI_WORKERS: {workers}, should be at least 1")
+    if workers > 1 and DEVICE != DEVICE_CPU:
+        raise ValueError(
+            f"CLIPAPI_WORKERS > 1 needs DEVICE={DEVICE_CPU}, CUDA can't be used after a fork"
+        )
+    if workers > 1 and VECTOR_INDEX_CAPACITY > 0:
+        # Unlike the image store it can't be sharded, a search has to see it all
+        raise ValueError("CLIPAPI_WORKERS > 1 can't be used with the vector index")
+
+
+def prepare_workers(workers: int):
+    """
+    Call before loading the models. OpenMP threads don't survive a fork, workers
+    of a process that ran an op on several of them hang on their first one, so
+    the models are loaded and warmed up on a single thread.
+    """
+    validate_workers(workers)
+    torch.set_num_threads(1)
+
+
+def _run_worker(
+    models_pack: ModelsPack,
+    sock: socket.socket,
+    index: int,
+    workers: int,
+    torch_threads: int,
+    image_store_capacity: int,
+    with_logger: bool,
+):
+    logger_listener = setup_logger() if with_logger else None
+    torch.set_num_threads(torch_threads)
+    if image_store_capacity > 0:
+        # A shard per worker, their in-memory indexes of the records can't be shared
+        models_pack.image_store = open_image_store(
+            os.path.join(IMAGE_STORE_DIR, f"worker-{index}"),
+            max(1, image_store_capacity // workers),
+        )
+
+    def stop(signum, frame):
+        if models_pack.image_store is not None:
+            models_pack.image_store.flush()
+        if logger_listener is not None:
+            logger_listener.stop()
+        os._exit(0)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    run_clipapi(models_pack, sockets=[sock])
+
+
+def _fork_worker(
+    models_pack: ModelsPack,
+    sock: socket.socket,
+    index: int,
+    workers: int,
+    torch_threads: int,
+    image_store_capacity: int,
+    with_logger: bool,
+) -> int:
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    try:
+        _run_worker(
+            models_pack,
+            sock,
+            index,
+            workers,
+            torch_threads,
+            image_store_capacity,
+            with_logger,
+        )
+    except Exception:
+        logging.error(f"🔴 Worker {index} failed: {traceback.format_exc()}")
+    finally:
+        os._exit(1)
+
+
+def run_clipapi_workers(
+    models_pack: ModelsPack,
+    workers: int,
+    logger_listener: LogListener | None = None,
+    image_store_capacity: int = 0,
+):
+    """
+    Forks `workers` processes serving the API once the eager models are loaded,
+    forks them again when they exit and stops them on SIGINT or SIGTERM. Returns
+    once they're all stopped. `logger_listener` is stopped before every fork and
+    set up again on both sides, its thread wouldn't survive in the workers.
+    """
+    host = os.environ.get("CLIPAPI_HOST", "0.0.0.0")
+    port = int(os.environ.get("CLIPAPI_PORT", 13339))
+    torch_threads = CLIPAPI_WORKER_TORCH_THREADS or max(
+        1, available_cpus() // workers
+    )
+
+    # Only the weights loaded before the fork are shared
+    for slot in models_pack.slots.values():
+        if not slot.lazy:
+            slot.wait()
+    lazy = [
+        name for name, slot in models_pack.slots.items() if slot.state == MODEL_LAZY
+    ]
+    if len(lazy) > 0:
+        logging.warning(
+            f"🟠 Lazy models are loaded by every worker on its own: {', '.join(lazy)}"
+        )
+
+    sock = socket.create_server((host, port), backlog=LISTEN_BACKLOG)
+    logging.info(
+        f"📎 🟢 Starting {workers} CLIP API workers on {host}:{port}, {torch_threads} torch thread(s) each"
+    )
+
+    def fork(index: int) -> int:
+        nonlocal logger_listener
+        if logger_listener is not None:
+            logger_listener.stop()
+        # Keeps the garbage collector from writing to, and so copying, the pages
+        # of every object that exists at this point
+        gc.collect()
+        gc.freeze()
+        pid = _fork_worker(
+            models_pack,
+            sock,
+            index,
+            workers,
+            torch_threads,
+            image_store_capacity,
+            logger_listener is not None,
+        )
+        if logger_listener is not None:
+            logger_listener = setup_logger()
+        return pid
+
+    children: Dict[int, int] = {}
+    for index in range(workers):
+        children[fork(index)] = index
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            logging.info("Signal received, stopping the workers...")
+            stopping = True
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while len(children) > 0:
+        pid, status = os.wait()
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+        if MULTIPROCESS:
+            multiprocess.mark_process_dead(pid)
+        if stopping:
+            continue
+        logging.error(
+            f"🔴 Worker {index} exited with {os.waitstatus_to_exitcode(status)}, restarting it"
+        )
+        time.sleep(WORKER_RESTART_DELAY_S)
+        if not stopping:
+            children[fork(index)] = index
+
+    sock.close()
+    logging.info("✅ All the workers are stopped")
+    if logger_listener is not None:
+        logger_listener.stop()
@@ -0,0 +1,148 @@
+import math
+import os
+import time
+from collections import deque
+from threading import Lock
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Pending items (images plus texts) and estimated wait over which requests are shed
+ADMISSION_MAX_PENDING_ITEMS = int(os.getenv("ADMISSION_MAX_PENDING_ITEMS", 1024))
+ADMISSION_MAX_WAIT_S = float(os.getenv("ADMISSION_MAX_WAIT_S", 20))
+# Completions older than this don't count towards the measured capacity
+CAPACITY_WINDOW_S = 30
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    def __init__(self, controller: "AdmissionController", items: int):
+        self._controller = controller
+        self.items = items
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self.items)
+
+
+class AdmissionController:
+    """
+    Bounds the work admitted into the server by the number of pending items (images
+    plus texts) rather than by the number of requests. A request is rejected when it
+    would take the pending items over `max_pending_items`, or when the wait it would
+    see, estimated from the recently measured capacity, is over `max_wait_s`.
+
+    The capacity is the items completed per second the server was busy, with at
+    least a request in flight, so idle time between requests doesn't count.
+    """
+
+    def __init__(self, max_pending_items: int, max_wait_s: float):
+        self.max_pending_items = max_pending_items
+        self.max_wait_s = max_wait_s
+        self._lock = Lock()
+        # (time, items) of every completed request
+        self._completions: deque = deque()
+        # (start, end) of every period with requests in flight, and the start of
+        # the current one
+        self._busy_periods: deque = deque()
+        self._busy_since: float | None = None
+        self.pending_items = 0
+        self.pending_requests = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def _capacity(self, now: float) -> float | None:
+        """
+        Items completed per second the server was busy over the window, `None`
+        before any completes.
+        """
+        start = now - CAPACITY_WINDOW_S
+        while len(self._completions) > 0 and self._completions[0][0] < start:
+            self._completions.popleft()
+        while len(self._busy_periods) > 0 and self._busy_periods[0][1] < start:
+            self._busy_periods.popleft()
+        periods = list(self._busy_periods)
+        if self._busy_since is not None:
+            periods.append((self._busy_since, now))
+        busy = sum(end - max(begin, start) for begin, end in periods)
+        items = sum(items for _, items in self._completions)
+        return items / busy if items > 0 and busy > 0 else None
+
+    def _estimated_wait(self, now: float, items: int) -> float:
+        capacity = self._capacity(now)
+        if capacity is None:
+            return 0.0
+        return (self.pending_items + items) / capacity
+
+    def admit(self, items: int) -> AdmissionTicket:
+        """Raises `AdmissionRejected` when the server shouldn't take `items` more."""
+        with self._lock:
+            now = time.monotonic()
+            estimated_wait = self._estimated_wait(now, items)
+            retry_after = max(1, math.ceil(self._estimated_wait(now, 0)))
+            # A request is always admitted into an idle server, however big it is
+            if self.pending_items > 0:
+                if self.pending_items + items > self.max_pending_items:
+                    self.rejected += 1
+                    raise AdmissionRejected(
+                        f"Too many pending items: {self.pending_items}", retry_after
+                    )
+                if estimated_wait > self.max_wait_s:
+                    self.rejected += 1
+                    raise AdmissionRejected(
+                        f"Estimated wait is too long: {estimated_wait:.1f} sec.",
+                        retry_after,
+                    )
+            if self.pending_requests == 0:
+                self._busy_since = now
+            self.pending_items += items
+            self.pending_requests += 1
+            self.admitted += 1
+            return AdmissionTicket(self, items)
+
+    def _release(self, items: int):
+        with self._lock:
+            now = time.monotonic()
+            self.pending_items -= items
+            self.pending_requests -= 1
+            self._completions.append((now, items))
+            if self.pending_requests == 0:
+                self._busy_periods.append((self._busy_since, now))
+                self._busy_since = None
+
+    def is_saturated(self) -> bool:
+        with self._lock:
+            return (
+                self.pending_items >= self.max_pending_items
+                or self._estimated_wait(time.monotonic(), 0) > self.max_wait_s
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            capacity = self._capacity(now)
+            return {
+                "pending_items": self.pending_items,
+                "pending_requests": self.pending_requests,
+                "max_pending_items": self.max_pending_items,
+                "capacity_items_per_sec": capacity,
+                "estimated_wait_sec": self._estimated_wait(now, 0),
+                "max_wait_sec": self.max_wait_s,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
+
+
+admission_controller = AdmissionController(
+    max_pending_items=ADMISSION_MAX_PENDING_ITEMS,
+    max_wait_s=ADMISSION_MAX_WAIT_S,
+)
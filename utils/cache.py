@@ -0,0 +1,66 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Hashable
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Thread-safe LRU cache of embedding vectors bounded by the total number of bytes
+    its vectors and keys take. Vectors are stored as compact numpy arrays of `dtype`.
+    """
+
+    def __init__(self, max_bytes: int, dtype: str = "float32"):
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self._entries: "OrderedDict[Hashable, np.ndarray]" = OrderedDict()
+        self._lock = Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _entry_bytes(self, key: Hashable, value: np.ndarray) -> int:
+        key_bytes = len(key.encode()) if isinstance(key, str) else len(repr(key))
+        return value.nbytes + key_bytes
+
+    def get(self, key: Hashable) -> np.ndarray | None:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value) -> None:
+        value = np.ascontiguousarray(value, dtype=self.dtype)
+        entry_bytes = self._entry_bytes(key, value)
+        if entry_bytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size_bytes -= self._entry_bytes(key, previous)
+            self._entries[key] = value
+            self.size_bytes += entry_bytes
+            while self.size_bytes > self.max_bytes:
+                old_key, old_value = self._entries.popitem(last=False)
+                self.size_bytes -= self._entry_bytes(old_key, old_value)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes,
+                "dtype": self.dtype.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            }
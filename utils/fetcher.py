@@ -0,0 +1,199 @@
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from threading import BoundedSemaphore, Lock, local
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+load_dotenv()
+
+# Downloads in flight at once, shared by all requests
+FETCHER_CONCURRENCY_MAX = int(os.getenv("FETCHER_CONCURRENCY_MAX", 64))
+# Hosts that keep a connection pool, and keep-alive connections per host
+FETCHER_POOL_HOSTS = int(os.getenv("FETCHER_POOL_HOSTS", 8))
+FETCHER_POOL_SIZE_PER_HOST = int(os.getenv("FETCHER_POOL_SIZE_PER_HOST", 32))
+# A second attempt is started for downloads slower than this percentile of the
+# recent download latencies, set it to 0 to disable hedging
+FETCHER_HEDGE_PERCENTILE = float(os.getenv("FETCHER_HEDGE_PERCENTILE", 95))
+FETCHER_HEDGE_MIN_DELAY_MS = float(os.getenv("FETCHER_HEDGE_MIN_DELAY_MS", 100))
+# Hedged attempts in flight at once, on top of FETCHER_CONCURRENCY_MAX so they
+# don't wait behind the slow downloads they hedge
+FETCHER_HEDGE_CONCURRENCY_MAX = int(os.getenv("FETCHER_HEDGE_CONCURRENCY_MAX", 8))
+# Latencies measured before hedging starts, and latencies kept
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MAX_SAMPLES = 1000
+
+
+class ImageFetcher:
+    """
+    Long-lived HTTP fetcher shared by all requests. Its threads have a session
+    each, all mounted on one adapter with a keep-alive connection pool per host,
+    so repeated downloads from the same CDN reuse connections instead of doing a
+    new TLS handshake. It bounds the number of downloads in flight across all
+    requests.
+
+    Downloads slower than `hedge_percentile` of the recent latencies get a hedged
+    second attempt, with a budget of its own of `hedge_concurrency_max`
+    attempts. The first successful response wins, or the last failed one when
+    neither succeeds.
+
+    Work that follows a download (decoding, preprocessing) is also run on its
+    executor so no request has to create a thread pool of its own.
+    """
+
+    def __init__(
+        self,
+        concurrency_max: int,
+        pool_hosts: int,
+        pool_size_per_host: int,
+        hedge_percentile: float,
+        hedge_min_delay_ms: float,
+        hedge_concurrency_max: int,
+    ):
+        self.concurrency_max = concurrency_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay_ms / 1000
+        # urllib3's pools are thread-safe, sessions aren't guaranteed to be
+        self._adapter = HTTPAdapter(
+            pool_connections=pool_hosts,
+            pool_maxsize=pool_size_per_host,
+            pool_block=False,
+        )
+        self._local = local()
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency_max, thread_name_prefix="image-fetcher"
+        )
+        # Attempts run on their own threads, a hedge must never wait for a free
+        # worker behind the tasks that are waiting for it
+        self._attempts = ThreadPoolExecutor(
+            max_workers=concurrency_max * 2, thread_name_prefix="image-fetcher-attempt"
+        )
+        self._semaphore = BoundedSemaphore(concurrency_max)
+        self._hedge_semaphore = BoundedSemaphore(max(hedge_concurrency_max, 1))
+        self._lock = Lock()
+        self._latencies: deque = deque(maxlen=HEDGE_MAX_SAMPLES)
+        self.in_flight = 0
+        self.waiting = 0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.mount("http://", self._adapter)
+            session.mount("https://", self._adapter)
+        return session
+
+    def get(self, url: str, timeout: float, hedge: bool = False) -> requests.Response:
+        with self._lock:
+            self.waiting += 1
+        with self._hedge_semaphore if hedge else self._semaphore:
+            with self._lock:
+                self.waiting -= 1
+                self.in_flight += 1
+                self.requests += 1
+            start = time.monotonic()
+            try:
+                response = self._session().get(url, timeout=timeout)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+            if response.ok:
+                with self._lock:
+                    self._latencies.append(time.monotonic() - start)
+            return response
+
+    def hedge_delay(self) -> float | None:
+        """The latency percentile after which a download is hedged, `None` when off."""
+        with self._lock:
+            if self.hedge_percentile <= 0 or len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        index = math.ceil(len(latencies) * self.hedge_percentile / 100) - 1
+        percentile = latencies[min(max(index, 0), len(latencies) - 1)]
+        return max(percentile, self.hedge_min_delay)
+
+    def get_hedged(self, url: str, timeout: float) -> requests.Response:
+        start = time.monotonic()
+        primary = self._attempts.submit(self.get, url, timeout)
+        delay = self.hedge_delay()
+        if delay is None or delay >= timeout:
+            return primary.result()
+        done, _ = wait([primary], timeout=delay)
+        if len(done) > 0:
+            return primary.result()
+
+        with self._lock:
+            self.hedges += 1
+        hedge = self._attempts.submit(
+            self.get, url, timeout - (time.monotonic() - start), True
+        )
+        pending = {primary, hedge}
+        failed = None
+        error = None
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if not response.ok:
+                    failed = response
+                    continue
+                if future is hedge:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return response
+        if failed is not None:
+            return failed
+        raise error
+
+    def stats(self) -> dict:
+        hosts = {}
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            # Free slots hold either an idle keep-alive connection or `None`
+            free = list(pool.pool.queue)
+            hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "in_use": pool.pool.maxsize - len(free),
+                "idle": sum(1 for conn in free if conn is not None),
+                "max_size": pool.pool.maxsize,
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+            }
+        hedge_delay = self.hedge_delay()
+        with self._lock:
+            return {
+                "concurrency_max": self.concurrency_max,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "requests": self.requests,
+                "hedge_delay_sec": hedge_delay,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hosts": hosts,
+            }
+
+
+image_fetcher = ImageFetcher(
+    concurrency_max=FETCHER_CONCURRENCY_MAX,
+    pool_hosts=FETCHER_POOL_HOSTS,
+    pool_size_per_host=FETCHER_POOL_SIZE_PER_HOST,
+    hedge_percentile=FETCHER_HEDGE_PERCENTILE,
+    hedge_min_delay_ms=FETCHER_HEDGE_MIN_DELAY_MS,
+    hedge_concurrency_max=FETCHER_HEDGE_CONCURRENCY_MAX,
+)
@@ -12,9 +12,16 @@ from flask import jsonify
 import os
 from dotenv import load_dotenv
 
+from utils.fetcher import image_fetcher
+from utils.logger import ITEM_LOG
+
 load_dotenv()
 
-TIMEOUT = os.getenv("TIMEOUT", 15)
+TIMEOUT = float(os.getenv("TIMEOUT", 15))
+
+# Modes whose bands `Image.reduce` can average, palette and 1 or 16-bit images
+# are converted to RGB first
+REDUCE_MODES = {"L", "LA", "RGB", "RGBA", "CMYK", "YCbCr", "I", "F"}
 
 
 @contextmanager
@@ -30,26 +37,47 @@ def time_log(after: str = "Completed", before: str | None = None):
         logging.info(f"{after}: {execution_time:.0f} ms")
 
 
-def download_image(url, timeout=TIMEOUT):
+def decode_image(data: bytes, min_size: int | None = None) -> Image.Image:
+    """
+    Decodes image bytes to RGB. With `min_size`, the image is decoded straight to a
+    reduced resolution whose shorter side is still at least `min_size`: JPEGs use
+    the decoder's DCT scaling, other formats are box-reduced after decoding while
+    keeping twice `min_size`, since a box filter aliases more than DCT scaling.
+    """
+    img = Image.open(BytesIO(data))
+    if min_size is not None:
+        if img.format == "JPEG":
+            img.draft("RGB", (min_size, min_size))
+        else:
+            factor = min(img.size) // (min_size * 2)
+            if factor >= 2:
+                if img.mode not in REDUCE_MODES:
+                    img = img.convert("RGB")
+                img = img.reduce(factor)
+    return img.convert("RGB")
+
+
+def download_image_bytes(url, timeout=TIMEOUT) -> bytes:
+    if timeout <= 0:
+        err = f'🔴 Timeout error: No time left to download "{url}"'
+        logging.info(err, extra=ITEM_LOG)
+        raise Exception(err)
     try:
-        response = requests.get(url, timeout=timeout)
+        response = image_fetcher.get_hedged(url, timeout=timeout)
         response.raise_for_status()  # Raises a HTTPError if the status is 4xx, 5xx
-        return Image.open(BytesIO(response.content)).convert("RGB")
+        return response.content
     except requests.exceptions.Timeout:
         err = f'🔴 Timeout error: The request to "{url}" timed out after {timeout:.1f} sec.'
-        logging.info(err)
+        logging.info(err, extra=ITEM_LOG)
         raise Exception(err)
     except requests.exceptions.RequestException as e:
         err = f'🔴 Error downloading image from "{url}": {str(e)}'
-        logging.info(err)
+        logging.info(err, extra=ITEM_LOG)
         raise Exception(err)
 
 
-def download_images(urls, max_workers=10):
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(download_image, url) for url in urls]
-        images = [future.result() for future in futures]
-    return images
+def is_true(value) -> bool:
+    return value is True or value == "true" or value == "True"
 
 
 def is_url(string):
@@ -0,0 +1,207 @@
+import hashlib
+import logging
+import os
+from threading import Lock
+from typing import Dict
+
+import numpy as np
+
+CONTENT_KEY_SIZE = 32
+URL_KEY_SIZE = 16
+
+FLAG_VALID = 1
+FLAG_EMBEDDING = 2
+
+SCORE_RATING = 0
+SCORE_ARTIFACT = 1
+SCORE_NSFW = 2
+
+
+def content_key_of(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+def url_key_of(url: str) -> bytes:
+    return hashlib.blake2b(url.encode(), digest_size=URL_KEY_SIZE).digest()
+
+
+def _optional(value: np.float64) -> float | None:
+    return None if np.isnan(value) else float(value)
+
+
+class ImageRecord:
+    def __init__(
+        self,
+        content_key: bytes,
+        embedding: np.ndarray | None,
+        pooler_output: np.ndarray | None,
+        rating_score: float | None,
+        artifact_score: float | None,
+        nsfw_score: float | None,
+    ):
+        self.content_key = content_key
+        self.embedding = embedding
+        self.pooler_output = pooler_output
+        self.rating_score = rating_score
+        self.artifact_score = artifact_score
+        self.nsfw_score = nsfw_score
+
+
+class ImageStore:
+    """
+    Disk-backed store of image embeddings and scores, keyed by the SHA-256 of the
+    downloaded image bytes with the image URL as a secondary key.
+
+    Records have a fixed width and live in a single memory-mapped file that is used
+    as a ring buffer, so reading a record is a plain array slice. Only the two key
+    lookup tables are held in memory, they are rebuilt from the file on startup.
+    """
+
+    def __init__(
+        self, directory: str, capacity: int, embedding_dim: int, pooler_dim: int
+    ):
+        self.capacity = capacity
+        self.record_dtype = np.dtype(
+            [
+                ("flags", "u1"),
+                ("content_key", "u1", CONTENT_KEY_SIZE),
+                ("url_key", "u1", URL_KEY_SIZE),
+                ("scores", "<f8", 3),
+                ("embedding", "<f4", embedding_dim),
+                ("pooler_output", "<f4", pooler_dim),
+            ]
+        )
+        os.makedirs(directory, exist_ok=True)
+        # Dimensions are a part of the file names, a model with other dimensions
+        # starts a fresh store instead of reading misaligned records
+        name = f"{embedding_dim}x{pooler_dim}x{capacity}"
+        self._records = self._open(
+            os.path.join(directory, f"records-{name}.bin"),
+            self.record_dtype,
+            capacity,
+        )
+        self._cursor = self._open(
+            os.path.join(directory, f"cursor-{name}.bin"), np.dtype("<i8"), 1
+        )
+        self._by_content: Dict[bytes, int] = {}
+        self._by_url: Dict[bytes, int] = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+        flags = self._records["flags"]
+        for slot in np.flatnonzero(flags & FLAG_VALID):
+            self._by_content[self._records["content_key"][slot].tobytes()] = slot
+            url_key = self._records["url_key"][slot]
+            if url_key.any():
+                self._by_url[url_key.tobytes()] = slot
+        logging.info(
+            f"🗄️ Opened image store at {directory} with {len(self._by_content)}/{capacity} record(s)"
+        )
+
+    @staticmethod
+    def _open(path: str, dtype: np.dtype, length: int) -> np.memmap:
+        mode = "r+" if os.path.exists(path) else "w+"
+        return np.memmap(path, dtype=dtype, mode=mode, shape=(length,))
+
+    def _read(self, slot: int) -> ImageRecord:
+        record = self._records[slot]
+        has_embedding = record["flags"] & FLAG_EMBEDDING
+        scores = record["scores"]
+        return ImageRecord(
+            content_key=record["content_key"].tobytes(),
+            embedding=np.array(record["embedding"]) if has_embedding else None,
+            pooler_output=np.array(record["pooler_output"]) if has_embedding else None,
+            rating_score=_optional(scores[SCORE_RATING]),
+            artifact_score=_optional(scores[SCORE_ARTIFACT]),
+            nsfw_score=_optional(scores[SCORE_NSFW]),
+        )
+
+    def _get(self, index: Dict[bytes, int], key: bytes) -> ImageRecord | None:
+        with self._lock:
+            slot = index.get(key)
+            if slot is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._read(slot)
+
+    def get_by_url(self, url: str) -> ImageRecord | None:
+        return self._get(self._by_url, url_key_of(url))
+
+    def get_by_content(self, content_key: bytes) -> ImageRecord | None:
+        return self._get(self._by_content, content_key)
+
+    def put(
+        self,
+        content_key: bytes,
+        url: str | None = None,
+        embedding: np.ndarray | None = None,
+        pooler_output: np.ndarray | None = None,
+        rating_score: float | None = None,
+        artifact_score: float | None = None,
+        nsfw_score: float | None = None,
+    ):
+        """Creates or updates the record of `content_key`, fields left as `None` are kept."""
+        with self._lock:
+            slot = self._by_content.get(content_key)
+            if slot is None:
+                slot = int(self._cursor[0] % self.capacity)
+                self._cursor[0] += 1
+                self._evict(slot)
+                self._records["scores"][slot] = np.nan
+                self._records["flags"][slot] = 0
+                # Or a record without a URL would come back under the evicted one's
+                self._records["url_key"][slot] = 0
+                self._records["content_key"][slot] = np.frombuffer(
+                    content_key, dtype=np.uint8
+                )
+                self._by_content[content_key] = slot
+
+            record = self._records[slot]
+            if url is not None:
+                url_key = url_key_of(url)
+                old_url_key = record["url_key"].tobytes()
+                if self._by_url.get(old_url_key) == slot:
+                    del self._by_url[old_url_key]
+                record["url_key"] = np.frombuffer(url_key, dtype=np.uint8)
+                self._by_url[url_key] = slot
+            if embedding is not None and pooler_output is not None:
+                record["embedding"] = embedding
+                record["pooler_output"] = pooler_output
+                record["flags"] |= FLAG_EMBEDDING
+            if rating_score is not None:
+                record["scores"][SCORE_RATING] = rating_score
+            if artifact_score is not None:
+                record["scores"][SCORE_ARTIFACT] = artifact_score
+            if nsfw_score is not None:
+                record["scores"][SCORE_NSFW] = nsfw_score
+            # Marked valid last, a half written record is never read back
+            record["flags"] |= FLAG_VALID
+
+    def _evict(self, slot: int):
+        record = self._records[slot]
+        if not record["flags"] & FLAG_VALID:
+            return
+        content_key = record["content_key"].tobytes()
+        url_key = record["url_key"].tobytes()
+        if self._by_content.get(content_key) == slot:
+            del self._by_content[content_key]
+        if self._by_url.get(url_key) == slot:
+            del self._by_url[url_key]
+
+    def flush(self):
+        with self._lock:
+            self._records.flush()
+            self._cursor.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "records": len(self._by_content),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            }
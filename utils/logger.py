@@ -1,8 +1,8 @@
 import logging
 import logging.handlers
-import logging_loki
-from multiprocessing import Queue
 import os
+import queue
+import random
 import sys
 from dotenv import load_dotenv
 from enum import Enum
@@ -11,38 +11,64 @@ load_dotenv()
 
 APPLICATON_NAME = "sc-clip"
 
+# Records waiting for the stdout and Loki handlers, newer ones are dropped and
+# counted once it's full
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10_000))
+# Loki pushes are sent once they have this many records or bytes of log lines,
+# or this long after the previous one
+LOKI_BATCH_MAX_RECORDS = int(os.getenv("LOKI_BATCH_MAX_RECORDS", 1000))
+LOKI_BATCH_MAX_BYTES = int(os.getenv("LOKI_BATCH_MAX_BYTES", 1024 * 1024))
+LOKI_BATCH_WAIT_MS = float(os.getenv("LOKI_BATCH_WAIT_MS", 1000))
+# Records waiting to be pushed while Loki is slow or down
+LOKI_BACKLOG_MAX_RECORDS = int(os.getenv("LOKI_BACKLOG_MAX_RECORDS", 50_000))
+LOKI_TIMEOUT = float(os.getenv("LOKI_TIMEOUT", 10))
+# Share of the per-item log lines that are kept, see `ITEM_LOG`
+LOG_ITEM_SAMPLE_RATE = float(os.getenv("LOG_ITEM_SAMPLE_RATE", 0.01))
+
+# Pass as `extra` to the log lines written for every item of a request, only a
+# `LOG_ITEM_SAMPLE_RATE` share of them is kept
+ITEM_LOG = {"sample_rate": LOG_ITEM_SAMPLE_RATE}
+
 
 class TabulateLevels(Enum):
     PRIMARY = "simple_grid"
     SECONDARY = "simple"
 
 
+class SamplingFilter(logging.Filter):
+    """Keeps records with a `sample_rate` attribute at that rate, all the others."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        sample_rate = getattr(record, "sample_rate", None)
+        return sample_rate is None or random.random() < sample_rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the logging thread, records that don't fit are dropped and counted."""
+
+    def enqueue(self, record: logging.LogRecord):
+        from utils.metrics import LOG_RECORDS_DROPPED
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.labels("queue_full").inc()
+
+
+class LogListener(logging.handlers.QueueListener):
+    def stop(self):
+        """Stops after the queued records are handled, and flushes the handlers."""
+        super().stop()
+        for handler in self.handlers:
+            handler.close()
+
+
 def setup_logger():
     # Fetch environment variables
     loki_url = os.getenv("LOKI_URL")
     loki_username = os.getenv("LOKI_USERNAME")
     loki_password = os.getenv("LOKI_PASSWORD")
 
-    # Validate environment variables
-    if not loki_url:
-        raise ValueError("LOKI_URL environment variable is not set")
-    if not loki_username:
-        raise ValueError("LOKI_USERNAME environment variable is not set")
-    if not loki_password:
-        raise ValueError("LOKI_PASSWORD environment variable is not set")
-
-    # Set up the logging queue and handler
-    queue = Queue(-1)
-    queue_handler = logging.handlers.QueueHandler(queue)
-
-    # Set up the Loki handler
-    handler_loki = logging_loki.LokiHandler(
-        url=f"{loki_url}/loki/api/v1/push",
-        tags={"application": APPLICATON_NAME},
-        auth=(loki_username, loki_password),
-        version="1",
-    )
-
     # Set up the stdout handler for console logging
     stdout_handler = logging.StreamHandler(sys.stdout)
     stdout_handler.setLevel(logging.INFO)
@@ -50,9 +76,37 @@ def setup_logger():
         "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     )
     stdout_handler.setFormatter(formatter)
+    handlers = [stdout_handler]
+
+    # Set up the Loki handler, the server runs without it when it's not configured
+    if loki_url:
+        from utils.loki import LokiBatchHandler
+
+        handlers.append(
+            LokiBatchHandler(
+                url=f"{loki_url}/loki/api/v1/push",
+                labels={"application": APPLICATON_NAME},
+                auth=(
+                    (loki_username, loki_password)
+                    if loki_username and loki_password
+                    else None
+                ),
+                batch_max_records=LOKI_BATCH_MAX_RECORDS,
+                batch_max_bytes=LOKI_BATCH_MAX_BYTES,
+                batch_wait_ms=LOKI_BATCH_WAIT_MS,
+                backlog_max_records=LOKI_BACKLOG_MAX_RECORDS,
+                timeout=LOKI_TIMEOUT,
+            )
+        )
+
+    # Set up the bounded logging queue and its handler, records are formatted
+    # when they're queued and handled on the listener's thread
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
 
     # Set up the listener to handle log entries from the queue
-    listener = logging.handlers.QueueListener(queue, handler_loki, stdout_handler)
+    listener = LogListener(log_queue, *handlers, respect_handler_level=True)
 
     # Start the listener
     listener.start()
@@ -65,4 +119,7 @@ def setup_logger():
     root_logger.addHandler(queue_handler)
     root_logger.setLevel(logging.INFO)
 
+    if not loki_url:
+        logging.warning("🟠 LOKI_URL isn't set, logging to stdout only")
+
     return listener
@@ -0,0 +1,168 @@
+import gzip
+import json
+import logging
+import sys
+import time
+from collections import deque
+from threading import Event, Lock, Thread
+from typing import Dict, List, Tuple
+
+import requests
+
+from utils.metrics import LOG_RECORDS_DROPPED, LOG_RECORDS_SHIPPED
+
+# Pushes that failed are retried once after this many seconds, then dropped
+PUSH_RETRY_DELAY_S = 1
+
+
+class LokiBatchHandler(logging.Handler):
+    """
+    Ships log records to Loki from a thread of its own, in gzipped pushes of up
+    to `batch_max_records` records or `batch_max_bytes` of log lines, sent once
+    either is reached or `batch_wait_ms` after the previous push.
+
+    At most `backlog_max_records` records wait to be pushed. While Loki is slow
+    or down the newer records are dropped and counted, and the next push that
+    gets through says how many were lost. Streams are labeled with the level and
+    the logger's name, like `python-logging-loki` does.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        labels: Dict[str, str],
+        auth: Tuple[str, str] | None,
+        batch_max_records: int,
+        batch_max_bytes: int,
+        batch_wait_ms: float,
+        backlog_max_records: int,
+        timeout: float,
+    ):
+        super().__init__()
+        self.url = url
+        self.labels = labels
+        self.batch_max_records = batch_max_records
+        self.batch_max_bytes = batch_max_bytes
+        self.batch_wait = batch_wait_ms / 1000
+        self.backlog_max_records = backlog_max_records
+        self.timeout = timeout
+        self._session = requests.Session()
+        self._session.auth = auth
+        self._entries: deque = deque()
+        self._bytes = 0
+        self._dropped = 0
+        self._entries_lock = Lock()
+        self._wake = Event()
+        self._stopping = Event()
+        self._thread = Thread(target=self._run, name="loki-shipper", daemon=True)
+        self._thread.start()
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        entry = (
+            record.levelname.lower(),
+            record.name,
+            str(int(record.created * 1e9)),
+            line,
+        )
+        with self._entries_lock:
+            if len(self._entries) >= self.backlog_max_records:
+                self._dropped += 1
+                LOG_RECORDS_DROPPED.labels("loki_backlog").inc()
+                return
+            self._entries.append(entry)
+            self._bytes += len(line)
+        if self._is_full():
+            self._wake.set()
+
+    def _is_full(self) -> bool:
+        with self._entries_lock:
+            return (
+                len(self._entries) >= self.batch_max_records
+                or self._bytes >= self.batch_max_bytes
+            )
+
+    def _take_batch(self) -> List[Tuple[str, str, str, str]]:
+        batch = []
+        size = 0
+        with self._entries_lock:
+            while len(self._entries) > 0 and len(batch) < self.batch_max_records:
+                entry = self._entries[0]
+                if len(batch) > 0 and size + len(entry[3]) > self.batch_max_bytes:
+                    break
+                self._entries.popleft()
+                self._bytes -= len(entry[3])
+                size += len(entry[3])
+                batch.append(entry)
+            if self._dropped > 0 and len(batch) > 0:
+                message = f"🟠 Dropped {self._dropped} log record(s) Loki didn't get"
+                batch.append(("warning", "loki", str(time.time_ns()), message))
+                self._dropped = 0
+        return batch
+
+    def _payload(self, batch: List[Tuple[str, str, str, str]]) -> bytes:
+        streams: Dict[Tuple[str, str], list] = {}
+        for severity, logger, ts, line in batch:
+            streams.setdefault((severity, logger), []).append([ts, line])
+        body = {
+            "streams": [
+                {
+                    "stream": {**self.labels, "severity": severity, "logger": logger},
+                    "values": values,
+                }
+                for (severity, logger), values in streams.items()
+            ]
+        }
+        return gzip.compress(json.dumps(body).encode(), compresslevel=5)
+
+    def _push(self, batch: List[Tuple[str, str, str, str]]):
+        payload = self._payload(batch)
+        headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+        for attempt in range(2):
+            try:
+                response = self._session.post(
+                    self.url, data=payload, headers=headers, timeout=self.timeout
+                )
+                if response.ok:
+                    LOG_RECORDS_SHIPPED.inc(len(batch))
+                    return
+                error = f"{response.status_code} {response.text[:200]}"
+            except requests.RequestException as e:
+                error = str(e)
+            if attempt == 0 and not self._stopping.is_set():
+                time.sleep(PUSH_RETRY_DELAY_S)
+        LOG_RECORDS_DROPPED.labels("push_failed").inc(len(batch))
+        with self._entries_lock:
+            self._dropped += len(batch)
+        # Not through logging, it would come back here
+        print(
+            f"🔴 Couldn't push {len(batch)} log record(s) to Loki: {error}",
+            file=sys.stderr,
+        )
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.batch_wait)
+            self._wake.clear()
+            # Everything on close, otherwise as long as there's a full batch
+            while True:
+                batch = self._take_batch()
+                if len(batch) > 0:
+                    self._push(batch)
+                if len(batch) < 1:
+                    break
+                if not (self._stopping.is_set() or self._is_full()):
+                    break
+            if self._stopping.is_set():
+                return
+
+    def close(self):
+        """Pushes what's left, waiting up to the push timeout."""
+        self._stopping.set()
+        self._wake.set()
+        self._thread.join(self.timeout * 2)
+        super().close()
@@ -0,0 +1,57 @@
+import resource
+
+import torch
+
+MB = 1024 * 1024
+
+
+def _proc_status() -> dict:
+    """The memory fields of /proc/self/status in bytes, empty outside of Linux."""
+    fields = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ["VmRSS", "VmHWM"]:
+                    fields[name] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return fields
+
+
+def _pss() -> int | None:
+    """Resident memory with the shared pages split among the processes sharing them."""
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def memory_stats() -> dict:
+    """
+    Current and peak resident memory of the process, and of the CUDA allocator
+    once CUDA is in use, in MB. The peaks are high-water marks since startup.
+    Worker processes count the weights they share in their RSS, the PSS only
+    counts their share of them.
+    """
+    status = _proc_status()
+    pss = _pss()
+    # ru_maxrss is in kilobytes on Linux
+    peak = status.get(
+        "VmHWM", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    )
+    stats = {
+        "rss_mb": round(status["VmRSS"] / MB) if "VmRSS" in status else None,
+        "rss_peak_mb": round(peak / MB),
+        "pss_mb": round(pss / MB) if pss is not None else None,
+    }
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        stats["cuda_allocated_mb"] = round(torch.cuda.memory_allocated() / MB)
+        stats["cuda_allocated_peak_mb"] = round(torch.cuda.max_memory_allocated() / MB)
+        stats["cuda_reserved_mb"] = round(torch.cuda.memory_reserved() / MB)
+        stats["cuda_reserved_peak_mb"] = round(torch.cuda.max_memory_reserved() / MB)
+    return stats
@@ -0,0 +1,254 @@
+"""
+Prometheus metrics of the server, served at `/metrics`:
+
+- clipapi_stage_seconds: latency histogram of every processing stage
+- clipapi_batch_size: rows per model forward pass
+- clipapi_items_total: items received, by route and kind
+- clipapi_item_errors_total: items that got an error instead of a result
+- clipapi_requests_rejected_total: requests shed before any work was done
+- clipapi_cache_lookups_total: hits and misses of the caches, read at scrape time
+  or, with several workers, every `CACHE_STATS_INTERVAL_S`
+- clipapi_log_records_shipped_total, clipapi_log_records_dropped_total: log
+  records pushed to Loki, and the ones lost on the way
+- clipapi_stage_rss_growth_bytes: largest RSS increase over a run of each stage
+  since the previous scrape, only once `enable_stage_rss_sampling` is called
+"""
+
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from threading import Lock, Thread
+from typing import Callable, Dict
+
+# With several worker processes, see servers/workers.py, every process writes its
+# metrics to files in this directory and `/metrics` adds them up. It's read when
+# prometheus_client is imported, and should be empty at startup
+if (
+    int(os.getenv("CLIPAPI_WORKERS", 1)) > 1
+    and "PROMETHEUS_MULTIPROC_DIR" not in os.environ
+):
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="clipapi-metrics-")
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    REGISTRY,
+    multiprocess,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# How often the workers add their cache lookups to the shared metrics
+CACHE_STATS_INTERVAL_S = 5
+
+STAGE_DOWNLOAD = "download"
+STAGE_DECODE = "decode"
+STAGE_PREPROCESS = "preprocess"
+STAGE_VISION_FORWARD = "vision_forward"
+STAGE_TEXT_FORWARD = "text_forward"
+STAGE_AESTHETICS = "aesthetics"
+STAGE_NSFW = "nsfw"
+STAGE_SERIALIZATION = "serialization"
+STAGE_SEARCH = "search"
+STAGE_ZERO_SHOT = "zero_shot"
+
+STAGE_SECONDS = Histogram(
+    "clipapi_stage_seconds",
+    "Time spent in each processing stage",
+    ["stage"],
+    buckets=[
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+        30,
+    ],
+)
+BATCH_SIZE = Histogram(
+    "clipapi_batch_size",
+    "Rows per model forward pass, before padding",
+    ["model"],
+    buckets=[1, 2, 4, 8, 16, 32, 64, 128],
+)
+ITEMS = Counter("clipapi_items_total", "Items received", ["route", "kind"])
+ITEM_ERRORS = Counter(
+    "clipapi_item_errors_total",
+    "Items answered with an error instead of a result",
+    ["route", "reason"],
+)
+REQUESTS_REJECTED = Counter(
+    "clipapi_requests_rejected_total",
+    "Requests shed before any work was done",
+    ["route", "reason"],
+)
+LOG_RECORDS_SHIPPED = Counter(
+    "clipapi_log_records_shipped_total", "Log records pushed to Loki"
+)
+LOG_RECORDS_DROPPED = Counter(
+    "clipapi_log_records_dropped_total",
+    "Log records that were never pushed to Loki",
+    ["reason"],
+)
+
+
+class _StageRun:
+    def __init__(self, stage: str, baseline: int):
+        self.stage = stage
+        self.baseline = baseline
+        self.peak = baseline
+
+
+class StageRSSSampler:
+    """
+    Samples the RSS of the process every `interval_s` on a thread, and keeps the
+    largest increase over a run of each stage: the highest RSS seen while it
+    ran, sampled on exit as well, less the RSS on entry. The increases start
+    over on every scrape.
+    """
+
+    def __init__(self, interval_s: float):
+        self.interval_s = interval_s
+        self._page_size = os.sysconf("SC_PAGE_SIZE")
+        self._lock = Lock()
+        self._runs: Dict[int, _StageRun] = {}
+        self._growths: Dict[str, int] = {}
+        Thread(target=self._run, name="stage-rss", daemon=True).start()
+
+    def _rss(self) -> int:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * self._page_size
+
+    def enter(self, stage: str) -> _StageRun:
+        run = _StageRun(stage, self._rss())
+        with self._lock:
+            self._runs[id(run)] = run
+        return run
+
+    def exit(self, run: _StageRun):
+        rss = self._rss()
+        with self._lock:
+            del self._runs[id(run)]
+            growth = max(run.peak, rss) - run.baseline
+            self._growths[run.stage] = max(self._growths.get(run.stage, 0), growth)
+
+    def _run(self):
+        while True:
+            rss = self._rss()
+            with self._lock:
+                for run in self._runs.values():
+                    run.peak = max(run.peak, rss)
+            time.sleep(self.interval_s)
+
+    def collect(self):
+        growths = GaugeMetricFamily(
+            "clipapi_stage_rss_growth_bytes",
+            "Largest RSS increase over a run of each stage since the previous scrape",
+            labels=["stage"],
+        )
+        with self._lock:
+            for stage, value in self._growths.items():
+                growths.add_metric([stage], value)
+            self._growths = {}
+        yield growths
+
+
+_stage_rss_sampler: StageRSSSampler | None = None
+
+
+def enable_stage_rss_sampling(interval_s: float):
+    """For servers/benchmark.py, Linux only and not with several workers."""
+    global _stage_rss_sampler
+    if MULTIPROCESS:
+        raise ValueError("Stage RSS sampling can't be used with several workers")
+    _stage_rss_sampler = StageRSSSampler(interval_s)
+    REGISTRY.register(_stage_rss_sampler)
+
+
+@contextmanager
+def stage_timer(stage: str):
+    sampler = _stage_rss_sampler
+    if sampler is None:
+        with STAGE_SECONDS.labels(stage).time():
+            yield
+        return
+    run = sampler.enter(stage)
+    try:
+        with STAGE_SECONDS.labels(stage).time():
+            yield
+    finally:
+        sampler.exit(run)
+
+
+class CacheCollector:
+    """
+    Reports the hit and miss counts the caches keep themselves, so lookups don't
+    pay for a metric update. `get_stats` returns each cache's `stats()`, or
+    `None` for a cache that's disabled or not loaded yet.
+    """
+
+    def __init__(self, get_stats: Callable[[], Dict[str, dict | None]]):
+        self.get_stats = get_stats
+
+    def collect(self):
+        lookups = CounterMetricFamily(
+            "clipapi_cache_lookups",
+            "Cache lookups by result",
+            labels=["cache", "result"],
+        )
+        for cache, stats in self.get_stats().items():
+            if stats is None:
+                continue
+            lookups.add_metric([cache, "hit"], stats["hits"])
+            lookups.add_metric([cache, "miss"], stats["misses"])
+        yield lookups
+
+
+def _publish_cache_stats(get_stats: Callable[[], Dict[str, dict | None]]):
+    """
+    Adds the lookups made since the last call to a counter of the same name as
+    the collector's, every `CACHE_STATS_INTERVAL_S`. Collectors only see the
+    caches of the worker that serves the scrape.
+    """
+    lookups = Counter(
+        "clipapi_cache_lookups", "Cache lookups by result", ["cache", "result"]
+    )
+    published: Dict[tuple, int] = {}
+    while True:
+        for cache, stats in get_stats().items():
+            if stats is None:
+                continue
+            for result, count in [("hit", stats["hits"]), ("miss", stats["misses"])]:
+                new = count - published.get((cache, result), 0)
+                if new > 0:
+                    lookups.labels(cache, result).inc(new)
+                    published[(cache, result)] = count
+        time.sleep(CACHE_STATS_INTERVAL_S)
+
+
+def register_cache_stats(get_stats: Callable[[], Dict[str, dict | None]]):
+    if not MULTIPROCESS:
+        REGISTRY.register(CacheCollector(get_stats))
+        return
+    Thread(
+        target=_publish_cache_stats, args=(get_stats,), name="cache-stats", daemon=True
+    ).start()
+
+
+def metrics_registry() -> CollectorRegistry:
+    """The registry `/metrics` serves, it reads the files of all the workers in multiprocess mode."""
+    if not MULTIPROCESS:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
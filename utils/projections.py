@@ -0,0 +1,60 @@
+import logging
+import os
+from typing import Dict
+
+import numpy as np
+
+
+class Projection:
+    def __init__(self, name: str, matrix: np.ndarray, mean: np.ndarray | None = None):
+        if matrix.ndim != 2 or (mean is not None and mean.shape != matrix.shape[:1]):
+            raise ValueError(f"Invalid projection {name}: {matrix.shape} matrix")
+        self.name = name
+        self.matrix = matrix.astype(np.float32)
+        self.mean = mean.astype(np.float32) if mean is not None else None
+
+    def apply(self, embeddings: np.ndarray) -> np.ndarray:
+        if self.mean is not None:
+            embeddings = embeddings - self.mean
+        return embeddings @ self.matrix
+
+
+def load_projection(path: str, name: str) -> Projection:
+    if path.endswith(".npy"):
+        return Projection(name, np.load(path))
+    with np.load(path) as arrays:
+        mean = arrays["mean"] if "mean" in arrays else None
+        return Projection(name, arrays["matrix"], mean)
+
+
+def load_projections(directory: str, dim: int) -> Dict[str, Projection]:
+    """
+    Loads every `<name>.npy` (a `(dim, k)` matrix) and `<name>.npz` (a "matrix"
+    and optionally the "mean" subtracted first, as fitted by a PCA) in
+    `directory`. Files that can't be read or don't take `dim` values are skipped.
+    """
+    projections: Dict[str, Projection] = {}
+    try:
+        files = sorted(os.listdir(directory))
+    except OSError as e:
+        logging.error(f"🔴 Couldn't read the embedding projections: {e}")
+        return projections
+    for file in files:
+        name, extension = os.path.splitext(file)
+        if extension not in [".npy", ".npz"]:
+            continue
+        try:
+            projection = load_projection(os.path.join(directory, file), name)
+        except Exception as e:
+            logging.warning(f"🟠 Skipped embedding projection {file}: {e}")
+            continue
+        if projection.matrix.shape[0] != dim:
+            logging.warning(
+                f"🟠 Skipped embedding projection {file}: it takes {projection.matrix.shape[0]} values, the embeddings have {dim}"
+            )
+            continue
+        projections[name] = projection
+        logging.info(
+            f"✅ Loaded embedding projection {name}: {projection.matrix.shape}"
+        )
+    return projections
@@ -0,0 +1,441 @@
+import logging
+import os
+import time
+from threading import Lock, Thread
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+
+FLAG_VALID = 1
+
+SCORE_RATING = 0
+SCORE_ARTIFACT = 1
+SCORE_NSFW = 2
+SCORE_NAMES = {"rating": SCORE_RATING, "artifact": SCORE_ARTIFACT, "nsfw": SCORE_NSFW}
+
+DTYPES = {"float32": np.dtype("<f4"), "float16": np.dtype("<f2")}
+
+# Same as faiss, fewer vectors per list make for poor centroids
+IVF_TRAIN_MIN_PER_LIST = 39
+IVF_TRAIN_MAX_PER_LIST = 64
+IVF_TRAIN_ITERATIONS = 10
+
+# Score bounds by score index, either bound can be `None`
+ScoreFilter = Dict[int, Tuple[float | None, float | None]]
+
+
+class VectorIndexFull(Exception):
+    pass
+
+
+class SearchMatch:
+    def __init__(
+        self,
+        id: str,
+        score: float,
+        rating_score: float | None,
+        artifact_score: float | None,
+        nsfw_score: float | None,
+    ):
+        self.id = id
+        self.score = score
+        self.rating_score = rating_score
+        self.artifact_score = artifact_score
+        self.nsfw_score = nsfw_score
+
+
+def _optional(value: np.float32) -> float | None:
+    return None if np.isnan(value) else float(value)
+
+
+def _scores(queries: torch.Tensor, rows: np.ndarray) -> np.ndarray:
+    # torch converts float16 rows several times faster than numpy
+    return (queries @ torch.from_numpy(rows).float().T).numpy()
+
+
+def _normalized(vectors: np.ndarray) -> np.ndarray:
+    """Rows scaled to unit length, as float32. Raises `ValueError` for a zero row."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    if not np.all(norms > 0) or not np.all(np.isfinite(norms)):
+        raise ValueError("Vectors should be finite and not all zeros")
+    return vectors / norms
+
+
+class VectorIndex:
+    """
+    Disk-backed index of embeddings by id, with their aesthetic and NSFW scores,
+    searched by cosine similarity.
+
+    Vectors are normalized on insert and kept as rows of a memory-mapped matrix,
+    ids and scores in a second file of fixed-width records, only the id lookup
+    table is held in memory and rebuilt on startup. A search multiplies the
+    queries with `block_rows` rows at a time and keeps a running top k, so its
+    memory doesn't grow with the collection.
+
+    With `ivf_lists` the vectors are also partitioned around that many k-means
+    centroids, trained once there are enough of them, and a search only scans
+    the `ivf_probes` lists closest to each query. Until then, and for `exact`
+    searches, every vector is scanned.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        capacity: int,
+        dim: int,
+        dtype: str,
+        id_max_bytes: int,
+        block_rows: int,
+        ivf_lists: int,
+        ivf_probes: int,
+    ):
+        if dtype not in DTYPES:
+            raise ValueError(f"Invalid dtype: {dtype}, should be one of {list(DTYPES)}")
+        self.capacity = capacity
+        self.dim = dim
+        self.dtype = dtype
+        self.block_rows = block_rows
+        self.ivf_lists = ivf_lists
+        self.ivf_probes = ivf_probes
+        self.meta_dtype = np.dtype(
+            [
+                ("flags", "u1"),
+                ("id", f"S{id_max_bytes}"),
+                ("scores", "<f4", 3),
+                ("list", "<i4"),
+            ]
+        )
+        os.makedirs(directory, exist_ok=True)
+        # Dimensions are a part of the file names, another model or dtype starts
+        # a fresh index instead of reading misaligned records
+        name = f"{dim}x{capacity}x{dtype}x{id_max_bytes}"
+        self._meta = self._open(
+            os.path.join(directory, f"meta-{name}.bin"), self.meta_dtype, (capacity,)
+        )
+        self._vectors = self._open(
+            os.path.join(directory, f"vectors-{name}.bin"),
+            DTYPES[dtype],
+            (capacity, dim),
+        )
+        self._centroids_path = os.path.join(
+            directory, f"centroids-{name}x{ivf_lists}.npy"
+        )
+        self._centroids: np.ndarray | None = None
+        self._training = False
+        self._by_id: Dict[bytes, int] = {}
+        self._free: List[int] = []
+        self._end = 0
+        self._lock = Lock()
+
+        valid = np.flatnonzero(self._meta["flags"] & FLAG_VALID)
+        for slot in valid:
+            self._by_id[self._meta["id"][slot]] = int(slot)
+        self._end = int(valid[-1]) + 1 if len(valid) > 0 else 0
+        self._free = sorted(set(range(self._end)) - set(self._by_id.values()))[::-1]
+        if ivf_lists > 0 and os.path.exists(self._centroids_path):
+            self._centroids = np.load(self._centroids_path)
+        logging.info(
+            f"🔎 Opened vector index at {directory} with {len(self._by_id)}/{capacity} vector(s)"
+        )
+        self._maybe_train()
+
+    @staticmethod
+    def _open(path: str, dtype: np.dtype, shape: Tuple[int, ...]) -> np.memmap:
+        mode = "r+" if os.path.exists(path) else "w+"
+        return np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+
+    def _encode_id(self, id: str) -> bytes:
+        key = id.encode()
+        if len(key) == 0 or len(key) > self.meta_dtype["id"].itemsize:
+            raise ValueError(
+                f"Invalid id: {id}, should be 1 to {self.meta_dtype['id'].itemsize} bytes"
+            )
+        if key.endswith(b"\x00"):
+            raise ValueError(f"Invalid id: {id}, can't end with a null character")
+        return key
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def upsert(
+        self,
+        id: str,
+        vector: np.ndarray,
+        rating_score: float | None = None,
+        artifact_score: float | None = None,
+        nsfw_score: float | None = None,
+    ):
+        """
+        Creates or replaces the vector and the scores of `id`. Raises `ValueError`
+        for an invalid id or vector, `VectorIndexFull` when there's no room left.
+        """
+        key = self._encode_id(id)
+        if np.shape(vector) != (self.dim,):
+            raise ValueError(
+                f"Invalid vector shape: {np.shape(vector)}, should be ({self.dim},)"
+            )
+        vector = _normalized(vector)
+        scores = [
+            np.nan if score is None else score
+            for score in [rating_score, artifact_score, nsfw_score]
+        ]
+        with self._lock:
+            slot = self._by_id.get(key)
+            if slot is None:
+                if len(self._free) > 0:
+                    slot = self._free.pop()
+                elif self._end < self.capacity:
+                    slot = self._end
+                    self._end += 1
+                else:
+                    raise VectorIndexFull(
+                        f"The vector index is full with {self.capacity} vector(s)"
+                    )
+                self._by_id[key] = slot
+            meta = self._meta[slot]
+            meta["flags"] = 0
+            meta["id"] = key
+            meta["scores"] = scores
+            meta["list"] = (
+                int(np.argmax(self._centroids @ vector))
+                if self._centroids is not None
+                else -1
+            )
+            self._vectors[slot] = vector
+            # Marked valid last, a half written record is never searched
+            meta["flags"] = FLAG_VALID
+        self._maybe_train()
+
+    def delete(self, id: str) -> bool:
+        """Removes `id`, returns whether it was in the index."""
+        key = self._encode_id(id)
+        with self._lock:
+            slot = self._by_id.pop(key, None)
+            if slot is None:
+                return False
+            self._meta["flags"][slot] = 0
+            self._free.append(slot)
+            return True
+
+    def _keep(self, start: int, stop: int, score_filter: ScoreFilter) -> np.ndarray:
+        meta = self._meta[start:stop]
+        keep = (meta["flags"] & FLAG_VALID) != 0
+        for score, (low, high) in score_filter.items():
+            values = meta["scores"][:, score]
+            # NaN, a missing score, fails both comparisons
+            if low is not None:
+                keep &= values >= low
+            if high is not None:
+                keep &= values <= high
+        return keep
+
+    @staticmethod
+    def _merge(
+        best: Tuple[np.ndarray, np.ndarray],
+        scores: np.ndarray,
+        slots: np.ndarray,
+        k: int,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """The top `k` of `best` and the `scores` of `slots`, unsorted."""
+        all_scores = np.concatenate([best[0], scores], axis=1)
+        all_slots = np.concatenate(
+            [best[1], np.broadcast_to(slots, scores.shape)], axis=1
+        )
+        if all_scores.shape[1] <= k:
+            return all_scores, all_slots
+        top = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+        return (
+            np.take_along_axis(all_scores, top, axis=1),
+            np.take_along_axis(all_slots, top, axis=1),
+        )
+
+    def _scan(
+        self,
+        queries: torch.Tensor,
+        slots: np.ndarray,
+        k: int,
+        best: Tuple[np.ndarray, np.ndarray],
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Scores the rows of `slots` in blocks, merging them into `best`."""
+        for start in range(0, len(slots), self.block_rows):
+            block_slots = slots[start : start + self.block_rows]
+            best = self._merge(
+                best, _scores(queries, self._vectors[block_slots]), block_slots, k
+            )
+        return best
+
+    def _search_exact(
+        self, queries: torch.Tensor, k: int, score_filter: ScoreFilter, end: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        best = (
+            np.empty((len(queries), 0), dtype=np.float32),
+            np.empty((len(queries), 0), dtype=np.int64),
+        )
+        for start in range(0, end, self.block_rows):
+            stop = min(start + self.block_rows, end)
+            keep = self._keep(start, stop, score_filter)
+            if keep.all():
+                # Contiguous rows are read straight from the file
+                scores = _scores(queries, self._vectors[start:stop])
+                best = self._merge(best, scores, np.arange(start, stop), k)
+            elif keep.any():
+                best = self._scan(queries, np.flatnonzero(keep) + start, k, best)
+        return best
+
+    def _search_ivf(
+        self, queries: torch.Tensor, k: int, score_filter: ScoreFilter, end: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        keep = self._keep(0, end, score_filter)
+        lists = np.asarray(self._meta["list"][:end])
+        probes = np.argsort(-(queries.numpy() @ self._centroids.T), axis=1)[
+            :, : self.ivf_probes
+        ]
+        scores, slots = [], []
+        for query, query_probes in zip(queries, probes):
+            best = (
+                np.empty((1, 0), dtype=np.float32),
+                np.empty((1, 0), dtype=np.int64),
+            )
+            candidates = np.flatnonzero(keep & np.isin(lists, query_probes))
+            best = self._scan(query[None, :], candidates, k, best)
+            scores.append(best[0][0])
+            slots.append(best[1][0])
+        # Queries with fewer than `k` candidates are padded with misses
+        width = max(len(row) for row in scores)
+        padded_scores = np.full((len(queries), width), -np.inf, dtype=np.float32)
+        padded_slots = np.zeros((len(queries), width), dtype=np.int64)
+        for row in range(len(queries)):
+            padded_scores[row, : len(scores[row])] = scores[row]
+            padded_slots[row, : len(slots[row])] = slots[row]
+        return padded_scores, padded_slots
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        score_filter: ScoreFilter | None = None,
+        exact: bool = False,
+    ) -> List[List[SearchMatch]]:
+        """
+        The `k` vectors most similar to every query among the ones whose scores
+        are within `score_filter`, best first. Searches don't wait for writes,
+        and may or may not see the ones that are in progress.
+        """
+        queries = _normalized(np.atleast_2d(queries))
+        if queries.shape[1] != self.dim:
+            raise ValueError(
+                f"Invalid query dimension: {queries.shape[1]}, should be {self.dim}"
+            )
+        score_filter = score_filter or {}
+        with self._lock:
+            end = self._end
+            use_ivf = self._centroids is not None and not self._training
+        if use_ivf and not exact:
+            search = self._search_ivf
+        else:
+            search = self._search_exact
+        scores, slots = search(torch.from_numpy(queries), k, score_filter, end)
+
+        results = []
+        order = np.argsort(-scores, axis=1)
+        for row in range(len(queries)):
+            matches = []
+            for column in order[row][:k]:
+                score = scores[row, column]
+                if not np.isfinite(score):
+                    break
+                meta = self._meta[slots[row, column]]
+                record_scores = meta["scores"]
+                matches.append(
+                    SearchMatch(
+                        id=meta["id"].decode(),
+                        score=float(score),
+                        rating_score=_optional(record_scores[SCORE_RATING]),
+                        artifact_score=_optional(record_scores[SCORE_ARTIFACT]),
+                        nsfw_score=_optional(record_scores[SCORE_NSFW]),
+                    )
+                )
+            results.append(matches)
+        return results
+
+    def _maybe_train(self):
+        with self._lock:
+            if (
+                self.ivf_lists < 1
+                or self._centroids is not None
+                or self._training
+                or len(self._by_id) < self.ivf_lists * IVF_TRAIN_MIN_PER_LIST
+            ):
+                return
+            self._training = True
+        Thread(target=self._train, name="vector-index-ivf", daemon=True).start()
+
+    def _train(self):
+        """Spherical k-means on a sample of the vectors, then assigns them all a list."""
+        start = time.time()
+        try:
+            with self._lock:
+                end = self._end
+            valid = np.flatnonzero(self._meta["flags"][:end] & FLAG_VALID)
+            rng = np.random.default_rng()
+            size = min(len(valid), self.ivf_lists * IVF_TRAIN_MAX_PER_LIST)
+            sample = np.sort(rng.choice(valid, size, replace=False))
+            vectors = np.asarray(self._vectors[sample], dtype=np.float32)
+            centroids = vectors[rng.choice(len(vectors), self.ivf_lists, replace=False)]
+            for _ in range(IVF_TRAIN_ITERATIONS):
+                assignment = np.argmax(vectors @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assignment, vectors)
+                counts = np.bincount(assignment, minlength=self.ivf_lists)
+                # Empty lists start over from a random vector
+                empty = counts == 0
+                sums[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+                centroids = _normalized(sums)
+
+            with self._lock:
+                self._centroids = centroids
+                # Vectors written while training got no list, and the ones
+                # written from now on are assigned on insert
+                end = self._end
+            for block_start in range(0, end, self.block_rows):
+                block_stop = min(block_start + self.block_rows, end)
+                with self._lock:
+                    block = np.asarray(
+                        self._vectors[block_start:block_stop], dtype=np.float32
+                    )
+                    self._meta["list"][block_start:block_stop] = np.argmax(
+                        block @ centroids.T, axis=1
+                    )
+            self._meta.flush()
+            # Written last, an index without it trains again on startup
+            tmp_path = f"{self._centroids_path}.tmp.npy"
+            np.save(tmp_path, centroids)
+            os.replace(tmp_path, self._centroids_path)
+            logging.info(
+                f"✅ Trained {self.ivf_lists} IVF lists on {size} vector(s) in: {round((time.time() - start) * 1000)} ms"
+            )
+        except Exception as e:
+            with self._lock:
+                self._centroids = None
+            logging.error(f"🔴 Failed to train the IVF lists: {e}")
+        finally:
+            with self._lock:
+                self._training = False
+
+    def flush(self):
+        with self._lock:
+            self._meta.flush()
+            self._vectors.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "vectors": len(self._by_id),
+                "capacity": self.capacity,
+                "dim": self.dim,
+                "dtype": self.dtype,
+                "ivf_lists": self.ivf_lists,
+                "ivf_trained": self._centroids is not None and not self._training,
+            }